@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Time copying files to an SFTP server with a varying number of concurrent jobs.
+
+The SFTP server is a local paramiko stand-in serving a temporary directory.
+Network latency is simulated by delaying every read & write request on the
+server side (see --delay).
+
+Usage: sftp_performance.py [--delay SECONDS] [--jobs N,N,...] FILE...
+
+"""
+import sys
+import os
+import time
+import shutil
+import socket
+import tempfile
+import logging
+import urlparse
+import multiprocessing
+import multiprocessing.pool
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'picture_clerk'))
+from connector import LocalConnector, SSHConnector
+
+
+USERNAME = 'pic'
+PASSWORD = 'pic'
+DELAY = 0.0
+
+
+class StubServer(paramiko.ServerInterface):
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (USERNAME, PASSWORD):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+
+    def read(self, offset, length):
+        time.sleep(DELAY)
+        return paramiko.SFTPHandle.read(self, offset, length)
+
+    def write(self, offset, data):
+        time.sleep(DELAY)
+        return paramiko.SFTPHandle.write(self, offset, data)
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                                                os.fstat(self.readfile.fileno()))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+
+    root = None
+
+    def _path(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._path(path), flags, 0666)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = StubSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+def serve(sock, root, delay):
+    """Accept SSH connections on sock and serve SFTP sessions (forever)."""
+    global DELAY
+    DELAY = delay
+    StubSFTPServer.root = root
+    host_key = paramiko.RSAKey.generate(2048)
+    while True:
+        conn, _ = sock.accept()
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                        StubSFTPServer)
+        transport.start_server(server=StubServer())
+
+
+class StubSSHConnector(SSHConnector):
+
+    """SSHConnector authenticating to the stand-in server by password."""
+
+    def _connect(self):
+        self._ssh = paramiko.SSHClient()
+        self._ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self._ssh.connect(self.url.hostname, port=self.url.port,
+                          username=USERNAME, password=PASSWORD,
+                          allow_agent=False, look_for_keys=False)
+        self._init_channels()
+
+
+def copy_files(files, dest, jobs):
+    src = LocalConnector.from_string('/')
+    with src.connected(), dest.connected():
+        def copy_file(path):
+            src.copy(os.path.abspath(path), dest, os.path.basename(path))
+        pool = multiprocessing.pool.ThreadPool(jobs)
+        try:
+            for _ in pool.imap_unordered(copy_file, files):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    jobs_list = [1, 2, 4, 8]
+    while args and args[0].startswith('--'):
+        opt = args.pop(0)
+        if opt == '--delay':
+            DELAY = float(args.pop(0))
+        elif opt == '--jobs':
+            jobs_list = [int(n) for n in args.pop(0).split(',')]
+    files = args
+    if not files:
+        sys.exit(__doc__)
+    total_size = sum(os.path.getsize(path) for path in files)
+
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+    # run server in its own process so it doesn't compete for client's GIL
+    root = tempfile.mkdtemp()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(10)
+    server = multiprocessing.Process(target=serve, args=(sock, root, DELAY))
+    server.daemon = True
+    server.start()
+
+    try:
+        print 'Copying %i files (%.1f MB) with a request delay of %.3f sec' % \
+            (len(files), total_size / 1024.0 ** 2, DELAY)
+        for jobs in jobs_list:
+            dest_dir = 'jobs%i' % jobs
+            os.mkdir(os.path.join(root, dest_dir))
+            url = urlparse.urlparse('ssh://127.0.0.1:%i/%s' %
+                                    (sock.getsockname()[1], dest_dir))
+            start = time.time()
+            copy_files(files, StubSSHConnector(url), jobs)
+            exec_time = time.time() - start
+            print '%2i jobs: %.3f sec (%.1f MB/s)' % \
+                (jobs, exec_time, total_size / 1024.0 ** 2 / exec_time)
+    finally:
+        server.terminate()
+        shutil.rmtree(root)
@@ -5,19 +5,48 @@
 
 """
 import os
+import json
 import logging
+import collections
+import random
+import re
+import time
+import multiprocessing
+import multiprocessing.pool
+import threading
+import Queue
 
+import config
 import repo
 
-from connector import Connector, LocalConnector
+from connector import BACKUP_MODES, Connector, LocalConnector
+from dispatcher import wait_interruptibly
+from index import PictureIndex
+from journal import Journal, get_state, set_state
 from recipe import Recipe
-from picture import Picture, get_sha1
+from picture import Picture, get_digests, get_stat_key
+from picture import cheapest_algorithm, strongest_algorithm
 from pipeline import Pipeline
+from stats import format_stats
+from worker import is_current
 from viewer import Viewer
 
 
 log = logging.getLogger('pic.app')
 
+# pipelines processing pictures (see cancel)
+_pipelines = []
+
+# states of a picture file reported by iter_check_pics
+OK = 'ok'
+CORRUPT = 'corrupt'
+MISSING = 'missing'
+UNCHANGED = 'unchanged'
+
+# units of scrub budgets (see parse_budget)
+_TIME_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+_SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
 
 def init_repo(url):
     """
@@ -54,7 +83,7 @@ def load_repo(url):
     log.info("Loaded PictureClerk repository from disk")
     return rep
 
-def add_pics(rep, paths, process, recipe=None):
+def add_pics(rep, paths, process, recipe=None, resume=False):
     """
     Add pictures to repository.
     
@@ -62,32 +91,307 @@ def add_pics(rep, paths, process, recipe=None):
     rep     -- Add pictures to this repository.
     paths   -- Paths of the pictures to be added (check if path exists).
     process -- Boolean flag if added pictures should be processed.
-    recipe  -- Recipe to use for picture processing.
+    recipe  -- Recipe (or recipe string) to use for picture processing.
+    resume  -- Boolean flag if processing interrupted before should be
+               resumed (stages recorded in the journal aren't run again).
+    """
+    pics = _add_pics(rep, paths, resume)
+    if process:
+        for pic in _iter_process_pics(rep, pics, recipe, resume):
+            pass
+    else:
+        log.info("Saving index to file.")
+        with rep.connector.connected():
+            rep.save_index_to_disk()
+    return rep
+
+def iter_add_pics(rep, paths, recipe=None, resume=False):
     """
+    Add pictures to repository & process them. Yield every picture as soon
+    as all stages of the recipe are done with it (pictures whose processing
+    failed aren't yielded). See add_pics for the arguments.
 
+    The index is saved regularly meanwhile (see _iter_process_pics) and once
+    all pictures are processed or the caller stops iterating.
+    """
+    return _iter_process_pics(rep, _add_pics(rep, paths, resume), recipe,
+                              resume)
+
+def _add_pics(rep, paths, resume=False):
+    """
+    Add pictures of existing paths to the index & return them. If resume is
+    set, pictures already in the index (saved by the interrupted run) are
+    returned instead of being added again.
+    """
+    pics = []
     for path in paths:
         if not os.path.exists(path):
             log.warning("File not found: '%s'. Skipping it." % path)
+        elif resume and path in rep.index:
+            pics.append(rep.index[path])
+        else:
+            pic = Picture(path)
+            rep.index.add(pic)
+            pics.append(pic)
+    return pics
 
-    pics = [Picture(path) for path in paths if os.path.exists(path)]
-    rep.index.add(pics)
+def process_pics(rep, files=None, recipe=None, resume=False, force=False):
+    """
+    Process pictures of the repository again. Stages whose results are up to
+    date (see worker.is_current) skip the pictures, so only new stages of
+    the recipe and pictures changed since their last processing are worked
+    on.
 
-    if process:
-        log.info("Processing pictures.")
-        if not recipe:  # set up pipeline
-            process_recipe = \
-                Recipe.fromString(rep.config['recipes.default'])
-        pl = Pipeline('Pipeline1', process_recipe,
-                      path=rep.connector.url.path)
-        for pic in pics:
-            pl.put(pic)
-        pl.start()  # start processing threads
-        pl.join()   # wait until threads exit
+    Arguments:
+    rep    -- Process pictures of this repository.
+    files  -- Process pictures associated with these files (default: all).
+    recipe -- Recipe (or recipe string) to use for picture processing.
+    resume -- Boolean flag if processing interrupted before should be
+              resumed (stages recorded in the journal aren't run again).
+    force  -- Boolean flag if stages should work on all pictures even if
+              their results are up to date.
+    """
+    if files:
+        pics = []
+        for fname in files:
+            if fname in rep.index:
+                pics.append(rep.index[fname])
+            else:
+                log.warning("Picture not in repository: '%s'. Skipping it."
+                            % fname)
+    else:
+        pics = rep.index.pics()
+    for pic in _iter_process_pics(rep, pics, recipe, resume, force):
+        pass
+    return rep
 
-    log.info("Saving index to file.")
+def _iter_process_pics(rep, pics, recipe, resume, force=False):
+    """
+    Run pictures through a pipeline & yield them once all stages are done
+    with them. Saves the index & the pipeline's statistics at the end.
+
+    The pictures are put into the pipeline by a separate thread while the
+    pipeline's output is consumed here. The index is saved whenever
+    'index.checkpoint_size' pictures were done or 'index.checkpoint_interval'
+    seconds passed since it was saved, so a crash doesn't lose all results
+    (see _checkpoint). Every checkpoint writes the whole index, so they're
+    spaced to spend at most the fraction 'index.checkpoint_max_overhead' of
+    the time on saving large indexes.
+
+    The jobs done are recorded in the repository's journal. If resume is
+    set, the pictures' state is restored from the journal and stages already
+    done with a picture don't work on it again. Otherwise the journal is
+    cleared first. Unless force is set, stages skip pictures their results
+    are up to date for as well.
+    """
+    log.info("Processing pictures.")
+    if not recipe:  # set up pipeline
+        recipe = rep.config['recipes.default']
+    if isinstance(recipe, basestring):
+        recipe = Recipe.fromString(recipe)
+    path = rep.connector.url.path
+    journal = Journal(os.path.join(path, repo.JOURNAL_FILE))
+    records = dict()
+    if resume:
+        records = journal.replay()
+        log.info("Resuming processing of %i pictures.", len(records))
+    else:
+        journal.clear()
+    pl = Pipeline('Pipeline1', recipe, path=path, conf=rep.config,
+                  journal=journal)
+    checkpoint_size = rep.config.get('index.checkpoint_size',
+                                     config.INDEX_CHECKPOINT_SIZE)
+    checkpoint_interval = rep.config.get('index.checkpoint_interval',
+                                         config.INDEX_CHECKPOINT_INTERVAL)
+    max_overhead = rep.config.get('index.checkpoint_max_overhead',
+                                  config.INDEX_CHECKPOINT_MAX_OVERHEAD)
+    _pipelines.append(pl)
+    journal.open()
+    pl.start()  # start processing threads
+    # states of the pictures put into the pipeline by filename, removed once
+    # they left it (see _checkpoint)
+    in_flight = dict()
+    feeder = _Feeder(pl, recipe, path, rep.config, pics, records, force,
+                     in_flight)
+    feeder.start()
+    try:
+        unsaved = 0
+        saved = time.time()
+        spacing = 0  # minimum number of seconds between checkpoints
+        taken = []  # job taken from the pipeline's output
+        finished = lambda: not feeder.is_alive() and pl.output.empty()
+        while True:
+            deadline = None
+            if unsaved:
+                deadline = saved + max(checkpoint_interval, spacing)
+            wait_interruptibly(lambda timeout: _try_get(pl.output, taken,
+                                                        timeout),
+                               finished, deadline)
+            if taken:
+                (pic, jobnr) = taken.pop()
+                in_flight.pop(pic.filename, None)
+                unsaved += 1
+                yield pic
+            elif finished():
+                break
+            elapsed = time.time() - saved
+            if unsaved and elapsed >= spacing and \
+                    (unsaved >= checkpoint_size or
+                     elapsed >= checkpoint_interval):
+                start = time.time()
+                _checkpoint(rep, in_flight)
+                (unsaved, saved) = (0, time.time())
+                if max_overhead:
+                    spacing = (saved - start) / max_overhead
+        feeder.join()
+        if feeder.error is not None:
+            raise feeder.error
+    finally:
+        if feeder.is_alive():   # caller stopped iterating or error
+            pl.cancel()
+            feeder.join()
+        _pipelines.remove(pl)
+        journal.close()
+        stats = pl.get_stats()
+        log.info("Pipeline statistics:\n%s", format_stats(stats))
+        failures = pl.get_failures()
+        if failures:
+            log.warning("%i jobs failed:\n%s", len(failures),
+                        _format_failures(failures))
+
+        log.info("Saving index to file.")
+        with rep.connector.connected():
+            rep.save_index_to_disk()
+            rep.save_stats_to_disk(stats)
+        if pl.cancelled.is_set():
+            log.warning("Processing cancelled. The results done so far were "
+                        "saved, use --resume to continue.")
+        else:
+            # the index contains the results now
+            journal.clear()
+
+
+def _checkpoint(rep, in_flight):
+    """
+    Save the index while pictures are being processed. Workers may be
+    changing the pictures still in the pipeline, so they are saved in the
+    state they entered it (in_flight, see get_state) instead: the journal
+    records their progress since.
+    """
+    log.info("Saving index to file (checkpoint).")
+    snapshot = dict()
+    for pic in rep.index.iterpics():
+        state = in_flight.get(pic.filename)
+        if state is not None:
+            pic = Picture(pic.filename)
+            set_state(pic, state)
+        snapshot[pic.filename] = pic
     with rep.connector.connected():
-        rep.save_index_to_disk()
-    return rep
+        rep.save_index_to_disk(PictureIndex(snapshot))
+
+
+class _Feeder(threading.Thread):
+    """
+    Thread putting pictures into a pipeline (see _iter_process_pics), then
+    joining it. Pictures all stages are done with already (replayed from
+    records of the journal or up to date unless force is set) are put into
+    the pipeline's output right away. The state of every picture is stored
+    in in_flight (by filename) before it's changed.
+    """
+
+    def __init__(self, pl, recipe, path, conf, pics, records, force,
+                 in_flight):
+        threading.Thread.__init__(self, name='Feeder')
+        self.daemon = True
+        self.pl = pl
+        self.recipe = recipe
+        self.path = path
+        self.conf = conf
+        self.pics = pics
+        self.records = records
+        self.force = force
+        self.in_flight = in_flight
+        self.error = None   # exception raised by the thread
+
+    def run(self):
+        try:
+            self._feed()
+        except Exception, e:
+            log.exception("Putting pictures into the pipeline failed.")
+            self.error = e
+            self.pl.cancel()
+        finally:
+            self.pl.join()  # wait until threads exit
+
+    def _feed(self):
+        # stages not journaled (e.g. LoadWorker) are always run again
+        journaled = set(WorkerClass.name
+                        for WorkerClass in self.recipe.stage_types
+                        if WorkerClass.journaled)
+        for pic in self.pics:
+            if self.pl.cancelled.is_set():
+                break
+            self.in_flight[pic.filename] = get_state(pic)
+            (done, state) = self.records.get(pic.filename, (set(), None))
+            if state is not None:
+                set_state(pic, state)
+            if not self.force:
+                done = done | _current_stages(self.recipe, pic, self.path,
+                                              self.conf)
+            if journaled and journaled <= done:
+                log.info("%s already processed. Skipping it.", pic.filename)
+                self.pl.output.put((pic, None))
+                continue
+            self.pl.put(pic, done)  # blocks while the pipeline's input is full
+
+def _try_get(queue, items, timeout):
+    """
+    Append an item taken from queue to items, waiting at most timeout
+    seconds for one. Return True if an item was taken.
+    """
+    try:
+        items.append(queue.get(timeout=timeout))
+    except Queue.Empty:
+        return False
+    return True
+
+def cancel():
+    """
+    Cancel processing of pictures: pending jobs are dropped, the results
+    done so far are saved (see add_pics & process_pics). Return True if
+    pictures were being processed. Safe to call from signal handlers.
+    """
+    for pl in list(_pipelines):
+        pl.cancel()
+    return bool(_pipelines)
+
+def _format_failures(failures):
+    """Return lines listing failed jobs (see Pipeline.get_failures)."""
+    return '\n'.join("  %s: %s%s" % (picture.filename, stage,
+                                      ' (%s)' % error if error else '')
+                     for (picture, jobnr, stage, error) in failures)
+
+def _current_stages(recipe, pic, path, conf):
+    """
+    Return names of the stages of recipe whose results for pic are up to
+    date. A stage's results are outdated as well if the results of a stage
+    it depends on are.
+    """
+    try:
+        stat = get_stat_key(os.stat(os.path.join(path, pic.filename)))
+    except OSError:
+        return set()
+    outdated = []
+    for (i, WorkerClass) in enumerate(recipe.stage_types):
+        deps = recipe.stage_dependencies[i]
+        # stages without results (e.g. LoadWorker) are outdated if the
+        # stages they depend on are
+        outdated.append(any(outdated[j] for j in deps) or
+                        (WorkerClass.journaled and
+                         not is_current(WorkerClass, pic, stat, path, conf)))
+    return set(WorkerClass.name for (WorkerClass, old)
+               in zip(recipe.stage_types, outdated)
+               if WorkerClass.journaled and not old)
 
 def remove_pics(rep, files):
     """
@@ -101,18 +405,12 @@ def remove_pics(rep, files):
     rep.index.remove(pics)
 
     # remove all files associated with above pictures
-    picfiles = (picfile for pic in pics
-                        for picfile in pic.get_filenames())
+    picfiles = [picfile for pic in pics
+                        for picfile in pic.get_filenames()]
 
     with rep.connector.connected():
-        for picfile in picfiles:
-            try:
-                rep.connector.remove(picfile)
-            except OSError, e:
-                if e.errno == 2: # ignore missing file (= already removed) error
-                    log.debug("No such file: %s" % e.filename)
-                else:
-                    raise   # re-raise all other (e.g. permission error)
+        # missing files (= already removed) are skipped
+        rep.connector.remove_many(picfiles)
 
         log.info("Saving index to file.")
         rep.save_index_to_disk()
@@ -139,6 +437,22 @@ def list_pics(rep, mode):
         return '\n'.join(('%s *%s' % (pic.checksum, pic.filename)
                           for pic in rep.index.pics()))
 
+def show_stats(rep, raw=False):
+    """
+    Return statistics of the last processing of pictures (see add_pics).
+
+    Arguments:
+    rep -- Show statistics of this repository.
+    raw -- Return statistics as JSON instead of a table.
+    """
+    with rep.connector.connected():
+        stats = rep.load_stats_from_disk()
+    if stats is None:
+        return "No statistics recorded yet (see 'pic add')."
+    if raw:
+        return json.dumps(stats, indent=2, sort_keys=True)
+    return format_stats(stats)
+
 def view_pics(rep, prog):
     """
     Launch external viewer and keep track of pictures deleted within.
@@ -171,32 +485,316 @@ def migrate_repo(rep):
             rep.save_config_to_disk()
     return rep
 
-def check_pics(rep):
+def _check_pic(connector, fname, algorithm, expected, chunk_size):
+    """Hash a single picture file. Return (filename, state, stat key)."""
+    try:
+        stat = get_stat_key(connector.stat(fname))
+        with connector.open(fname, 'rb') as fh:
+            checksum = get_digests(fh, [algorithm], chunk_size)[algorithm]
+    except (IOError, OSError):
+        return fname, MISSING, None
+    else:
+        return fname, OK if checksum == expected else CORRUPT, stat
+
+def _get_device(connector, fname):
+    """Return ID of the device a file resides on (or None if unknown)."""
+    # remote connectors don't know about devices: treat host as one device
+    # (without stat'ing every file over the network)
+    if not isinstance(connector, LocalConnector):
+        return connector.url.netloc
+    try:
+        return connector.stat(fname).st_dev
+    except (IOError, OSError):
+        return None
+
+def _get_size(connector, pic):
+    """Return size of a picture file (or 0 if unknown)."""
+    if pic.stat:
+        return pic.stat[0]
+    try:
+        return connector.stat(pic.filename).st_size
+    except (IOError, OSError):
+        return 0
+
+def parse_budget(budget):
     """
-    Verify picture checksums. Return names of corrupt & missing files.
+    Parse a time (e.g. '90s', '30m', '2h', '1d') or size budget (e.g. '500M',
+    '2G', '1T').
+    
+    Returns:
+    2-tuple ('time', seconds) or ('bytes', number of bytes).
+    
+    Raises:
+    ValueError if the budget can't be parsed.
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhdKMGT])B?\s*$', budget)
+    if not match:
+        raise ValueError("invalid budget: %s" % budget)
+    value, unit = float(match.group(1)), match.group(2)
+    if unit in _TIME_UNITS:
+        return 'time', value * _TIME_UNITS[unit]
+    else:
+        return 'bytes', int(value * _SIZE_UNITS[unit])
+
+def _iter_check_jobs(connector, checks, jobs, processes, device_jobs,
+                     deadline=None):
+    """
+    Run _check_pic for all supplied argument tuples, 'jobs' at a time.
+    
+    Arguments:
+    connector   -- Connector to the checked repository (must be connected).
+    checks      -- List of argument tuples for _check_pic.
+    jobs        -- Number of concurrent checks.
+    processes   -- Hash in processes instead of threads.
+    device_jobs -- Maximum number of concurrent checks per device (0: no
+                   limit).
+    deadline    -- Don't start checks after this time (seconds since epoch).
+    
+    Yields:
+    Results of _check_pic as soon as they are available.
+    """
+    def expired():
+        return deadline is not None and time.time() >= deadline
+
+    if jobs <= 1:
+        for args in checks:
+            if expired():
+                break
+            yield _check_pic(*args)
+        return
+
+    if processes and not isinstance(connector, LocalConnector):
+        log.warning("Hashing remote pictures in threads, not processes.")
+        processes = False
+    if processes:
+        pool = multiprocessing.Pool(jobs)
+    else:
+        pool = multiprocessing.pool.ThreadPool(jobs)
+
+    # queue checks per device, so that busy devices don't block others
+    waiting = collections.OrderedDict()
+    for args in checks:
+        device = _get_device(connector, args[1]) if device_jobs else None
+        waiting.setdefault(device, collections.deque()).append(args)
+    busy = collections.Counter()    # number of checks per device
+    inflight = dict()   # (device, AsyncResult) of each file being checked
+    results = Queue.Queue()
+    try:
+        while waiting or inflight:
+            if expired():
+                waiting.clear()
+            for device, queued in waiting.items():
+                while queued and len(inflight) < jobs and \
+                        (not device_jobs or busy[device] < device_jobs):
+                    args = queued.popleft()
+                    busy[device] += 1
+                    inflight[args[1]] = (device, pool.apply_async(
+                            _check_pic, args, callback=results.put))
+                if not queued:
+                    del waiting[device]
+            if not inflight:
+                break
+            result = _get_check_result(results, inflight)
+            busy[inflight.pop(result[0])[0]] -= 1
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _get_check_result(results, inflight):
+    """
+    Return the next result put into results by a check's callback. Checks
+    raising an exception (e.g. NotConnectedError or connectors that can't be
+    pickled for processes) don't call the callback: their exception is
+    raised instead of waiting forever.
+    """
+    taken = []
+    def wait(timeout):
+        if _try_get(results, taken, timeout):
+            return True
+        for (device, result) in inflight.values():
+            if result.ready() and not result.successful():
+                result.get()    # raises the check's exception
+        return False
+    wait_interruptibly(wait, lambda: False)
+    return taken[0]
+
+def _iter_remote_checks(connector, checks, deadline=None):
+    """
+    Calculate checksums where the files reside (see Connector.iter_digests).
     
     Arguments:
-    rep -- Verify pictures in this repository.
+    connector -- Connector to the checked repository (must be connected).
+    checks    -- List of argument tuples for _check_pic.
+    deadline  -- Stop checking after this time (seconds since epoch).
+    
+    Yields:
+    Results like _check_pic as soon as they are available.
+    """
+    groups = collections.OrderedDict()    # checks by algorithm
+    for _, fname, algorithm, expected, chunk_size in checks:
+        groups.setdefault((algorithm, chunk_size), {})[fname] = expected
+    for (algorithm, chunk_size), expected in groups.iteritems():
+        digests = connector.iter_digests(expected.keys(), algorithm,
+                                         chunk_size)
+        try:
+            for fname, checksum in digests:
+                if checksum is None:
+                    yield fname, MISSING, None
+                elif checksum != expected[fname]:
+                    yield fname, CORRUPT, None
+                else:
+                    try:
+                        stat = get_stat_key(connector.stat(fname))
+                    except (IOError, OSError):
+                        stat = None
+                    yield fname, OK, stat
+                if deadline is not None and time.time() >= deadline:
+                    return
+        finally:
+            digests.close()
+
+def iter_check_pics(rep, audit=False, jobs=None, processes=None, quick=False,
+                    sample=None, budget=None, remote=None):
+    """
+    Verify picture checksums. Yield (filename, state) as soon as known.
+    
+    Routine checks compare the cheapest checksum recorded for a picture (e.g.
+    CRC32), audits compare the strongest one (e.g. SHA256). Pictures are
+    hashed concurrently by a pool of 'jobs' threads (or processes), but at
+    most 'check.device_jobs' files of the same device are read at once.
+    
+    Quick checks only hash files whose size, modification time, inode or
+    device changed since they were last hashed, plus a random sample of the
+    unchanged ones to detect bitrot. The file status of verified pictures is
+    recorded in the index.
+    
+    Scrubs (i.e. checks with a budget) verify the least recently verified
+    pictures first and stop as soon as the time or size budget is used up.
+    Running a scrub regularly thus verifies the whole repository on a rolling
+    basis. The time of the last verification is recorded in the index.
+    
+    Checksums of repositories on SSH hosts are calculated on the remote host
+    if possible, only the digests are transferred. This way a remote copy of
+    the repository (e.g. a backup) is verified against the index, too. Quick
+    checks and the verification records don't apply to remote copies.
+    
+    Arguments:
+    rep       -- Verify pictures in this repository.
+    audit     -- Verify the strongest instead of the cheapest checksum.
+    jobs      -- Number of concurrent checks (default: 'check.jobs').
+    processes -- Hash in processes instead of threads (default:
+                 'check.processes'), only used for local repositories.
+    quick     -- Skip pictures whose file status is unchanged.
+    sample    -- Fraction of unchanged pictures to hash anyway in quick mode
+                 (default: 'check.sample').
+    budget    -- Time or size budget of a scrub (see parse_budget).
+    remote    -- URL of a copy of the repository to verify instead.
+    
+    Yields:
+    2-tuples of filename and state (OK, CORRUPT, MISSING or UNCHANGED).
+    """
+    if jobs is None:
+        jobs = rep.config['check.jobs']
+    if processes is None:
+        processes = rep.config['check.processes']
+    if sample is None:
+        sample = rep.config['check.sample']
+    device_jobs = rep.config['check.device_jobs']
+    chunk_size = rep.config['checksums.chunk_size']
+    select_algorithm = strongest_algorithm if audit else cheapest_algorithm
+    pics = rep.index.pics()
+    deadline = None
+    size_budget = None
+    if budget:
+        kind, value = parse_budget(budget)
+        if kind == 'time':
+            deadline = time.time() + value
+        else:
+            size_budget = value
+        # scrub least recently verified pictures first
+        pics.sort(key=lambda pic: pic.verified or 0)
+
+    if remote:
+        connector = Connector.from_string(remote)
+        quick = False   # file status of the copy isn't recorded
+    else:
+        connector = rep.connector
+
+    with connector.connected():
+        checks = []
+        for pic in pics:
+            if size_budget is not None:
+                if size_budget <= 0:
+                    break
+                size_budget -= _get_size(connector, pic)
+            if quick and pic.stat and random.random() >= sample:
+                try:
+                    stat = get_stat_key(connector.stat(pic.filename))
+                except (IOError, OSError):
+                    yield pic.filename, MISSING
+                    continue
+                if stat == pic.stat:
+                    yield pic.filename, UNCHANGED
+                    continue
+            algorithms = [algorithm for algorithm in pic.checksums
+                          if algorithm in connector.remote_algorithms]
+            algorithm = select_algorithm(algorithms) or \
+                select_algorithm(pic.checksums) or 'sha1'
+            checks.append((connector, pic.filename, algorithm,
+                           pic.checksums.get(algorithm), chunk_size))
+
+        if connector.remote_algorithms:
+            results = _iter_remote_checks(connector, checks, deadline)
+        else:
+            results = _iter_check_jobs(connector, checks, jobs, processes,
+                                       device_jobs, deadline)
+        verified = False
+        for fname, state, stat in results:
+            if state == OK and not remote:
+                rep.index[fname].stat = stat
+                rep.index[fname].verified = time.time()
+                verified = True
+            yield fname, state
+
+        if budget and not remote:
+            _warn_overdue(rep)
+        if verified:
+            log.info("Saving index to file.")
+            rep.save_index_to_disk()
+
+def _warn_overdue(rep):
+    """Log number of pictures not verified within the scrub cycle."""
+    cycle = rep.config['check.cycle_days']
+    threshold = time.time() - cycle * 24 * 60 * 60
+    overdue = len([pic for pic in rep.index.iterpics()
+                   if (pic.verified or 0) < threshold])
+    if overdue:
+        log.warning("%i pictures have not been verified in the last %i days.",
+                    overdue, cycle)
+
+def check_pics(rep, audit=False, jobs=None, processes=None, quick=False,
+               sample=None, budget=None, remote=None):
+    """
+    Verify picture checksums. Return names of corrupt & missing files.
+    
+    See iter_check_pics for a description of the arguments.
     
     Returns:
-    A 2-tuple containing a list over the corrupted and a list over the
-    missing picture's filenames.
+    A 2-tuple containing a sorted list over the corrupted and a sorted list
+    over the missing picture's filenames.
     """
     corrupted = []
     missing = []
 
-    with rep.connector.connected():
-        for pic in rep.index.pics():
-            try:
-                with rep.connector.open(pic.filename, 'r') as buf:
-                    checksum = get_sha1(buf.read())
-            except (IOError, OSError):
-                missing.append(pic.filename)
-            else:
-                if checksum != pic.checksum:
-                    corrupted.append(pic.filename)
+    for fname, state in iter_check_pics(rep, audit, jobs, processes, quick,
+                                        sample, budget, remote):
+        if state == CORRUPT:
+            corrupted.append(fname)
+        elif state == MISSING:
+            missing.append(fname)
 
-    return corrupted, missing
+    return sorted(corrupted), sorted(missing)
 
 def merge_repos(rep, *others):
     """
@@ -215,7 +813,8 @@ def merge_repos(rep, *others):
                 # copy picture files
                 for picture in other.index.iterpics():
                     for fname in picture.get_filenames():
-                        connector.copy(fname, rep.connector, dest_path=fname)
+                        connector.copy(fname, rep.connector, dest_path=fname,
+                            checksums=repo.get_checksums(picture, fname))
             # add pictures to index
             rep.index.add(other.index.iterpics())
     log.info("Saving index to file.")
@@ -223,13 +822,16 @@ def merge_repos(rep, *others):
         rep.save_index_to_disk()
     return rep
 
-def clone_repo(src, dest):
+def clone_repo(src, dest, verify=False, mode=None, jobs=None):
     """
     Clone a repository.
     
     Arguments:
-    src  -- URL of to the repository to clone from.
-    dest -- URL of the target directory of the clone.
+    src    -- URL of to the repository to clone from.
+    dest   -- URL of the target directory of the clone.
+    verify -- Read back and verify every copied file.
+    mode   -- How files are copied locally (see LocalConnector.copy).
+    jobs   -- Number of files copied concurrently.
     
     Returns:
     A clone of the supplied repository.
@@ -240,28 +842,42 @@ def clone_repo(src, dest):
         dest = os.path.join(dest, origin.name)  # make clone at "<dest>/<name>"
         dest_connector = Connector.from_string(dest)
         with dest_connector.connected():
-            clone = repo.Repo.clone(origin, dest_connector)
+            clone = repo.Repo.clone(origin, dest_connector, verify, mode,
+                                    jobs)
     init_repo_logging(clone)
     log.info("Cloned repository from %s to %s" % (src, dest))
     return clone
 
-def backup_repo(rep, *urls):
+def backup_repo(rep, *urls, **options):
     """
     Backup a repository to multiple locations.
     
     Arguments:
-    rep  -- Repository to be backed up
-    urls -- Backup repository to these locations (1 or more URL args).
+    rep    -- Repository to be backed up
+    urls   -- Backup repository to these locations (1 or more URL args).
+    verify -- Read back and verify every copied file (keyword only).
+    mode   -- How files are copied locally (see LocalConnector.copy, keyword
+              only, default: 'copy' regardless of 'clone.mode'). Hard links
+              aren't backups: 'hardlink' raises ValueError.
+    jobs   -- Number of files copied concurrently (keyword only).
     
     Returns:
     Backup repositories (clones of the supplied respositories).
     """
+    verify = options.get('verify', False)
+    mode = options.get('mode') or 'copy'
+    jobs = options.get('jobs')
+    if mode not in BACKUP_MODES:
+        raise ValueError("invalid backup mode: %s" % mode)
+    if mode == 'reflink':
+        log.warning("Backups reflinked on the repository's filesystem share "
+                    "its data blocks: they don't survive damage of the disk.")
     backups = list()
     for url in urls:
         url = os.path.join(url, rep.name)
         connector = Connector.from_string(url)
         with rep.connector.connected(), connector.connected():
-            backup = repo.Repo.clone(rep, connector)
+            backup = repo.Repo.clone(rep, connector, verify, mode, jobs)
         init_repo_logging(backup)
         backups.append(backup)
         log.info("Backed up repository to %s" % url)
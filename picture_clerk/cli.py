@@ -14,6 +14,7 @@ import pprint
 
 import app
 import config
+import connector
 
 
 log = logging.getLogger('pic.cli')
@@ -24,6 +25,8 @@ class CLI(object):
 
     def __init__(self):
         self.app = None
+        # exit code of a command cancelled by a signal
+        self.exit_code = None
 
     def setup_signal_handlers(self):
         signal.signal(signal.SIGINT, self.handle_sigint)
@@ -31,11 +34,22 @@ class CLI(object):
 
     def handle_sigint(self, signum, frame):
         print("Caught signal INT")  # don't use logging due to possible deadlock
-        self.shutdown(exit_code=128 + signum)
+        self.cancel(exit_code=128 + signum)
 
     def handle_sigterm(self, signum, frame):
         print("Caught signal TERM")  # don't use logging due to possible deadlock
-        self.shutdown(exit_code=128 + signum)
+        self.cancel(exit_code=128 + signum)
+
+    def cancel(self, exit_code):
+        """
+        Cancel processing of pictures, so the command saves the results done
+        so far and exits. Shut down right away if no pictures are processed
+        or if cancelling was requested before.
+        """
+        if self.exit_code is None and app.cancel():
+            self.exit_code = exit_code
+        else:
+            self.shutdown(exit_code)
 
     def setup_logging(self, verbosity):
         """Configure logging and add console logger with supplied verbosity.
@@ -78,7 +92,14 @@ class CLI(object):
 
     def handle_add_cmd(self, conf):
         repo = app.load_repo(conf['working_dir'])
-        app.add_pics(repo, conf['add.files'], conf['add.process'], conf['add.recipe'])
+        app.add_pics(repo, conf['add.files'], conf['add.process'],
+                     conf['add.recipe'], conf['add.resume'])
+        return 0
+
+    def handle_process_cmd(self, conf):
+        repo = app.load_repo(conf['working_dir'])
+        app.process_pics(repo, conf['process.files'], conf['process.recipe'],
+                         conf['process.resume'], conf['process.force'])
         return 0
 
     def handle_remove_cmd(self, conf):
@@ -96,6 +117,11 @@ class CLI(object):
         app.view_pics(repo, conf['viewer.prog'])
         return 0
 
+    def handle_stats_cmd(self, conf):
+        repo = app.load_repo(conf['working_dir'])
+        print app.show_stats(repo, raw=conf['stats.json'])
+        return 0
+
     def handle_migrate_cmd(self, conf):
         repo = app.load_repo(conf['working_dir'])
         app.migrate_repo(repo)
@@ -103,14 +129,18 @@ class CLI(object):
 
     def handle_check_cmd(self, conf):
         repo = app.load_repo(conf['working_dir'])
-        corrupt_pics, missing_pics = app.check_pics(repo)
         exit_code = 0
-        if corrupt_pics:
-            print '\n'.join('CORRUPT: %s' % pic for pic in corrupt_pics)
-            exit_code = 1
-        if missing_pics:
-            print '\n'.join('MISSING: %s' % pic for pic in missing_pics)
-            exit_code = 1
+        for pic, state in app.iter_check_pics(repo,
+                                              audit=conf['check.audit'],
+                                              jobs=conf['check.jobs'],
+                                              processes=conf['check.processes'],
+                                              quick=conf['check.quick'],
+                                              sample=conf['check.sample'],
+                                              budget=conf['check.budget'],
+                                              remote=conf['check.remote']):
+            if state in (app.CORRUPT, app.MISSING):
+                print '%s: %s' % (state.upper(), pic)
+                exit_code = 1
         return exit_code
 
     def handle_merge_cmd(self, conf):
@@ -119,12 +149,16 @@ class CLI(object):
         return 0
 
     def handle_clone_cmd(self, conf):
-        app.clone_repo(src=conf['clone.repo'], dest=conf['working_dir'])
+        app.clone_repo(src=conf['clone.repo'], dest=conf['working_dir'],
+                       verify=conf['clone.verify'], mode=conf['clone.mode'],
+                       jobs=conf['clone.jobs'])
         return 0
 
     def handle_backup_cmd(self, conf):
         repo = app.load_repo(conf['working_dir'])
-        app.backup_repo(repo, *conf['backup.path'])
+        app.backup_repo(repo, *conf['backup.path'],
+                        verify=conf['backup.verify'], mode=conf['backup.mode'],
+                        jobs=conf['backup.jobs'])
         return 0
 
     def parse_args(self, args, conf):
@@ -166,6 +200,11 @@ class CLI(object):
             dest='add.recipe',
             metavar='RECIPE',
             help="processing instructions (comma separated list)")
+        parser_add.add_argument(
+            '--resume',
+            dest='add.resume',
+            action='store_true',
+            help="resume interrupted processing (skip jobs already done)")
         parser_add.add_argument(
             'add.files',
             metavar='file',
@@ -173,6 +212,32 @@ class CLI(object):
             help="picture file(s) to add")
         parser_add.set_defaults(func=self.handle_add_cmd)
 
+        # 'process' subcommand
+        parser_process = subparsers.add_parser(
+            'process',
+            help="process pictures whose results are outdated")
+        parser_process.add_argument(
+            '--recipe',
+            dest='process.recipe',
+            metavar='RECIPE',
+            help="processing instructions (comma separated list)")
+        parser_process.add_argument(
+            '--resume',
+            dest='process.resume',
+            action='store_true',
+            help="resume interrupted processing (skip jobs already done)")
+        parser_process.add_argument(
+            '-f', '--force',
+            dest='process.force',
+            action='store_true',
+            help="process pictures even if their results are up to date")
+        parser_process.add_argument(
+            'process.files',
+            metavar='file',
+            nargs='*',
+            help="picture(s) to process (default: all)")
+        parser_process.set_defaults(func=self.handle_process_cmd)
+
         # 'remove' subcommand
         parser_remove = subparsers.add_parser(
             'remove',
@@ -207,6 +272,18 @@ class CLI(object):
              help="program to use as picture viewer")
         parser_view.set_defaults(func=self.handle_view_cmd)
 
+        # 'stats' subcommand
+        parser_stats = subparsers.add_parser(
+            'stats',
+            help="show throughput and latency of last picture processing")
+        parser_stats.add_argument(
+            '--json',
+            dest='stats.json',
+            default=False,
+            action='store_true',
+            help="print statistics as JSON")
+        parser_stats.set_defaults(func=self.handle_stats_cmd)
+
         # 'migrate' subcommand
         parser_migrate = subparsers.add_parser(
             'migrate',
@@ -217,6 +294,48 @@ class CLI(object):
         parser_check = subparsers.add_parser(
             'check',
             help="find corrupt or missing picture files")
+        parser_check.add_argument(
+            '--audit',
+            dest='check.audit',
+            default=False,
+            action='store_true',
+            help="verify strongest instead of cheapest checksum")
+        parser_check.add_argument(
+            '-j', '--jobs',
+            dest='check.jobs',
+            metavar='N',
+            type=int,
+            help="number of pictures to check concurrently")
+        parser_check.add_argument(
+            '--processes',
+            dest='check.processes',
+            default=None,
+            action='store_true',
+            help="hash pictures in processes instead of threads")
+        parser_check.add_argument(
+            '-q', '--quick',
+            dest='check.quick',
+            default=False,
+            action='store_true',
+            help="only verify pictures whose file status changed")
+        parser_check.add_argument(
+            '--sample',
+            dest='check.sample',
+            metavar='FRACTION',
+            type=float,
+            help="fraction of unchanged pictures to verify anyway (--quick)")
+        parser_check.add_argument(
+            '--budget',
+            dest='check.budget',
+            metavar='BUDGET',
+            help="only verify least recently verified pictures within a time "
+                 "(e.g. 2h) or size (e.g. 100G) budget")
+        parser_check.add_argument(
+            '--remote',
+            dest='check.remote',
+            metavar='URL',
+            help="verify copy of repository at URL (e.g. a backup), "
+                 "checksums of ssh:// copies are calculated remotely")
         parser_check.set_defaults(func=self.handle_check_cmd)
 
         # 'merge' subcommand
@@ -238,6 +357,23 @@ class CLI(object):
             'clone.repo',
             metavar='repo',
             help="repository to clone (origin)")
+        parser_clone.add_argument(
+            '--verify',
+            dest='clone.verify',
+            default=False,
+            action='store_true',
+            help="read back and verify copied files")
+        parser_clone.add_argument(
+            '--mode',
+            dest='clone.mode',
+            choices=connector.COPY_MODES,
+            help="how to copy files between local repositories")
+        parser_clone.add_argument(
+            '-j', '--jobs',
+            dest='clone.jobs',
+            metavar='N',
+            type=int,
+            help="number of files to copy concurrently")
         parser_clone.set_defaults(func=self.handle_clone_cmd)
 
         # 'backup' subcommand
@@ -255,6 +391,23 @@ class CLI(object):
             metavar='path',
             nargs='*',
             help="one or more backup path(s)")
+        parser_backup.add_argument(
+            '--verify',
+            dest='backup.verify',
+            default=False,
+            action='store_true',
+            help="read back and verify copied files")
+        parser_backup.add_argument(
+            '--mode',
+            dest='backup.mode',
+            choices=connector.BACKUP_MODES,
+            help="how to copy files between local repositories")
+        parser_backup.add_argument(
+            '-j', '--jobs',
+            dest='backup.jobs',
+            metavar='N',
+            type=int,
+            help="number of files to copy concurrently")
         parser_backup.set_defaults(func=self.handle_backup_cmd)
 
         return vars(parser.parse_args(args))
@@ -283,6 +436,8 @@ class CLI(object):
         self.setup_logging(conf['logging.verbosity'])
 
         exit_code = self.handle_command(conf)
+        if self.exit_code is not None:  # cancelled
+            exit_code = self.exit_code
         self.shutdown(exit_code)
 
     def shutdown(self, exit_code):
@@ -24,9 +24,64 @@ APP_CONFIG_FILE = os.path.join(APP_DIR, 'config')
 # number of workers in each stage by default
 STAGE_SIZE = 1
 
+# bounds of the number of workers per stage (see Dispatcher.job_done)
+STAGE_MIN_WORKERS = 1
+STAGE_MAX_WORKERS = 8
+
+# engine running the jobs of a pipeline's stages: 'stages' (every stage has
+# its own workers), 'shared' (one pool of workers for all stages, see
+# SharedPool) or 'events' (like 'shared', but the external programs of
+# subprocess stages are run by an EventLoop) & number of workers of the shared
+# pool (0: twice the CPUs) & maximum number of external programs run by the
+# event loop at the same time
+PIPELINE_ENGINE = 'stages'
+PIPELINE_POOL_SIZE = 0
+PIPELINE_MAX_SUBPROCESSES = 64
+
+# maximum number of jobs waiting in front of each stage (0: unlimited)
+PIPELINE_BUFFER_SIZE = 64
+
+# maximum number of bytes of picture files loaded into memory at the same time
+# by a pipeline (see MemoryGovernor, 0: unlimited)
+PIPELINE_MEMORY_BUDGET = 512 * 1024 * 1024
+
+# number of times a job failing with a transient I/O error is retried & number
+# of seconds to wait before the first retry (doubled for every further retry)
+STAGE_RETRIES = 3
+STAGE_RETRY_DELAY = 0.5
+
+# number of seconds between checks whether a pipeline was cancelled while
+# waiting (blocking waits can't be interrupted by signals) & maximum number of
+# seconds an aborted pipeline waits for the jobs in progress
+POLL_INTERVAL = 0.1
+PIPELINE_ABORT_TIMEOUT = 5
+
+# the index is saved while processing pictures whenever this number of
+# pictures were done or this number of seconds passed since it was last saved
+INDEX_CHECKPOINT_SIZE = 100
+INDEX_CHECKPOINT_INTERVAL = 60
+
+# maximum fraction of the processing time spent on index checkpoints (every
+# checkpoint writes the whole index, they're spaced further apart if saving
+# takes long, 0: unlimited)
+INDEX_CHECKPOINT_MAX_OVERHEAD = 0.1
+
 # number of seconds a worker should wait for new jobs if queue is empty
 WORKER_TIMEOUT = 1
 
+# maximum number of pictures passed to one run of an external program & number
+# of seconds to wait for more pictures before running it (see SubprocessWorker)
+SUBPROCESS_BATCH_SIZE = 32
+SUBPROCESS_BATCH_WAIT = 0.1
+
+# number of bytes read at once when calculating checksums of picture files
+CHUNK_SIZE = 1024 * 1024
+
+# SSH flow control window & maximum packet size of SFTP channels (the larger
+# the window, the more data can be in flight on high-latency links)
+SFTP_WINDOW_SIZE = 64 * 1024 * 1024
+SFTP_MAX_PACKET_SIZE = 32 * 1024
+
 # path to exiv2 executable (used by Exiv2XMPSidecarWorker)
 EXIV2_BIN = '/usr/bin/exiv2'
 
@@ -9,14 +9,45 @@ import urlparse
 import logging
 import errno
 import contextlib
+import ctypes
+import ctypes.util
+import fcntl
+import threading
+import pipes
+import re
+import socket
 
 import paramiko
 
+from paramiko.sftp import CMD_MKDIR, CMD_REMOVE, CMD_STATUS
+
 from abc import ABCMeta, abstractmethod
 
+import config
+
+from picture import MultiDigest, get_digests, iter_chunks
+
 
 log = logging.getLogger('pic.connector')
 
+# modes of copying files between local connectors (see LocalConnector.copy)
+COPY_MODES = ('copy', 'fast', 'reflink', 'hardlink')
+# modes making copies that don't depend on their source, usable for backups
+BACKUP_MODES = ('copy', 'fast', 'reflink')
+
+# ioctl request sharing the data blocks of two files (Linux' FICLONE)
+_FICLONE = 0x40049409
+
+# cached attributes of a path known to exist that must be fetched again
+_STALE = object()
+
+# commands calculating checksums on SSH hosts (see SSHConnector.iter_digests)
+_SUM_COMMANDS = {'md5': 'md5sum', 'sha1': 'sha1sum', 'sha256': 'sha256sum',
+                 'sha512': 'sha512sum'}
+# exit status of the remote checksum command if the repository's directory
+# can't be entered (not used by xargs)
+_CD_FAILED = 100
+
 
 class NotConnectedError(Exception):
     pass
@@ -40,12 +71,28 @@ class ConnectionError(Exception):
         return self.url.geturl()
 
 
+class ChecksumMismatchError(Exception):
+
+    def __init__(self, path, algorithm, expected, actual):
+        self.path = path
+        self.algorithm = algorithm
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return "%s checksum mismatch of '%s': expected %s, got %s" % \
+            (self.algorithm, self.path, self.expected, self.actual)
+
+
 class Connector(object):
 
     """Holds the logic on how to connect to given URLs. (Abstract class)"""
 
     __metaclass__ = ABCMeta
 
+    # checksum algorithms calculated where the files reside (see iter_digests)
+    remote_algorithms = ()
+
     def __init__(self, url):
         """Connector's constructor.
 
@@ -153,14 +200,56 @@ class Connector(object):
         """
         if self.isconnected:
             rel_dirname = os.path.dirname(rel_path)
-            if recursive and not self.exists(rel_dirname):
-                self.mkdir(rel_dirname)
+            if recursive and rel_dirname and not self.exists(rel_dirname):
+                self.mkdir(rel_dirname, mode, recursive=True)
             path = self._rel2abs(rel_path)
             log.debug("Creating directory '%s'" % path)
             self._mkdir(path, mode)
         else:
             raise NotConnectedError()
 
+    def _mkdir_many(self, paths, mode):
+        """Create directories one after another. Return errors (or None)."""
+        return _apply_many(self._mkdir, paths, mode)
+
+    def mkdir_many(self, rel_paths, mode=0777):
+        """Create directories at the supplied relative paths.
+
+        Missing parent directories are created as well, existing directories
+        are skipped. Connectors may send all directories of the same depth to
+        the remote end at once (see SSHConnector).
+
+        Arguments:
+        rel_paths -- paths of directories to create relative to base URL
+        mode      -- numeric mode (default: 0777) see os.mkdir's mode for infos
+
+        Raises:
+        NotConnectedError
+
+        """
+        if self.isconnected:
+            missing = set()
+            for rel_path in rel_paths:
+                rel_path = os.path.normpath(rel_path)
+                while rel_path not in ('', '.', os.sep) \
+                        and rel_path not in missing \
+                        and not self.exists(rel_path):
+                    missing.add(rel_path)
+                    rel_path = os.path.dirname(rel_path)
+            # create parents before their children
+            depths = dict()
+            for rel_path in missing:
+                depths.setdefault(rel_path.count(os.sep), []).append(rel_path)
+            for depth in sorted(depths):
+                paths = [self._rel2abs(rel_path)
+                         for rel_path in sorted(depths[depth])]
+                log.debug("Creating %i directories" % len(paths))
+                for error in self._mkdir_many(paths, mode):
+                    if error:
+                        raise error
+        else:
+            raise NotConnectedError()
+
     @abstractmethod
     def _remove(self, path):
         raise NotImplementedError
@@ -182,6 +271,54 @@ class Connector(object):
         else:
             raise NotConnectedError()
 
+    def _remove_many(self, paths):
+        """Remove files one after another. Return errors (or None)."""
+        return _apply_many(self._remove, paths)
+
+    def remove_many(self, rel_paths):
+        """Remove files at supplied relative paths, skip missing files.
+
+        Arguments:
+        rel_paths -- paths of files to remove relative to connector's base URL
+
+        Raises:
+        NotConnectedError
+
+        """
+        if self.isconnected:
+            paths = [self._rel2abs(rel_path) for rel_path in rel_paths]
+            log.debug("Removing %i files" % len(paths))
+            for path, error in zip(paths, self._remove_many(paths)):
+                if error and error.errno == errno.ENOENT:
+                    log.debug("No such file: %s" % path)
+                elif error:
+                    raise error
+        else:
+            raise NotConnectedError()
+
+    @abstractmethod
+    def _rename(self, src_path, dest_path):
+        raise NotImplementedError
+
+    def rename(self, src_rel_path, dest_rel_path):
+        """Rename file, replacing an existing destination file atomically.
+
+        Arguments:
+        src_rel_path  -- path of file to rename relative to base URL
+        dest_rel_path -- new path of file relative to base URL
+
+        Raises:
+        NotConnectedError
+
+        """
+        if self.isconnected:
+            src_path = self._rel2abs(src_rel_path)
+            dest_path = self._rel2abs(dest_rel_path)
+            log.debug("Renaming file '%s' to '%s'" % (src_path, dest_path))
+            self._rename(src_path, dest_path)
+        else:
+            raise NotConnectedError()
+
     @abstractmethod
     def _exists(self, path):
         raise NotImplementedError
@@ -203,31 +340,126 @@ class Connector(object):
         else:
             raise NotConnectedError()
 
-    def copy(self, src_path, dest_conn, dest_path, create_parents=False):
+    @abstractmethod
+    def _stat(self, path):
+        raise NotImplementedError
+
+    def stat(self, rel_path):
+        """Return status of file at relative path (see os.stat).
+
+        Remote connectors may not provide all fields of os.stat's result.
+
+        Arguments:
+        rel_path -- path of file relative to connector's base URL
+
+        Raises:
+        NotConnectedError
+
+        """
+        if self.isconnected:
+            path = self._rel2abs(rel_path)
+            log.debug("Retrieving status of '%s'" % path)
+            return self._stat(path)
+        else:
+            raise NotConnectedError()
+
+    def copy(self, src_path, dest_conn, dest_path, create_parents=False,
+             checksums=None, verify=False, chunk_size=config.CHUNK_SIZE,
+             mode='copy'):
         """Copy file from src_path to dest_path based on dest_conn's URL.
 
+        The file is copied in chunks. If checksums are supplied, they are
+        calculated from the chunks as they pass through and compared to the
+        expected values, so no extra pass over the source is needed. If verify
+        is set, the destination is read back and its checksums are compared
+        as well. A destination that fails either comparison is removed.
+
         Arguments:
         src_path       -- path of file to copy relative to this conn's base URL
         dest_conn      -- connector to destination path
         dest_src       -- destination path relative to dest_conn's base URL
         create_parents -- recursively create parent directories at destination
+        checksums      -- expected checksums tagged by algorithm (optional)
+        verify         -- read back destination and compare its checksums
+        chunk_size     -- number of bytes copied at once
+        mode           -- one of COPY_MODES, only supported between local
+                          connectors (see LocalConnector.copy)
 
         Raises:
         NotConnectedError
+        ChecksumMismatchError
 
         """
         if self.isconnected:
             log.debug("Copying '%s'" % \
                           urlparse.urljoin(dest_conn.url.geturl(), dest_path))
-            with self.open(src_path, 'r') as src_fh:
-                dest_dirname = os.path.dirname(dest_path)
-                if create_parents and not dest_conn.exists(dest_dirname):
-                    dest_conn.mkdir(dest_dirname, recursive=True)
-                with dest_conn.open(dest_path, 'w') as dest_fh:
-                    dest_fh.writelines(src_fh.readlines())
+            algorithms = checksums.keys() if checksums else []
+            if verify and not algorithms:
+                algorithms = ['sha1']
+            digest = MultiDigest(algorithms)
+            with self.open(src_path, 'rb') as src_fh:
+                if create_parents:
+                    self._create_parents(dest_conn, dest_path)
+                with dest_conn.open(dest_path, 'wb') as dest_fh:
+                    # local files write the chunks (buffer objects, see
+                    # iter_chunks) without copying, paramiko can't write them
+                    copy_chunks = not isinstance(dest_fh, file)
+                    for chunk in iter_chunks(src_fh, chunk_size):
+                        digest.update(chunk)
+                        dest_fh.write(str(chunk) if copy_chunks else chunk)
+            actual = digest.hexdigests()
+            if checksums:
+                self._compare_checksums(dest_conn, dest_path, checksums, actual)
+            if verify:
+                self._verify_copy(dest_conn, dest_path, actual, chunk_size)
         else:
             raise NotConnectedError()
 
+    def iter_digests(self, rel_paths, algorithm, chunk_size=config.CHUNK_SIZE):
+        """Calculate checksums of files. Yield (rel_path, hexdigest) tuples.
+
+        The hexdigest of files that don't exist or can't be read is None.
+        Connectors calculate checksums of their remote_algorithms on the
+        remote host, all others are calculated locally.
+
+        Arguments:
+        rel_paths  -- paths of files relative to connector's base URL
+        algorithm  -- checksum algorithm (see picture.ALGORITHMS)
+        chunk_size -- number of bytes read at once
+
+        Raises:
+        NotConnectedError
+
+        """
+        if not self.isconnected:
+            raise NotConnectedError()
+        for rel_path in rel_paths:
+            try:
+                with self.open(rel_path, 'rb') as fh:
+                    digests = get_digests(fh, [algorithm], chunk_size)
+            except (IOError, OSError):
+                yield rel_path, None
+            else:
+                yield rel_path, digests[algorithm]
+
+    def _create_parents(self, dest_conn, dest_path):
+        """Create missing parent directories of dest_path at dest_conn."""
+        dest_conn.mkdir_many([os.path.dirname(dest_path)])
+
+    def _verify_copy(self, dest_conn, dest_path, expected, chunk_size):
+        """Read back copied file and compare its checksums to expected ones."""
+        with dest_conn.open(dest_path, 'rb') as dest_fh:
+            written = get_digests(dest_fh, expected.keys(), chunk_size)
+        self._compare_checksums(dest_conn, dest_path, expected, written)
+
+    def _compare_checksums(self, dest_conn, dest_path, expected, actual):
+        """Remove destination & raise ChecksumMismatchError on mismatch."""
+        for algorithm, value in expected.iteritems():
+            if actual[algorithm] != value:
+                dest_conn.remove(dest_path)
+                raise ChecksumMismatchError(dest_path, algorithm,
+                                            value, actual[algorithm])
+
     @classmethod
     def from_string(cls, url):
         """Parse url string and return appropriate Connector instance.
@@ -274,17 +506,173 @@ class LocalConnector(Connector):
     def _exists(self, path):
         return os.path.exists(path)
 
+    def _stat(self, path):
+        return os.stat(path)
+
     def _mkdir(self, path, mode):
         os.mkdir(path, mode)
 
     def _remove(self, path):
         os.remove(path)
 
+    def _rename(self, src_path, dest_path):
+        os.rename(src_path, dest_path)
+
+    def copy(self, src_path, dest_conn, dest_path, create_parents=False,
+             checksums=None, verify=False, chunk_size=config.CHUNK_SIZE,
+             mode='copy'):
+        """Copy file from src_path to dest_path based on dest_conn's URL.
+
+        Between two local connectors the following modes are supported:
+           "copy"     -->  copy in chunks & compare checksums on the fly
+           "fast"     -->  copy inside the kernel (sendfile), data doesn't
+                           pass through Python
+           "reflink"  -->  share data blocks between source and copy if the
+                           filesystem supports it (e.g. btrfs, XFS), else fast
+           "hardlink" -->  hard link copy to source if both are on the same
+                           filesystem, else fast
+
+        The data of the "fast", "reflink" and "hardlink" modes is not hashed,
+        supplied checksums are only compared if verify is set (destination
+        is read back). See Connector.copy for a description of the arguments.
+
+        """
+        if mode == 'copy' or not isinstance(dest_conn, LocalConnector):
+            return Connector.copy(self, src_path, dest_conn, dest_path,
+                                  create_parents, checksums, verify,
+                                  chunk_size)
+        if mode not in COPY_MODES:
+            raise ValueError("unknown copy mode: %s" % mode)
+        if not (self.isconnected and dest_conn.isconnected):
+            raise NotConnectedError()
+
+        src = self._rel2abs(src_path)
+        dest = dest_conn._rel2abs(dest_path)
+        log.debug("Copying '%s' (%s)" % (dest, mode))
+        if create_parents:
+            self._create_parents(dest_conn, dest_path)
+        if not (mode == 'hardlink' and _hardlink(src, dest)):
+            with open(src, 'rb') as src_fh:
+                with open(dest, 'wb') as dest_fh:
+                    if not (mode == 'reflink' and _reflink(src_fh, dest_fh)):
+                        _copy_file(src_fh, dest_fh, chunk_size)
+        if verify:
+            if not checksums:
+                with open(src, 'rb') as src_fh:
+                    checksums = get_digests(src_fh, ['sha1'], chunk_size)
+            self._verify_copy(dest_conn, dest_path, checksums, chunk_size)
+
+
+def _apply_many(func, paths, *args):
+    """Call func for every path. Return list of raised errors (or None)."""
+    errors = list()
+    for path in paths:
+        try:
+            func(path, *args)
+        except EnvironmentError, e:
+            errors.append(e)
+        else:
+            errors.append(None)
+    return errors
+
+def _hardlink(src, dest):
+    """Hard link dest to src. Return False if not possible."""
+    try:
+        if os.path.lexists(dest):
+            os.remove(dest)
+        os.link(src, dest)
+    except OSError, e:
+        if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                       errno.EOPNOTSUPP):
+            log.debug("Hard linking '%s' failed: %s" % (dest, e))
+            return False
+        raise
+    return True
+
+def _reflink(src_fh, dest_fh):
+    """Share data blocks of src_fh with dest_fh. Return False if unsupported."""
+    try:
+        fcntl.ioctl(dest_fh.fileno(), _FICLONE, src_fh.fileno())
+    except IOError, e:
+        log.debug("Reflinking '%s' failed: %s" % (dest_fh.name, e))
+        return False
+    return True
+
+def _load_sendfile():
+    """Return sendfile(out_fd, in_fd, count) function or None if unavailable.
+
+    Uses os.sendfile if available (Python 3), libc's sendfile otherwise.
+
+    """
+    if hasattr(os, 'sendfile'):
+        return lambda out_fd, in_fd, count: os.sendfile(out_fd, in_fd,
+                                                        None, count)
+    try:
+        libc_sendfile = ctypes.CDLL(ctypes.util.find_library('c'),
+                                    use_errno=True).sendfile
+    except (OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                              ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, count):
+        sent = libc_sendfile(out_fd, in_fd, None, count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+_sendfile = _load_sendfile()
+
+def _copy_file(src_fh, dest_fh, chunk_size):
+    """Copy content of src_fh to dest_fh, inside the kernel if possible."""
+    if _sendfile:
+        try:
+            remaining = os.fstat(src_fh.fileno()).st_size
+            while remaining > 0:
+                sent = _sendfile(dest_fh.fileno(), src_fh.fileno(), remaining)
+                if not sent:
+                    break
+                remaining -= sent
+            return
+        except OSError, e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            log.debug("sendfile failed (%s), copying in chunks" % e)
+            src_fh.seek(0)
+            dest_fh.seek(0)
+            dest_fh.truncate()
+    for chunk in iter_chunks(src_fh, chunk_size):
+        dest_fh.write(chunk)
+
 
 class SSHConnector(Connector):
 
+    """Connector to a remote path over SFTP.
+
+    All SFTP channels share a single SSH connection. Every thread using the
+    connector opens its own channel, so files can be transferred concurrently
+    (see Repo.clone's jobs argument). Files opened for reading are prefetched
+    and writes are pipelined, i.e. requests are sent without waiting for the
+    server's acknowledgements.
+
+    File attributes are cached for the duration of a connection: the first
+    lookup of a path lists its whole parent directory, so checking the
+    siblings of a path doesn't need further round-trips. mkdir_many and
+    remove_many send all their requests at once and then collect the replies.
+
+    Checksums of remote_algorithms are calculated by coreutils' commands on
+    the remote host, only the digests are transferred (see iter_digests).
+
+    """
+
+    remote_algorithms = tuple(sorted(_SUM_COMMANDS))
+
     def __init__(self, url):
         Connector.__init__(self, url)
+        self._clear_cache()
 
     def _connect(self):
         #@todo: handle SSH authentication
@@ -296,13 +684,95 @@ class SSHConnector(Connector):
             else:
                 self._ssh.connect(self.url.hostname, port=self.url.port,
                                   username=self.url.username)
-            self._sftp = self._ssh.open_sftp()
+            self._init_channels()
         except paramiko.SSHException:
             raise ConnectionError(self.url)
 
+    def _init_channels(self):
+        """Setup pool of SFTP channels over the established SSH connection."""
+        self._channels = list()
+        self._channels_lock = threading.Lock()
+        self._local = threading.local()
+        self._sftp  # open the connecting thread's channel right away
+
+    @property
+    def _sftp(self):
+        """SFTP client of the calling thread (opened on first use)."""
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            sftp = paramiko.SFTPClient.from_transport(
+                self._ssh.get_transport(),
+                window_size=config.SFTP_WINDOW_SIZE,
+                max_packet_size=config.SFTP_MAX_PACKET_SIZE)
+            with self._channels_lock:
+                self._channels.append(sftp)
+            self._local.sftp = sftp
+        return sftp
+
     def _disconnect(self):
-        self._sftp.close()
+        with self._channels_lock:
+            for sftp in self._channels:
+                sftp.close()
+            del self._channels[:]
+        self._local = threading.local()
         self._ssh.close()
+        self._clear_cache()
+
+    def _clear_cache(self):
+        # path -> SFTPAttributes, None (missing) or _STALE (exists)
+        self._attrs = dict()
+        # directories whose entries are all in self._attrs
+        self._listed = set()
+        self._cache_lock = threading.RLock()
+
+    def _list(self, path):
+        """Cache attributes of all entries of directory. Return success."""
+        try:
+            entries = self._sftp.listdir_attr(path)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                self._attrs[path] = None
+                return True
+            return False    # e.g. not a directory or not readable
+        for attrs in entries:
+            self._attrs.setdefault(os.path.join(path, attrs.filename), attrs)
+        self._listed.add(path)
+        return True
+
+    def _lookup(self, path, fresh=False):
+        """Return (cached) attributes of path or None if it doesn't exist.
+
+        Unless fresh is set, _STALE is returned for paths known to exist whose
+        attributes changed since they were cached.
+
+        """
+        with self._cache_lock:
+            dirname = os.path.dirname(path)
+            if path not in self._attrs and dirname != path:
+                if dirname not in self._listed and \
+                        self._attrs.get(dirname, _STALE) is not None:
+                    self._list(dirname)
+                if path not in self._attrs and (dirname in self._listed or
+                        self._attrs.get(dirname, _STALE) is None):
+                    return None
+            attrs = self._attrs.get(path, _STALE)
+            if attrs is _STALE and (fresh or path not in self._attrs):
+                try:
+                    attrs = self._sftp.stat(path)
+                except IOError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    attrs = None
+                self._attrs[path] = attrs
+            return attrs
+
+    def _update_cache(self, path, attrs, listed=False):
+        with self._cache_lock:
+            self._attrs[path] = attrs
+            if listed:
+                self._listed.add(path)
+            else:
+                self._listed.discard(path)
 
     def _open(self, path, mode):
         # patch SFTPFile to be used as a context manager
@@ -315,21 +785,183 @@ class SSHConnector(Connector):
             return False
         paramiko.SFTPFile.__exit__ = exit
 
-        return self._sftp.open(path, mode)
+        fh = self._sftp.open(path, mode, bufsize=config.CHUNK_SIZE)
+        if 'r' in mode and '+' not in mode:
+            fh.prefetch()
+        else:
+            fh.set_pipelined(True)
+            self._update_cache(path, _STALE)
+        return fh
 
     def _exists(self, path):
         """Equivalent to os.path.exists for SFTP."""
-        try:
-            self._sftp.stat(path)
-        except IOError, e:
-            if e.errno == errno.ENOENT:  # "No such file or directory"
-                return False
-            raise
-        else:
-            return True
+        return self._lookup(path) is not None
+
+    def _stat(self, path):
+        attrs = self._lookup(path, fresh=True)
+        if attrs is None:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return attrs
 
     def _mkdir(self, path, mode):
         self._sftp.mkdir(path, mode)
+        self._update_cache(path, _STALE, listed=True)  # new dirs are empty
+
+    def _mkdir_many(self, paths, mode):
+        attrs = paramiko.SFTPAttributes()
+        attrs.st_mode = mode
+        errors = self._pipeline([(CMD_MKDIR, path, attrs) for path in paths])
+        for path, error in zip(paths, errors):
+            if not error:
+                self._update_cache(path, _STALE, listed=True)
+        return errors
 
     def _remove(self, path):
         self._sftp.remove(path)
+        self._update_cache(path, None)
+
+    def _rename(self, src_path, dest_path):
+        # plain SFTP rename fails if the destination exists
+        self._sftp.posix_rename(src_path, dest_path)
+        self._update_cache(src_path, None)
+        self._update_cache(dest_path, _STALE)
+
+    def _remove_many(self, paths):
+        errors = self._pipeline([(CMD_REMOVE, path) for path in paths])
+        for path, error in zip(paths, errors):
+            if not error or error.errno == errno.ENOENT:
+                self._update_cache(path, None)
+        return errors
+
+    def iter_digests(self, rel_paths, algorithm, chunk_size=config.CHUNK_SIZE):
+        """Calculate checksums of files. Yield (rel_path, hexdigest) tuples.
+
+        Checksums of remote_algorithms are calculated on the remote host by
+        running e.g. sha1sum over the SSH connection. The file names are fed
+        to it on stdin, so there's no limit on their number. Digests are
+        yielded as they are streamed back. If the command is not available,
+        checksums are calculated locally (see Connector.iter_digests).
+
+        """
+        if algorithm not in _SUM_COMMANDS:
+            for item in Connector.iter_digests(self, rel_paths, algorithm,
+                                               chunk_size):
+                yield item
+            return
+        if not self.isconnected:
+            raise NotConnectedError()
+        rel_paths = list(rel_paths)
+        if not rel_paths:
+            return
+
+        command = "cd %s || exit %i; xargs -0 %s --" % (
+                        pipes.quote(self.url.path), _CD_FAILED,
+                        _SUM_COMMANDS[algorithm])
+        log.debug("Running '%s' for %i files" % (command, len(rel_paths)))
+        stdin, stdout, stderr = self._ssh.exec_command(command)
+        # feed file names & read the error output in the background, the
+        # command would otherwise block once the channel's window is full
+        def feed():
+            try:
+                stdin.write('\0'.join(rel_paths))
+                stdin.channel.shutdown_write()
+            except (IOError, EOFError, socket.error), e:
+                log.debug("Sending file names failed: %s" % e)
+        errors = []
+        def drain():
+            try:
+                for line in stderr:
+                    errors.append(line.rstrip())
+                    log.debug(line.rstrip())
+            except (IOError, EOFError, socket.error), e:
+                log.debug("Reading error output failed: %s" % e)
+        threads = [threading.Thread(target=feed),
+                   threading.Thread(target=drain)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        missing = set(rel_paths)
+        try:
+            for line in stdout:
+                rel_path, digest = _parse_sum_line(line)
+                if rel_path in missing:
+                    missing.remove(rel_path)
+                    yield rel_path, digest
+            status = stdout.channel.recv_exit_status()
+        finally:
+            stdout.channel.close()
+            for thread in threads:
+                thread.join()
+
+        missing = [rel_path for rel_path in rel_paths if rel_path in missing]
+        if status == _CD_FAILED:
+            # e.g. a path relative to the home directory, which SFTP accepts:
+            # don't report all files as missing
+            log.warning("Can't change to %s on %s (%s), calculating "
+                        "checksums locally." % (self.url.path,
+                                                self.url.hostname,
+                                                '; '.join(errors)))
+        elif status in (126, 127):  # command can't be run or not found
+            log.warning("Can't run %s on %s, calculating checksums locally." %
+                        (_SUM_COMMANDS[algorithm], self.url.hostname))
+        if status in (_CD_FAILED, 126, 127):
+            for item in Connector.iter_digests(self, missing, algorithm,
+                                               chunk_size):
+                yield item
+        else:
+            for rel_path in missing:
+                yield rel_path, None
+
+    def _pipeline(self, requests):
+        """Send all SFTP requests at once, then wait for their replies.
+
+        Relies on paramiko's internal request API (also used by SFTPFile's
+        prefetching) as SFTPClient only offers synchronous requests.
+
+        Arguments:
+        requests -- list of tuples (SFTP request type, request args...)
+
+        Returns:
+        List of IOErrors (or None) in the order of the requests.
+
+        """
+        sftp = self._sftp
+        replies = _SFTPReplies()
+        nums = [sftp._async_request(replies, request[0], *request[1:])
+                for request in requests]
+        while len(replies) < len(nums):
+            sftp._read_response()
+        errors = list()
+        for num in nums:
+            t, msg = replies[num]
+            try:
+                if t == CMD_STATUS:
+                    sftp._convert_status(msg)
+            except IOError, e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
+
+def _parse_sum_line(line):
+    """Parse output line of e.g. sha1sum. Return (filename, hexdigest)."""
+    line = line.rstrip('\n')
+    escaped = line.startswith('\\')
+    if escaped:
+        line = line[1:]
+    digest, fname = line.split(' ', 1)
+    fname = fname[1:]   # skip ' ' (text) or '*' (binary mode) indicator
+    if escaped:
+        fname = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n'
+                       else m.group(1), fname)
+    return fname, digest
+
+
+class _SFTPReplies(dict):
+
+    """Collect replies to asynchronous SFTP requests by request number."""
+
+    def _async_response(self, t, msg, num):
+        self[num] = (t, msg)
@@ -4,56 +4,209 @@
 @license: GPL
 
 """
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+import os
 import threading
 import time
 
+import config
 
-class Dispatcher(threading.Thread):
+
+log = logging.getLogger('pic.dispatcher')
+
+# poison pill: a worker terminates when it gets this from its input queue
+STOP = None
+
+# weight of the latest job in the moving averages of service & CPU time
+SMOOTHING = 0.2
+
+# stages whose workers spend more than this fraction of the service time on
+# the CPU are CPU-bound (more threads than CPUs don't help them)
+CPU_BOUND = 0.5
+
+# clock_gettime's ID of the calling thread's CPU time clock (Linux)
+_CLOCK_THREAD_CPUTIME_ID = 3
+
+
+class Dispatcher(object):
     """
-    The dispatcher thread activates and holds the worker threads depending
-    on waiting jobs in the input queue.
+    The dispatcher creates, starts and stops the worker threads of a stage.
+
+    Workers block on the stage's input queue until a job arrives, so idle
+    workers neither poll nor add latency. A worker is stopped by putting a
+    poison pill (STOP) into the input queue: the first idle worker taking it
+    from the queue terminates (see Worker.run).
+
+    The number of workers adapts to the workload: whenever a job is done
+    (see job_done), a worker is added if more jobs are waiting than workers
+    are running, and removed if no jobs are waiting. CPU-bound stages don't
+    grow beyond the number of CPUs or while the CPUs are busy. The number of
+    workers stays within the stage's min_workers & max_workers.
+
+    Constructor arguments:
+        pool (Stage)            :   stage whose workers are dispatched
     """
 
-    # FIXME: dispatcher should maybe also create and start worker threads?
     def __init__(self, pool):
-        threading.Thread.__init__(self)
         self.pool = pool
-        self.workersOnHold = True
-
-    def _activate_workers(self):
-        self.pool.wakeSignal.set()
-#        for worker in self.pool.workers:
-#            worker.hold = False
-        self.workersOnHold = False
-
-    def _hold_workers(self):
-        self.pool.wakeSignal.clear()
-#        for worker in self.pool.workers:
-#            worker.hold = True
-        self.workersOnHold = True
-
-    def _stop_workers(self):
-        # let workers finish the jobs they are working on and wait for them
-        # TODO: this method should probably be called _finish_workers or some-
-        #       thing to make it clear that workers are not directly terminated
-        if self.workersOnHold: self._activate_workers()
-        for worker in self.pool.workers:
-            worker.join()
-
-    def run(self):
-        # hold all workers (shouldn't be necessary if workers were just created)
-        self._hold_workers()
-        while self.pool.isactive:
-            if self.pool.input.qsize == 0:
-                # No work in input queues. Hold workers
-                if not self.workersOnHold: self._hold_workers()
+        self.workers = []
+        self._stopping = 0      # number of poison pills not taken yet
+        self._stopped = threading.Condition()
+        self._next_number = 0
+        # statistics of done jobs
+        self.jobs_done = 0
+        self.service_time = None    # moving average (seconds)
+        self.cpu_ratio = None       # moving average of CPU / service time
+        self._scaling = False       # no scaling once all workers are stopped
+        self._last_scaled = 0
+
+    def start_workers(self, num):
+        """Create & start num workers."""
+        with self._stopped:
+            for i in range(num):
+                worker = self.pool.create_worker(self._next_number)
+                self._next_number += 1
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            self._scaling = True
+        log.debug("%s: started %i workers", self.pool.name, num)
+
+    def stop_workers(self, num=None):
+        """
+        Tell num (default: all) workers to stop once the jobs queued before
+        are taken. Doesn't block, see join.
+        """
+        with self._stopped:
+            running = len(self.workers) - self._stopping
+            if num is None:
+                num = running
+                self._scaling = False
+            num = min(num, running)
+            self._stopping += num
+        for i in range(num):
+            put_unbounded(self.pool.input, STOP)
+        log.debug("%s: stopping %i workers", self.pool.name, num)
+
+    def worker_stopped(self, worker):
+        """Called by a worker that took a poison pill before it terminates."""
+        with self._stopped:
+            self.workers.remove(worker)
+            self._stopping -= 1
+            self._stopped.notify_all()
+
+    def job_done(self, service_time, cpu_time=None):
+        """
+        Record statistics of a job & adapt number of workers to the workload.
+        Called by workers after every job.
+
+        Arguments:
+        service_time -- seconds the worker spent on the job
+        cpu_time     -- seconds of CPU time spent on the job (if known)
+        """
+        with self._stopped:
+            self.jobs_done += 1
+            self.service_time = _average(self.service_time, service_time)
+            if cpu_time is not None and service_time > 0:
+                self.cpu_ratio = _average(self.cpu_ratio,
+                                          min(cpu_time / service_time, 1.0))
+            # give the last change time to take effect
+            now = time.time()
+            if not self._scaling or now - self._last_scaled < self.service_time:
+                return
+            running = len(self.workers) - self._stopping
+            backlog = self.pool.input.qsize() - self._stopping
+            if backlog > running and running < self.pool.max_workers \
+                    and not self._cpu_saturated(running):
+                log.debug("%s: adding worker (%i running, %i waiting jobs)",
+                          self.pool.name, running, backlog)
+                self.pool.add_worker()
+            elif backlog <= 0 and running > self.pool.min_workers:
+                log.debug("%s: removing worker (%i running, no waiting jobs)",
+                          self.pool.name, running)
+                self.pool.remove_worker()
             else:
-                if self.workersOnHold: self._activate_workers()
-                else: self.pool.progress = self.pool.output.qsize()
-            # only run once a second
-            time.sleep(1)
-        else:
-            self._stop_workers()
+                return
+            self._last_scaled = now
+
+    def _cpu_saturated(self, running):
+        """Return True if a CPU-bound stage shouldn't get more workers."""
+        if self.cpu_ratio is None or self.cpu_ratio < CPU_BOUND:
+            return False
+        cpus = multiprocessing.cpu_count()
+        return running >= cpus or os.getloadavg()[0] >= cpus
+
+    def join(self, timeout=None):
+        """
+        Block until all workers told to stop have terminated (or timeout
+        seconds passed). Return True if they have terminated.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._stopped:
+            return wait_interruptibly(self._stopped.wait,
+                                      lambda: not self._stopping, deadline)
+
+
+def put_unbounded(queue, item):
+    """
+    Put item into queue without blocking, even if the (bounded) queue is full.
+    Used for poison pills & requeued jobs, which mustn't wait for the stage's
+    workers (possibly the caller itself) to make room in the queue.
+    """
+    with queue.mutex:
+        queue._put(item)
+        queue.unfinished_tasks += 1
+        queue.not_empty.notify()
+
+def wait_interruptibly(wait, done, deadline=None):
+    """
+    Call wait(timeout) (e.g. Condition.wait or Thread.join) until done()
+    returns True or wait returns True. Return False if the deadline (a
+    time.time() value, None: no deadline) passed before.
+
+    Blocking waits without a timeout can't be interrupted by signals, so wait
+    is called with timeouts of at most config.POLL_INTERVAL seconds to let
+    signal handlers run meanwhile.
+    """
+    while not done():
+        timeout = config.POLL_INTERVAL
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.time())
+            if timeout <= 0:
+                return False
+        if wait(timeout):
+            return True
+    return True
+
+def _average(average, value):
+    """Return exponential moving average updated with value."""
+    if average is None:
+        return value
+    return SMOOTHING * value + (1 - SMOOTHING) * average
+
+def _load_thread_time():
+    """Return function returning the calling thread's CPU time (or None)."""
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('c'),
+                                    use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        return lambda: None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def thread_time():
+        ts = timespec()
+        if clock_gettime(_CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts)) != 0:
+            return None
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return thread_time
+
+# CPU time of the calling thread in seconds (None if unknown)
+thread_time = _load_thread_time()
 
 
 # Unit test       
@@ -63,4 +216,3 @@ def _test():
 
 if __name__ == "__main__":
     _test()
-
@@ -0,0 +1,376 @@
+"""
+@author: Matthias Grueter <matthias@grueter.name>
+@copyright: Copyright (c) 2012 Matthias Grueter
+@license: GPL
+
+"""
+import errno
+import fcntl
+import logging
+import os
+import select
+import subprocess
+import threading
+import time
+import Queue
+
+import config
+
+from dispatcher import STOP, thread_time, wait_interruptibly
+
+
+log = logging.getLogger('pic.eventloop')
+
+# number of bytes read at once from the output of external programs
+READ_SIZE = 4096
+
+
+class EventLoop(object):
+    """
+    An event loop runs the external programs of the jobs of subprocess stages
+    (see SubprocessWorker) in a single thread, so many programs can be in
+    flight without a thread waiting for each of them.
+
+    The loop takes jobs from the stages' input queues while fewer than
+    max_jobs jobs are in progress, starts their programs & waits for their
+    output (select on the programs' pipes). A job's commands are run one
+    after the other, as by SubprocessWorker._work. Every stage has one worker
+    (not started) finishing its jobs (see Worker._finish).
+
+    The loop never blocks: pictures handed on by the workers wait in a list
+    of pending hand-offs until there's room in the next stage's buffer (see
+    _Outlet). Jobs in progress & pending hand-offs together are limited to
+    max_jobs.
+
+    Constructor arguments:
+        stages (list of Stage)  :   subprocess stages of the pipeline
+        max_jobs (int)          :   maximum number of jobs in progress
+        cancelled (Event)       :   set once the pipeline is cancelled
+        waker (Waker)           :   released for every job put into the
+                                    stages' input queues (see
+                                    SignallingQueue)
+    """
+
+    def __init__(self, stages, max_jobs, cancelled, waker):
+        self.stages = stages
+        self.max_jobs = max_jobs
+        self.cancelled = cancelled
+        self.waker = waker
+        self.workers = [stage.create_worker(0) for stage in stages]
+        for (stage, worker) in zip(stages, self.workers):
+            worker.inqueue = worker.outqueue = _Outlet(self, stage)
+        self.jobs = []      # jobs in progress
+        # (targets, job, stage) tuples of the pictures waiting to be put into
+        # targets (buffers or joins, see Pipeline) by the loop
+        self.pending = []
+        self.thread = None
+        self._stopping = False
+
+    def start(self):
+        """Start the loop's thread. It waits until jobs arrive."""
+        self._stopping = False
+        self.waker.open()
+        self.thread = threading.Thread(target=self._run, name='EventLoop')
+        self.thread.daemon = True
+        self.thread.start()
+        log.debug("started event loop running at most %i jobs",
+                  self.max_jobs)
+
+    def stop(self, timeout=None):
+        """
+        Stop loop once the jobs in progress are done. Blocks until it
+        terminated (or timeout seconds passed).
+        """
+        if self.thread is None:
+            return
+        self._stopping = True
+        self.waker.release()
+        deadline = None if timeout is None else time.time() + timeout
+        if wait_interruptibly(self.thread.join,
+                              lambda: not self.thread.is_alive(), deadline):
+            self.thread = None
+
+    def cancel(self):
+        """Kill the programs of the jobs in progress."""
+        self.cancelled.set()
+        self.waker.release()
+
+    def _run(self):
+        # pending hand-offs are kept if the loop is stopped (see Stage.stop)
+        try:
+            while not (self._stopping and not self.jobs):
+                if self.cancelled.is_set():
+                    for job in self.jobs:
+                        job.kill()
+                    self._drop_pending()
+                elif not self._stopping:
+                    self._take_jobs()
+                self._hand_on()
+                self._poll()
+        finally:
+            self.waker.close()
+
+    def _take_jobs(self):
+        """Start jobs waiting in the stages' queues (downstream first)."""
+        for i in reversed(range(len(self.stages))):
+            while len(self.jobs) + len(self.pending) < self.max_jobs:
+                try:
+                    item = self.stages[i].input.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is STOP:    # not meant for the event loop
+                    self.stages[i].input.task_done()
+                    continue
+                (picture, jobnr) = item
+                worker = self.workers[i]
+                if worker._skip(picture, jobnr):
+                    continue
+                job = _Job(worker, picture, jobnr)
+                if job.next_command():
+                    self.jobs.append(job)
+                else:
+                    self._finish(job)
+
+    def _finish(self, job):
+        """
+        Finish job (see _Job.finish). If that raises an exception, the job
+        failed: it's put into the dead letters with the exception.
+        """
+        try:
+            job.finish()
+        except Exception, e:
+            worker = job.worker
+            worker.logger.exception("%s, finishing job %i raised an "
+                                    "exception", worker.name, job.jobnr)
+            if worker.pool.dead_letters is not None:
+                worker.pool.dead_letters.put((job.picture, job.jobnr,
+                                              worker.name, e))
+            worker.inqueue.task_done()
+
+    def _hand_on(self):
+        """
+        Put pending pictures into their targets where there's room. A job is
+        marked done in the stage's input queue once it reached all targets.
+        """
+        for entry in list(self.pending):
+            (targets, job, stage) = entry
+            while targets:
+                try:
+                    targets[0].put(job, False)
+                except Queue.Full:
+                    break
+                targets.pop(0)
+            if not targets:
+                self.pending.remove(entry)
+                stage.input.task_done()
+
+    def _drop_pending(self):
+        """Drop pending hand-offs (once the pipeline is cancelled)."""
+        for (targets, job, stage) in self.pending:
+            stage._release_buffer(job[0])
+            stage.input.task_done()
+        del self.pending[:]
+
+    def _poll(self):
+        """
+        Wait for output of the jobs' programs (at most POLL_INTERVAL seconds)
+        and handle it. Jobs whose programs are done are finished.
+        """
+        readers = dict((job.fd, job) for job in self.jobs
+                       if job.fd is not None)
+        try:
+            (readable, _, _) = select.select(readers.keys() + [self.waker.fd],
+                                             [], [], config.POLL_INTERVAL)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        for fd in readable:
+            if fd == self.waker.fd:
+                self.waker.drain()
+            else:
+                readers[fd].read()
+        for job in list(self.jobs):
+            if job.fd is None and job.exited() and not job.next_command():
+                self.jobs.remove(job)
+                self._finish(job)
+
+
+class _Outlet(object):
+    """
+    Input & output queue of a worker of an EventLoop (see Worker._finish).
+    Pictures put are added to the loop's pending hand-offs instead of being
+    put into the stage's output, which might block. The job is marked done
+    in the stage's input queue once the loop handed it on.
+    """
+
+    def __init__(self, loop, stage):
+        self.loop = loop
+        self.stage = stage
+        self._deferred = False  # task_done deferred until handed on
+
+    def put(self, job):
+        # a fork is handed on to each of its joins on its own (see Pipeline)
+        targets = getattr(self.stage.output, 'joins', [self.stage.output])
+        self.loop.pending.append((list(targets), job, self.stage))
+        self._deferred = True
+
+    def task_done(self):
+        if self._deferred:
+            self._deferred = False
+        else:
+            self.stage.input.task_done()
+
+
+class _Job(object):
+    """A job of a SubprocessWorker in progress in an EventLoop."""
+
+    def __init__(self, worker, picture, jobnr):
+        self.worker = worker
+        self.picture = picture
+        self.jobnr = jobnr
+        self.command = None
+        self.process = None
+        self.fd = None      # of the program's output, None once closed
+        self.success = True
+        self.error = None
+        try:
+            self.commands = list(worker._compile_commands(picture))
+        except Exception, e:
+            worker.logger.exception("%s, job %i raised an exception",
+                                    worker.name, jobnr)
+            (self.commands, self.success, self.error) = ([], False, e)
+        self._partial = ''  # output line read partially
+        worker.logger.info("%s starting job %i", worker.name, jobnr)
+        self.start, self.cpu_start = time.time(), thread_time()
+
+    def next_command(self):
+        """
+        Start the job's next command. Returns False if there's none left or
+        the job failed.
+        """
+        if not self.success or not self.commands:
+            return False
+        if self.worker.pool.cancelled.is_set():
+            self.success = False
+            return False
+        self.command = self.commands.pop(0)
+        try:
+            self.process = subprocess.Popen(self.command,
+                                            shell=False, cwd=self.worker.path,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT,
+                                            # don't leak other jobs' pipes
+                                            close_fds=True)
+        except OSError, e:
+            self.worker.logger.error("%s (%i): '%s' execution failed: %s",
+                                     self.worker.name, self.jobnr,
+                                     self.command, e)
+            self.success = False
+            return False
+        self.fd = self.process.stdout.fileno()
+        return True
+
+    def read(self):
+        """Log the output lines of the program. Called if fd is readable."""
+        data = os.read(self.fd, READ_SIZE)
+        if not data:
+            self.process.stdout.close()
+            self.fd = None
+            # the program is exiting: reap it now, there's no fd left to wake
+            # the loop once it's done
+            self.process.wait()
+            data = '\n' if self._partial else ''
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.worker.logger.info(line.strip())
+
+    def exited(self):
+        """Return True once the program terminated."""
+        retcode = self.process.poll()
+        if retcode is None:
+            return False
+        if retcode < 0:
+            self.worker.logger.error("%s (%i): '%s' terminated with signal %s",
+                                     self.worker.name, self.jobnr,
+                                     self.command, retcode)
+            self.success = False
+        elif retcode > 0:
+            self.worker.logger.error("%s (%i): '%s' failed with exit code %i",
+                                     self.worker.name, self.jobnr,
+                                     self.command, retcode)
+            self.success = False
+        return True
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass    # terminated meanwhile
+
+    def finish(self):
+        """Hand the picture on to the next stage (see Worker._finish)."""
+        self.worker._job_done(self.start, self.cpu_start,
+                              [(self.picture, self.success)])
+        self.worker._finish(self.picture, self.jobnr, self.success,
+                            self.error)
+
+
+class Waker(object):
+    """
+    Pipe waking up a thread waiting in select once release is called (e.g.
+    by a SignallingQueue), without blocking the caller. Releasing a closed
+    waker does nothing.
+    """
+
+    def __init__(self):
+        self.fd = None
+        self._write_fd = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        with self._lock:
+            if self.fd is not None:
+                return
+            (self.fd, self._write_fd) = os.pipe()
+            for fd in (self.fd, self._write_fd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def release(self):
+        with self._lock:
+            if self._write_fd is None:
+                return
+            try:
+                os.write(self._write_fd, 'x')
+            except OSError, e:
+                if e.errno != errno.EAGAIN:     # pipe full: wakes up anyway
+                    raise
+
+    def drain(self):
+        """Empty the pipe. Called by the waiting thread once it woke up."""
+        try:
+            while os.read(self.fd, READ_SIZE):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        with self._lock:
+            if self.fd is None:
+                return
+            os.close(self.fd)
+            os.close(self._write_fd)
+            (self.fd, self._write_fd) = (None, None)
+
+
+# Unit test
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
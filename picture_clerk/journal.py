@@ -0,0 +1,139 @@
+"""
+@author: Matthias Grueter <matthias@grueter.name>
+@copyright: Copyright (c) 2012 Matthias Grueter
+@license: GPL
+
+"""
+import errno
+import json
+import logging
+import os
+import threading
+import time
+
+
+log = logging.getLogger('pic.journal')
+
+# maximum number of seconds between syncing the journal to disk
+SYNC_INTERVAL = 1.0
+
+
+class Journal(object):
+    """
+    A journal is an append-only file recording which pipeline stages are done
+    with which picture, together with the state of the picture (checksums,
+    metadata, sidecars, ...) at that time.
+
+    If processing pictures is interrupted, replaying the journal restores the
+    pictures' state, so only the stages not yet done have to be run again.
+
+    Constructor arguments:
+        path (string)           :   path of the journal file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+        self._synced = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def open(self):
+        """Open journal for appending records."""
+        self._fh = open(self.path, 'a')
+
+    def close(self):
+        if self._fh is not None:
+            self._sync()
+            self._fh.close()
+            self._fh = None
+
+    def clear(self):
+        """Remove journal (e.g. once the processed pictures were saved)."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def record(self, picture, stage):
+        """Record that stage is done with picture. Called by the workers."""
+        # take the state while locked: concurrent stages change the picture
+        # meanwhile, records must be in the order of their states (see replay)
+        with self._lock:
+            try:
+                line = json.dumps(dict(picture=picture.filename, stage=stage,
+                                       state=get_state(picture)))
+            except (TypeError, ValueError), e:
+                # stage will be run again when resuming
+                log.warning("Can't journal %s of %s: %s", stage, picture, e)
+                return
+            self._fh.write(line + '\n')
+            self._fh.flush()
+            if time.time() - self._synced > SYNC_INTERVAL:
+                self._sync()
+
+    def _sync(self):
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._synced = time.time()
+
+    def replay(self):
+        """
+        Return dictionary of (names of stages done, latest state) tuples by
+        picture filename. A partially written last record is ignored.
+        """
+        records = dict()
+        try:
+            fh = open(self.path, 'r')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return records
+            raise
+        with fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    log.warning("Ignoring corrupt journal record: %r", line)
+                    continue
+                (stages, state) = records.get(record['picture'], (set(), None))
+                stages.add(record['stage'])
+                # states are recorded after the stage's changes were applied,
+                # the latest one therefore contains the changes of all stages
+                records[record['picture']] = (stages, record['state'])
+        return records
+
+
+def get_state(picture):
+    """Return the attributes of picture set by workers as JSON-able dict."""
+    # copies, concurrent stages may change the picture meanwhile
+    return dict(checksums=dict(picture.checksums),
+                stat=picture.stat,
+                verified=picture.verified,
+                metadata=dict(picture.metadata),
+                sidecars=[(sidecar.path, sidecar.content_type)
+                          for sidecar in list(picture.list_sidecars())],
+                history=list(picture.history),
+                stages=dict(picture.stages))
+
+
+def set_state(picture, state):
+    """Restore the attributes of picture from a state (see get_state)."""
+    picture.checksums.update(state['checksums'])
+    picture.stat = tuple(state['stat']) if state['stat'] else None
+    picture.verified = state['verified']
+    picture.metadata.update(state['metadata'])
+    known = set(picture.get_sidecar_filenames())
+    for (path, content_type) in state['sidecars']:
+        if path not in known:
+            picture.add_sidecar(path, content_type)
+    picture.history = [tuple(entry) for entry in state['history']]
+    picture.stages.update(state['stages'])
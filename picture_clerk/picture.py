@@ -6,6 +6,13 @@
 """
 import hashlib
 import os.path
+import zlib
+
+import config
+
+
+# supported checksum algorithms ordered from cheapest to strongest
+ALGORITHMS = ('adler32', 'crc32', 'md5', 'sha1', 'sha256', 'sha512')
 
 
 class PictureFileType():
@@ -36,15 +43,61 @@ class Picture(object):
         (self.basename, self.extension) = os.path.splitext(self.filename)
         # FIXME: extract file type from given filename
         self.filetype = PictureFileType.RAW
-        # checksum
-        # TODO: type of checksum (CRC32, MD5, SHA1, SHA256, etc.) should also be saved
-        self.checksum = None
+        # checksums tagged by algorithm (e.g. {'sha1': '...', 'crc32': '...'})
+        self.checksums = dict()
+        # file status (see get_stat_key) at the time checksums were verified
+        self.stat = None
+        # time of last successful verification (seconds since epoch)
+        self.verified = None
         # sidecar files
         self._sidecars = set([])
         # metadata
         self.metadata = dict()
         # history
         self.history = []
+        # inputs & outputs of the workers' last jobs by worker name (see
+        # worker.is_current)
+        self.stages = dict()
+        # content & file status of the picture file read once by LoadWorker
+        # for the following stages of a pipeline (not pickled)
+        self.buffer = None
+        self.buffer_stat = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('buffer', None)
+        state.pop('buffer_stat', None)
+        return state
+
+    def __setstate__(self, state):
+        # indexes written before checksums were tagged by their algorithm
+        # store a bare SHA1 digest in the 'checksum' attribute
+        if 'checksums' not in state:
+            checksum = state.pop('checksum', None)
+            state['checksums'] = {'sha1': checksum} if checksum else dict()
+        state.setdefault('stat', None)
+        state.setdefault('verified', None)
+        state.setdefault('stages', dict())
+        state.setdefault('buffer', None)
+        state.setdefault('buffer_stat', None)
+        self.__dict__.update(state)
+
+    def release_buffer(self):
+        """Release the content of the picture file loaded by LoadWorker."""
+        self.buffer = None
+        self.buffer_stat = None
+
+    @property
+    def checksum(self):
+        """SHA1 checksum of the picture file (or None if unknown)."""
+        return self.checksums.get('sha1')
+
+    @checksum.setter
+    def checksum(self, value):
+        if value is None:
+            self.checksums.pop('sha1', None)
+        else:
+            self.checksums['sha1'] = value
 
     def _str_sidecars(self):
         rtn = str()
@@ -150,5 +203,133 @@ class Sidecar(object):
 #    def __init__(self, path):
 #        Sidecar.__init__(self, path, content_type="Thumbnail") 
 
-def get_sha1(buf):
-    return hashlib.sha1(buf).hexdigest()
+def get_stat_key(st):
+    """Return (size, mtime in ns, inode, device) tuple of a file status.
+
+    Fields unknown to the file status object (e.g. inode of remote files) are
+    set to None.
+
+    Arguments:
+    st -- file status as returned by os.stat or Connector.stat
+
+    """
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10 ** 9)
+    return (st.st_size, mtime_ns,
+            getattr(st, 'st_ino', None), getattr(st, 'st_dev', None))
+
+def iter_chunks(fh, chunk_size=config.CHUNK_SIZE):
+    """Yield the content of a readable file object in chunks.
+
+    File objects supporting readinto() are read into a single preallocated
+    buffer which is reused for every chunk, so memory usage is bounded by
+    chunk_size regardless of the file size. A yielded chunk is therefore only
+    valid until the next one is requested.
+
+    Arguments:
+    fh         -- readable file object (opened in binary mode)
+    chunk_size -- maximum number of bytes per chunk
+
+    """
+    readinto = getattr(fh, 'readinto', None)
+    if readinto is None:    # e.g. StringIO
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        buf = bytearray(chunk_size)
+        while True:
+            num_bytes = readinto(buf)
+            if not num_bytes:
+                break
+            yield buffer(buf, 0, num_bytes)
+
+class _ZlibChecksum(object):
+    """hashlib-like wrapper around zlib's running checksums (crc32, adler32)."""
+
+    def __init__(self, func):
+        self._func = func
+        self._value = func('')
+
+    def update(self, buf):
+        self._value = self._func(buf, self._value)
+
+    def hexdigest(self):
+        return '%08x' % (self._value & 0xffffffff)
+
+
+def new_digest(algorithm):
+    """Return a new hashlib-like digest object for the supplied algorithm.
+
+    Raises:
+    ValueError if the algorithm is not listed in ALGORITHMS
+
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError("unsupported checksum algorithm: %s" % algorithm)
+    if algorithm == 'crc32':
+        return _ZlibChecksum(zlib.crc32)
+    elif algorithm == 'adler32':
+        return _ZlibChecksum(zlib.adler32)
+    else:
+        return hashlib.new(algorithm)
+
+def parse_algorithms(string):
+    """Return list of algorithms from a comma separated string."""
+    return [a.strip().lower() for a in string.split(',') if a.strip()]
+
+def cheapest_algorithm(algorithms):
+    """Return the cheapest of the supplied algorithms (or None)."""
+    known = [a for a in ALGORITHMS if a in algorithms]
+    return known[0] if known else None
+
+def strongest_algorithm(algorithms):
+    """Return the strongest of the supplied algorithms (or None)."""
+    known = [a for a in ALGORITHMS if a in algorithms]
+    return known[-1] if known else None
+
+
+class MultiDigest(object):
+    """
+    MultiDigest calculates several checksums of the same data in one pass.
+
+    Constructor arguments:
+        algorithms (list)       :   names of the algorithms (see ALGORITHMS)
+    """
+    def __init__(self, algorithms):
+        self._digests = dict((a, new_digest(a)) for a in set(algorithms))
+
+    def update(self, buf):
+        for digest in self._digests.itervalues():
+            digest.update(buf)
+
+    def hexdigests(self):
+        """Return dictionary of hex digests tagged by algorithm."""
+        return dict((a, digest.hexdigest())
+                    for a, digest in self._digests.iteritems())
+
+
+def get_digests(src, algorithms, chunk_size=config.CHUNK_SIZE):
+    """Return checksums of a string or readable file object for all algorithms.
+
+    The data is read only once regardless of the number of algorithms. File
+    objects are hashed chunk by chunk (see iter_chunks).
+
+    Returns:
+    Dictionary of hex digests tagged by algorithm.
+
+    """
+    digest = MultiDigest(algorithms)
+    if hasattr(src, 'read'):
+        for chunk in iter_chunks(src, chunk_size):
+            digest.update(chunk)
+    else:
+        digest.update(src)
+    return digest.hexdigests()
+
+def get_sha1(src, chunk_size=config.CHUNK_SIZE):
+    """Return SHA1 hex digest of a string or of a readable file object."""
+    return get_digests(src, ['sha1'], chunk_size)['sha1']
@@ -5,9 +5,26 @@
 
 """
 import config
+import logging
+import multiprocessing
+import threading
+import time
 import Queue
 
-from stage import Stage
+from dispatcher import wait_interruptibly
+from eventloop import EventLoop, Waker
+from sharedpool import SharedPool, SignallingQueue
+from stage import Stage, ProcessStage
+from stats import InstrumentedQueue
+
+
+log = logging.getLogger('pic.pipeline')
+
+# stage class running the workers of a recipe's executor (see recipe.EXECUTORS)
+STAGE_TYPES = dict(thread=Stage, process=ProcessStage)
+
+# engines running the jobs of the stages (see 'pipeline.engine')
+ENGINES = ('stages', 'shared', 'events')
 
 
 #class PipelineState():
@@ -20,50 +37,205 @@ from stage import Stage
 
 
 
-# TODO: unit tests
-# TODO: implement some sort of dispatcher to dynamically create or kill threads
-#       in each stage to optimize performance (e.g. workers are only started if
-#       something is in its input queue, number of workers is adapted according
-#       to workload and worker performance.)
 class Pipeline():
     """
     Pipeline defines the stages of the workflow.
+
+    Constructor arguments:
+        name (string)           :   name of the pipeline
+        recipe (Recipe)         :   sequence of jobs to be performed
+        path (string)           :   path in which the workers base their work
+        conf (Config or dict)   :   repository configuration passed on to the
+                                    workers (optional)
+        journal (Journal)       :   journal recording the jobs done by the
+                                    workers (optional)
+
+    Each stage starts with config.STAGE_SIZE workers. Their number is then
+    adapted to the stage's workload by its dispatcher within the bounds set
+    by 'pipeline.min_workers' and 'pipeline.max_workers'. Stages whose
+    executor is 'process' run their jobs in a pool of worker processes (see
+    ProcessStage).
+
+    Stages are connected according to the recipe's dependencies. Stages not
+    depending on each other work on a picture concurrently, so a picture's
+    latency is the one of the critical path of the recipe instead of the sum
+    of all stages. A picture leaves the pipeline once all stages are done
+    with it.
+
+    The buffer in front of each stage holds at most 'pipeline.buffer_size'
+    jobs (an int for all stages or a comma separated list with one size per
+    stage), so a fast stage blocks instead of outrunning a slow one. Loaded
+    picture files (see LoadWorker) and their copies sent to worker processes
+    (see ProcessWorker) are limited to 'pipeline.memory_budget' bytes by a
+    MemoryGovernor. The output buffer is unbounded.
+
+    If 'pipeline.engine' is 'shared', the stages have no workers of their
+    own: a SharedPool of 'pipeline.pool_size' workers does the jobs of all
+    stages, preferring jobs of stages further downstream. If it's 'events',
+    the jobs of subprocess stages (see SubprocessWorker.evented) are run by
+    an EventLoop instead, keeping up to 'pipeline.max_subprocesses' external
+    programs in flight with a single thread.
+
+    Jobs failing with transient I/O errors are retried (see Worker._attempt).
+    Jobs failing for good are collected (see get_failures) and don't reach
+    the following stages.
+
+    If a journal is given, the workers record every job done in it, so an
+    interrupted run can be resumed by putting the pictures again together
+    with the names of the stages already done with them.
     """
 
-    def __init__(self, name, recipe, path):
+    def __init__(self, name, recipe, path, conf=None, journal=None):
         self.name = name
         # recipe defining the sequence of jobs to be performed
         self.recipe = recipe
         self.num_stages = self.recipe.num_stages
-        self.num_stageworkers = config.STAGE_SIZE
+        conf = conf if conf is not None else dict()
+        min_workers = conf.get('pipeline.min_workers', config.STAGE_MIN_WORKERS)
+        max_workers = conf.get('pipeline.max_workers', config.STAGE_MAX_WORKERS)
+        self.num_stageworkers = min(max(config.STAGE_SIZE, min_workers),
+                                    max_workers)
         # Create buffers before and after each stage (hand-off points)
-        self.buffers = [Queue.Queue() for i in range(self.num_stages + 1)]
-        # The input buffer of the pipeline.
-        self.input = self.buffers[0]
+        sizes = _parse_buffer_sizes(conf.get('pipeline.buffer_size',
+                                             config.PIPELINE_BUFFER_SIZE),
+                                    self.num_stages)
+        # engine running the stages' jobs (see SharedPool & EventLoop)
+        self.engine = conf.get('pipeline.engine', config.PIPELINE_ENGINE)
+        if self.engine not in ENGINES:
+            raise ValueError("unknown pipeline engine: %s" % self.engine)
+        # stages whose jobs are run by the event loop
+        evented = [i for i in range(self.num_stages)
+                   if self.engine == 'events'
+                   and self.recipe.stage_executors[i] == 'thread'
+                   and self.recipe.stage_types[i].evented]
+        if self.engine != 'stages':
+            available = threading.Semaphore(0)
+            waker = Waker()
+            self.buffers = [SignallingQueue(size, waker if i in evented
+                                                  else available)
+                            for i, size in enumerate(sizes)] + \
+                           [InstrumentedQueue()]
+        else:
+            self.buffers = [InstrumentedQueue(size) for size in sizes] + \
+                           [InstrumentedQueue()]
+        self.governor = MemoryGovernor(conf.get('pipeline.memory_budget',
+                                                config.PIPELINE_MEMORY_BUDGET))
         # The output buffer of the pipeline
         self.output = self.buffers[-1]
+        # (picture, jobnr, stage name, exception) tuples of failed jobs
+        self.dead_letters = _DeadLetters(self.governor)
+        # Connect stages according to their dependencies: a stage's output
+        # is handed to all stages depending on it (fork), a stage gets a job
+        # once all stages it depends on are done with it (join)
+        dependencies = self.recipe.stage_dependencies
+        joins = [_Join(self.buffers[i], max(len(dependencies[i]), 1),
+                       failed=self.dead_letters)
+                 for i in range(self.num_stages)]
+        successors = [[joins[j] for j in range(self.num_stages)
+                       if i in dependencies[j]]
+                      for i in range(self.num_stages)]
+        # pictures leave the pipeline once all final stages are done with them
+        sink = _Join(self.output, successors.count([]), self.governor,
+                     self.dead_letters)
+        self.dead_letters.joins = joins + [sink]
+        outputs = [_fork(targets or [sink]) for targets in successors]
+        # The input of the pipeline (stages not depending on other stages)
+        self.input = _fork([joins[i] for i in range(self.num_stages)
+                            if not dependencies[i]])
+        self._inputs = [self.buffers[i] for i in range(self.num_stages)
+                        if not dependencies[i]]
+        # set once the pipeline is cancelled (see cancel & abort)
+        self.cancelled = threading.Event()
         # Stage environment variables
-        self.stage_environ = dict(pipeline=self, path=path)
+        self.stage_environ = dict(pipeline=self, path=path, conf=conf,
+                                  governor=self.governor, journal=journal,
+                                  dead_letters=self.dead_letters,
+                                  cancelled=self.cancelled)
         # Create stages and connect them to the buffers
-        self.stages = [Stage(name=self.recipe.stage_names[i],
+        self.stages = [STAGE_TYPES[self.recipe.stage_executors[i]](
+                             name=self.recipe.stage_names[i],
                              WorkerClass=self.recipe.stage_types[i],
                              num_workers=self.num_stageworkers,
                              in_buffer=self.buffers[i],
-                             out_buffer=self.buffers[i + 1],
+                             out_buffer=outputs[i],
                              seq_number=i,
+                             min_workers=min_workers,
+                             max_workers=max_workers,
                              **self.stage_environ) for i in range(self.num_stages)]
+        self.pool = None
+        self.loop = None
+        # worker processes of the process stages (see _start_processes)
+        self.processes = None
+        if self.engine != 'stages':
+            self.pool = SharedPool([self.stages[i]
+                                    for i in range(self.num_stages)
+                                    if i not in evented],
+                                   conf.get('pipeline.pool_size',
+                                            config.PIPELINE_POOL_SIZE),
+                                   available)
+        if evented:
+            self.loop = EventLoop([self.stages[i] for i in evented],
+                                  conf.get('pipeline.max_subprocesses',
+                                           config.PIPELINE_MAX_SUBPROCESSES),
+                                  self.cancelled, waker)
         # jobnr is a simple counter of jobs that have been or still are processed
         self.jobnr = 0
+        # names of the stages already done with a job by jobnr (see put)
+        self._done = dict()
+        self.started = None
         # Set state to inactive
         # FIXME: isactive should be a descriptor and depend on stage's status
         self.isactive = False
 
 
-    def put(self, picture):
-        """Put a Job object into the pipeline"""
+    def put(self, picture, done=()):
+        """
+        Put a Job object into the pipeline. Blocks while the input buffer is
+        full, so the pipeline should be started before.
+
+        Stages whose worker's name is in done (e.g. replayed from a journal)
+        hand the picture on without working on it.
+
+        Pictures put after the pipeline was cancelled are dropped.
+        """
         # FIXME: make access to self.jobnr thread-safe (locking)
         self.jobnr += 1
-        self.input.put((picture, self.jobnr))
+        if done:
+            self._done[self.jobnr] = frozenset(done)
+        job = (picture, self.jobnr)
+        for queue in self._inputs:
+            wait_interruptibly(lambda timeout: _try_put(queue, job, timeout),
+                               self.cancelled.is_set)
+
+    def is_done(self, jobnr, stage_name):
+        """Return True if stage_name was done with job jobnr before."""
+        return stage_name in self._done.get(jobnr, ())
+
+    def get_failures(self):
+        """
+        Return (picture, jobnr, stage name, exception) tuples of the jobs
+        that failed so far. The exception is None if the worker reported the
+        failure without raising one.
+        """
+        with self.dead_letters.mutex:
+            return list(self.dead_letters.queue)
+
+    def get_stats(self):
+        """
+        Return dictionary of statistics of the pipeline & its stages (see
+        StageStats).
+        """
+        stages = []
+        for stage, executor in zip(self.stages, self.recipe.stage_executors):
+            stats = stage.stats.todict()
+            stats['name'] = getattr(stage.name, 'name', str(stage.name))
+            stats['executor'] = executor
+            stats['workers'] = len(stage.workers)
+            stages.append(stats)
+        return dict(name=self.name,
+                    jobs=self.jobnr,
+                    elapsed=time.time() - self.started if self.started else 0,
+                    stages=stages)
 
     def get_progress(self):
         """Returns a list of the number of jobs in each queue"""
@@ -72,35 +244,108 @@ class Pipeline():
     def start(self):
         """Start all workers"""
         self.isactive = True
-        [s.start() for s in self.stages]
+        self.started = self.started or time.time()
+        # fork the worker processes before any thread is started: a process
+        # forked while other threads run may inherit locks held by them
+        self._start_processes()
+        [s.start(workers=self.pool is None) for s in self.stages]
+        if self.pool is not None:
+            self.pool.start()
+        if self.loop is not None:
+            self.loop.start()
+
+    def _start_processes(self):
+        """
+        Start one pool of worker processes shared by all process stages, so
+        there's at most one process per CPU (see ProcessStage).
+        """
+        stages = [s for s in self.stages if isinstance(s, ProcessStage)]
+        if stages and self.processes is None:
+            self.processes = multiprocessing.Pool(max(s.max_workers
+                                                      for s in stages))
+        for s in stages:
+            s.start_processes(self.processes)
+
+    def _stop_processes(self, terminate=False):
+        """Stop the worker processes (kill their jobs if terminate is set)."""
+        if self.processes is None:
+            return
+        if terminate:
+            self.processes.terminate()
+        else:
+            self.processes.close()
+        self.processes.join()
+        self.processes = None
 
     def flush(self):
-        """Flushes all queues"""
-        # TODO: How to flush queues?
-        raise(NotImplementedError('Queue flushing'))
+        """
+        Flushes all queues: jobs waiting for a stage are dropped (the output
+        buffer is kept). Returns number of dropped jobs.
+        """
+        return sum(s.flush() for s in self.stages)
 
     def stop(self):
         """
         Stops all workers.
         Blocks until all workers have completed their current job.
         """
+        if self.pool is not None:
+            self.pool.stop()
+        if self.loop is not None:
+            self.loop.stop()
         [s.stop() for s in self.stages]
+        self._stop_processes()
         self.isactive = False
 
-    def abort(self):
-        """Immediately terminate all worker threads and flush queues"""
-        # FIXME: Is it possible to kill threads?
-#        raise(NotImplementedError('Aborting pipline'))
-        print('Aborting is not implemented yet. Stopping instead and flushing queues.')
-        self.stop()
-        self.flush()
+    def cancel(self):
+        """
+        Tell the pipeline to abort. Workers drop the jobs they get from now
+        on & join returns (aborting the pipeline). Safe to call from signal
+        handlers, unlike abort.
+        """
+        self.cancelled.set()
+
+    def abort(self, timeout=config.PIPELINE_ABORT_TIMEOUT):
+        """
+        Immediately terminate all workers and flush queues: external
+        programs & worker processes running jobs are killed. Threads can't
+        be killed, abort waits at most timeout seconds for the jobs they're
+        working on. Results of the jobs done are kept.
+        """
+        self.cancelled.set()
+        # flush all stages first, so no worker blocks on a full queue
+        [s.cancel() for s in self.stages]
+        if self.pool is not None:
+            self.pool.cancel()
+        if self.loop is not None:
+            self.loop.cancel()
+        deadline = time.time() + timeout
+        if self.pool is not None:
+            self.pool.stop(timeout)
+        if self.loop is not None:
+            self.loop.stop(max(deadline - time.time(), 0))
+        for s in self.stages:
+            s.abort(max(deadline - time.time(), 0))
+        # kill the worker processes' jobs in progress
+        self._stop_processes(terminate=True)
+        self.isactive = False
 
     def join(self):
         """
         Finish all pending jobs.
-        Blocks until all stages' input queues are empty.
+        Blocks until the last job has passed the last stage, then stops all
+        workers. If the pipeline is cancelled meanwhile, it's aborted and the
+        pending jobs are dropped.
         """
         [s.join() for s in self.stages]
+        if self.cancelled.is_set():
+            self.abort()
+        else:
+            if self.pool is not None:
+                self.pool.stop()
+            if self.loop is not None:
+                self.loop.stop()
+            self._stop_processes()
         self.isactive = False
 
     def get_total_progress(self):
@@ -112,6 +357,195 @@ class Pipeline():
         return self.output.qsize()
 
 
+class _Join(object):
+    """
+    Puts a job into a queue once it was put by num_inputs stages.
+
+    If a governor is given, the picture's loaded file content is released
+    before (see MemoryGovernor.release_buffer). Jobs that failed in another
+    stage (see _DeadLetters) are dropped.
+    """
+
+    def __init__(self, queue, num_inputs, governor=None, failed=None):
+        self.queue = queue
+        self.num_inputs = num_inputs
+        self.governor = governor
+        self.failed = failed
+        self._arrived = dict()  # number of inputs done by jobnr
+        self._lock = threading.Lock()
+
+    def put(self, job, block=True):
+        """
+        Count job's arrival. If block isn't set and the queue is full,
+        Queue.Full is raised and the arrival isn't counted.
+        """
+        if self.num_inputs > 1:
+            jobnr = job[1]
+            with self._lock:
+                if self.failed is not None and self.failed.has_failed(jobnr):
+                    self.failed.drop(job)
+                    return
+                arrived = self._arrived.get(jobnr, 0) + 1
+                if arrived < self.num_inputs:
+                    self._arrived[jobnr] = arrived
+                    return
+                if not block:
+                    # put while locked, so the arrival is counted only once
+                    self._put(job, False)
+                    self._arrived.pop(jobnr, None)
+                    return
+                self._arrived.pop(jobnr, None)
+        self._put(job, block)
+
+    def _put(self, job, block):
+        if self.governor is not None:
+            self.governor.release_buffer(job[0])
+        self.queue.put(job, block)
+
+    def discard(self, jobnr):
+        """
+        Forget the arrivals of job jobnr. Returns True if some inputs were
+        done with it.
+        """
+        with self._lock:
+            return self._arrived.pop(jobnr, None) is not None
+
+
+class _DeadLetters(Queue.Queue):
+    """
+    Queue of the (picture, jobnr, stage name, exception) tuples of failed jobs.
+
+    A failed job never reaches the joins following the failed stage, so the
+    other inputs' arrivals counted by the joins (see _Join) are discarded and
+    jobs arriving from other inputs later on are dropped.
+    """
+
+    def __init__(self, governor=None):
+        Queue.Queue.__init__(self)
+        self.governor = governor
+        self.joins = []
+        self._jobnrs = set()    # of the failed jobs
+
+    def put(self, item, block=True, timeout=None):
+        (picture, jobnr) = item[:2]
+        # mark failed first, so no join starts counting arrivals again
+        self._jobnrs.add(jobnr)
+        Queue.Queue.put(self, item, block, timeout)
+        if any([join.discard(jobnr) for join in self.joins]):
+            log.warning("%s didn't reach the end of the pipeline: job %i "
+                        "failed in %s", picture.filename, jobnr, item[2])
+
+    def has_failed(self, jobnr):
+        return jobnr in self._jobnrs
+
+    def drop(self, job):
+        """Drop job arriving at a join after it failed."""
+        log.debug("dropping job %i of %s, it failed before", job[1],
+                  job[0].filename)
+        if self.governor is not None:
+            self.governor.release_buffer(job[0])
+
+
+class _Fork(object):
+    """Puts a job into several joins."""
+
+    def __init__(self, joins):
+        self.joins = joins
+
+    def put(self, job):
+        for join in self.joins:
+            join.put(job)
+
+
+def _fork(joins):
+    """Return object putting jobs into all joins."""
+    if len(joins) == 1:
+        join = joins[0]
+        # linear hand-off: put directly into the next stage's buffer
+        return join.queue if join.num_inputs == 1 and not join.governor \
+            else join
+    return _Fork(joins)
+
+
+class MemoryGovernor(object):
+    """
+    A memory governor limits the number of bytes loaded into memory by all
+    stages of a pipeline at the same time, including the copies held by
+    worker processes.
+
+    Constructor arguments:
+        budget (int)            :   maximum number of bytes in flight (0 or
+                                    None: unlimited)
+
+    A single allocation larger than the budget is granted once nothing else is
+    in flight, so that it doesn't block forever.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.in_flight = 0
+        self._released = threading.Condition()
+
+    def acquire(self, num_bytes, block=True):
+        """
+        Block until num_bytes fit into the budget, then account for them. If
+        block isn't set, returns False at once if they don't fit (True if
+        they were accounted for).
+        """
+        with self._released:
+            while self.budget and self.in_flight and \
+                    self.in_flight + num_bytes > self.budget:
+                if not block:
+                    return False
+                self._released.wait()
+            self.in_flight += num_bytes
+            return True
+
+    def release(self, num_bytes):
+        """Return num_bytes acquired before to the budget."""
+        with self._released:
+            self.in_flight -= num_bytes
+            self._released.notify_all()
+
+    def release_buffer(self, picture):
+        """
+        Release picture's loaded file content (see LoadWorker) & return its
+        size to the budget.
+        """
+        with self._released:
+            stat = picture.buffer_stat
+            picture.release_buffer()
+            if stat is not None:
+                self.in_flight -= stat[0]
+                self._released.notify_all()
+
+
+def _try_put(queue, item, timeout):
+    """Put item into queue, waiting at most timeout seconds for room."""
+    try:
+        queue.put(item, timeout=timeout)
+    except Queue.Full:
+        return False
+    return True
+
+
+def _parse_buffer_sizes(value, num_stages):
+    """
+    Return list of the buffer sizes of num_stages stages from an int or a
+    comma separated string of ints (the last size applies to further stages).
+
+    >>> _parse_buffer_sizes(16, 3)
+    [16, 16, 16]
+    >>> _parse_buffer_sizes('32, 8', 3)
+    [32, 8, 8]
+    """
+    if isinstance(value, basestring):
+        sizes = [int(size) for size in value.split(',') if size.strip()]
+    else:
+        sizes = [int(value)]
+    return (sizes + sizes[-1:] * num_stages)[:num_stages]
+
+
 # Unit test       
 def _test():
     import doctest
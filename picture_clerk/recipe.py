@@ -4,29 +4,78 @@
 @license: GPL
 
 """
+import re
+
 import worker
 
 
+# how a stage runs its workers: in threads of the pic process or in a pool of
+# worker processes (for CPU-bound workers, which threads serialise on the GIL)
+EXECUTORS = ('thread', 'process')
+
+
 class Recipe():
     """
     A recipe defines the workflow a pipeline has to accomodate
+
+    Constructor arguments:
+        instructions (list)     :   worker classes or (worker class, executor)
+                                    tuples, one per stage (see EXECUTORS)
+        dependencies (list)     :   indexes of the stages each stage depends
+                                    on, e.g. [[], [0], [0], [2]] (optional,
+                                    default: every stage depends on the
+                                    stage before it)
+
+    A stage only depends on stages before it in the recipe. A picture is
+    handed to a stage once all stages it depends on are done with it, stages
+    not depending on each other work on the same picture concurrently.
     """
 
-    def __init__(self, instructions):
-        (self.stage_names, self.stage_types) = self._parse_instructions(instructions)
+    def __init__(self, instructions, dependencies=None):
+        (self.stage_names, self.stage_types,
+         self.stage_executors) = self._parse_instructions(instructions)
 #        self.stage_jobs = _parse_instructions(instructions)     
         self.num_stages = len(instructions)
+        if dependencies is None:    # linear recipe
+            dependencies = [[i - 1] if i else []
+                            for i in range(self.num_stages)]
+        if len(dependencies) != self.num_stages:
+            raise ValueError("dependencies of %i stages given for %i stages" %
+                             (len(dependencies), self.num_stages))
+        for (i, deps) in enumerate(dependencies):
+            if any(not 0 <= dep < i for dep in deps):
+                raise ValueError("stage %i can only depend on stages before "
+                                 "it: %s" % (i, deps))
+        self.stage_dependencies = [sorted(set(deps)) for deps in dependencies]
 
 
     def _parse_instructions(self, instructions):
         """Create stage specifications from given instructions."""
         # TODO: How should instructions look like?
-        return (instructions, instructions)
+        types = []
+        executors = []
+        for instruction in instructions:
+            if isinstance(instruction, tuple):
+                (WorkerClass, executor) = instruction
+            else:
+                (WorkerClass, executor) = (instruction, 'thread')
+            if executor not in EXECUTORS:
+                raise ValueError("unknown executor: %s" % executor)
+            types.append(WorkerClass)
+            executors.append(executor)
+        return (types, types, executors)
 
     def __str__(self):
         string = []
         for i, stage in enumerate(self.stage_names):
-            string.append('%i: %s' % (i + 1, stage))
+            deps = self.stage_dependencies[i]
+            if deps == ([i - 1] if i else []):
+                string.append('%i: %s' % (i + 1, stage))
+            else:
+                string.append('%i: %s (after %s)' %
+                              (i + 1, stage,
+                               ', '.join(str(dep + 1) for dep in deps)
+                               or 'start'))
         return '\n'.join(string)
 
     def __repr__(self):
@@ -34,7 +83,36 @@ class Recipe():
 
     @classmethod
     def fromString(cls, list_as_string):
-        return Recipe([eval(s.strip(), worker.__dict__)
-                       for s in list_as_string.split(',')])
+        """
+        Create recipe from a comma separated list of worker class names. A
+        name may be followed by its stage's executor and by the stages it
+        depends on (joined by '+', default: the stage before it), e.g.
+        "LoadWorker, HashDigestWorker after LoadWorker, ThumbWorker:process
+        after LoadWorker, AutorotWorker after ThumbWorker". A dependency
+        refers to the last stage before with that worker name, stages "after
+        start" don't depend on any stage.
+        """
+        instructions = []
+        dependencies = []
+        names = []
+        for (i, s) in enumerate(list_as_string.split(',')):
+            parts = re.split(r'\s+after\s+', s.strip(), 1)
+            (name, _, executor) = parts[0].partition(':')
+            WorkerClass = eval(name.strip(), worker.__dict__)
+            instructions.append((WorkerClass, executor.strip() or 'thread'))
+            if len(parts) == 2:
+                dependencies.append([_find_stage(names, dep.strip())
+                                     for dep in parts[1].split('+')
+                                     if dep.strip() != 'start'])
+            else:
+                dependencies.append([i - 1] if i else [])
+            names.append(WorkerClass.name)
+        return Recipe(instructions, dependencies)
 
 
+def _find_stage(names, name):
+    """Return index of the last stage with worker name."""
+    for i in reversed(range(len(names))):
+        if names[i] == name:
+            return i
+    raise ValueError("unknown stage: %s" % name)
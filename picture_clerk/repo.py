@@ -5,8 +5,10 @@
 
 """
 import copy
+import json
 import logging
 import os
+import multiprocessing.pool
 
 import config
 import index
@@ -20,6 +22,8 @@ PIC_DIR = ".pic"    # PictureClerk repo directory
 CONFIG_FILE = os.path.join(PIC_DIR, "config")
 INDEX_FILE = os.path.join(PIC_DIR, "index")
 INDEX_FORMAT_VERSION = 1
+STATS_FILE = os.path.join(PIC_DIR, "stats.json")  # of last pipeline run
+JOURNAL_FILE = os.path.join(PIC_DIR, "journal")   # of running pipeline
 
 # @todo: remove these deprecated options
 SHA1_SIDECAR_ENABLED = 1
@@ -27,6 +31,10 @@ SHA1_SIDECAR_DIR = os.path.join(PIC_DIR, "sha1")
 THUMB_SIDECAR_DIR = "jpg"
 XMP_SIDECAR_DIR = os.path.join(PIC_DIR, "xmp")
 
+# checksums calculated for new pictures (cheap one for scrubs, strong one for
+# audits and SHA1 for compatibility)
+CHECKSUM_ALGORITHMS = 'crc32, sha1, sha256'
+
 
 def new_repo_config():
     """Return default repo configuration (Config instance)."""
@@ -35,14 +43,45 @@ def new_repo_config():
 
         'index.file': INDEX_FILE,
         'index.format_version': INDEX_FORMAT_VERSION,
+        'index.checkpoint_size': config.INDEX_CHECKPOINT_SIZE,
+        'index.checkpoint_interval': config.INDEX_CHECKPOINT_INTERVAL,
+        'index.checkpoint_max_overhead': config.INDEX_CHECKPOINT_MAX_OVERHEAD,
 
         'recipes.default':
-            'HashDigestWorker, ThumbWorker, AutorotWorker, MetadataWorker',
+            'LoadWorker, '
+            'HashDigestWorker after LoadWorker, '
+            'ThumbWorker:process after LoadWorker, '
+            'AutorotWorker after ThumbWorker, '
+            'MetadataWorker:process after LoadWorker',
+
+        'pipeline.engine': config.PIPELINE_ENGINE,
+        'pipeline.pool_size': config.PIPELINE_POOL_SIZE,
+        'pipeline.max_subprocesses': config.PIPELINE_MAX_SUBPROCESSES,
+        'pipeline.min_workers': config.STAGE_MIN_WORKERS,
+        'pipeline.max_workers': config.STAGE_MAX_WORKERS,
+        'pipeline.buffer_size': config.PIPELINE_BUFFER_SIZE,
+        'pipeline.memory_budget': config.PIPELINE_MEMORY_BUDGET,
+        'pipeline.retries': config.STAGE_RETRIES,
+        'pipeline.retry_delay': config.STAGE_RETRY_DELAY,
+
+        'subprocess.batch_size': config.SUBPROCESS_BATCH_SIZE,
+        'subprocess.batch_wait': config.SUBPROCESS_BATCH_WAIT,
 
         'thumbnails.sidecar_dir': THUMB_SIDECAR_DIR,
 
         'checksums.sidecar_enabled': SHA1_SIDECAR_ENABLED,
         'checksums.sidecar_dir': SHA1_SIDECAR_DIR,
+        'checksums.chunk_size': config.CHUNK_SIZE,
+        'checksums.algorithms': CHECKSUM_ALGORITHMS,
+
+        'clone.mode': 'copy',
+        'clone.jobs': 1,
+
+        'check.jobs': 1,
+        'check.processes': 0,
+        'check.device_jobs': 0,
+        'check.sample': 0.0,
+        'check.cycle_days': 30,
 
         'logging.file': os.path.join(PIC_DIR, "log.txt"),
         'logging.level': logging.DEBUG,
@@ -115,12 +154,36 @@ class Repo(object):
         with self.connector.open(CONFIG_FILE, 'r') as config_fh:
             self.config.read(config_fh)
 
-    def save_index_to_disk(self):
-        """Save picture index to disk."""
+    def save_index_to_disk(self, snapshot=None):
+        """Save picture index (or the supplied snapshot of it) to disk.
+
+        The index is written to a temporary file replacing the index file
+        once complete, so a crash while saving doesn't truncate the index.
+
+        """
         log.info("Saving repository picture index, version %i" % INDEX_FORMAT_VERSION)
+        pic_index = snapshot if snapshot is not None else self.index
         index_filename = self.config['index.file']
-        with self.connector.open(index_filename, 'wb') as index_fh:
-            self.index.write(index_fh)
+        tmp_filename = index_filename + '.tmp'
+        with self.connector.open(tmp_filename, 'wb') as index_fh:
+            pic_index.write(index_fh)
+            if hasattr(index_fh, 'fileno'):     # local file
+                index_fh.flush()
+                os.fsync(index_fh.fileno())
+        self.connector.rename(tmp_filename, index_filename)
+
+    def save_stats_to_disk(self, stats):
+        """Save pipeline statistics (see Pipeline.get_stats) to disk."""
+        log.info("Saving pipeline statistics.")
+        with self.connector.open(STATS_FILE, 'w') as stats_fh:
+            json.dump(stats, stats_fh, indent=2, sort_keys=True)
+
+    def load_stats_from_disk(self):
+        """Load pipeline statistics from disk (None if there are none)."""
+        if not self.connector.exists(STATS_FILE):
+            return None
+        with self.connector.open(STATS_FILE, 'r') as stats_fh:
+            return json.load(stats_fh)
 
     def load_index_from_disk(self, version=INDEX_FORMAT_VERSION):
         """Load picture index from disk."""
@@ -179,11 +242,18 @@ class Repo(object):
         return repo
 
     @classmethod
-    def clone(cls, repo, dest):
+    def clone(cls, repo, dest, verify=False, mode=None, jobs=None):
         """Clone an existing repository to a new location and return it.
         
-        repo -- source repo to be cloned
-        dest -- connector pointing to location of new repo-clone
+        Picture files are checked against their SHA1 checksum while they are
+        copied (see Connector.copy).
+        
+        repo   -- source repo to be cloned
+        dest   -- connector pointing to location of new repo-clone
+        verify -- read back and verify every copied file
+        mode   -- how files are copied between local repositories (see
+                  LocalConnector.copy, default: 'clone.mode')
+        jobs   -- number of files copied concurrently (default: 'clone.jobs')
         
         """
         # clone repo
@@ -192,9 +262,41 @@ class Repo(object):
                                     pi=copy.deepcopy(repo.index))
 
         # clone pictures
-        for picture in repo.index.iterpics():
-            for fname in picture.get_filenames():
-                repo.connector.copy(fname, dest, dest_path=fname,
-                                        create_parents=True)
+        chunk_size = repo.config['checksums.chunk_size']
+        if not mode:
+            mode = repo.config['clone.mode']
+        if not jobs:
+            jobs = repo.config['clone.jobs']
+        files = [(fname, get_checksums(picture, fname))
+                 for picture in repo.index.iterpics()
+                 for fname in picture.get_filenames()]
+
+        # create parent directories upfront so concurrent copies don't race
+        dest.mkdir_many(set(os.path.dirname(fname) for fname, _ in files))
+
+        def copy_file(args):
+            fname, checksums = args
+            repo.connector.copy(fname, dest, dest_path=fname,
+                                checksums=checksums, verify=verify,
+                                chunk_size=chunk_size, mode=mode)
+
+        if jobs > 1:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+            try:
+                for _ in pool.imap_unordered(copy_file, files):
+                    pass
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for args in files:
+                copy_file(args)
 
         return clone
+
+
+def get_checksums(picture, fname):
+    """Return known checksums of a picture's file to be verified on copy."""
+    if fname == picture.filename and picture.checksum:
+        return {'sha1': picture.checksum}
+    return None
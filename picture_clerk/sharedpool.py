@@ -0,0 +1,140 @@
+"""
+@author: Matthias Grueter <matthias@grueter.name>
+@copyright: Copyright (c) 2012 Matthias Grueter
+@license: GPL
+
+"""
+import logging
+import multiprocessing
+import threading
+import time
+import Queue
+
+from dispatcher import STOP, wait_interruptibly
+from stats import InstrumentedQueue
+
+
+log = logging.getLogger('pic.sharedpool')
+
+
+class SharedPool(object):
+    """
+    A shared pool is a fixed number of worker threads doing the jobs of all
+    stages of a pipeline, so no worker idles while any stage has jobs left.
+
+    A thread takes the next job from the stage furthest downstream having
+    one (the stages are in recipe order, downstream stages thus come
+    later): pictures in progress are finished first, which frees their
+    memory & keeps the buffers short. The stages don't start workers of
+    their own (see Stage.start), each thread has an instance of every
+    stage's worker class working on its jobs (see Worker.handle).
+
+    Constructor arguments:
+        stages (list of Stage)  :   stages of the pipeline in recipe order
+        size (int)              :   number of threads (0: twice the CPUs)
+        available (Semaphore)   :   released for every job put into the
+                                    stages' input queues (see
+                                    SignallingQueue)
+    """
+
+    def __init__(self, stages, size, available):
+        self.stages = stages
+        self.size = size or 2 * multiprocessing.cpu_count()
+        self.available = available
+        self.threads = []
+        self._stopping = False
+
+    def start(self):
+        """Start threads. They block until jobs arrive in a stage's queue."""
+        self._stopping = False
+        self.threads = [_SharedWorker(self, number)
+                        for number in range(self.size)]
+        for thread in self.threads:
+            thread.start()
+        log.debug("started %i shared workers", self.size)
+
+    def stop(self, timeout=None):
+        """
+        Stop threads once they finished their current job. Blocks until
+        they terminated (or timeout seconds passed).
+        """
+        self._stopping = True
+        for thread in self.threads:
+            self.available.release()    # wake up waiting threads
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            if not wait_interruptibly(thread.join,
+                                      lambda: not thread.is_alive(), deadline):
+                return
+        self.threads = []
+
+    def cancel(self):
+        """Abort the jobs in progress where possible (see Worker.cancel)."""
+        for thread in list(self.threads):
+            for worker in thread.workers:
+                worker.cancel()
+
+    def _next_job(self):
+        """
+        Return (worker index, job) of the next job to work on or None if the
+        pool is stopping. Blocks until a job is available.
+        """
+        while True:
+            self.available.acquire()
+            if self._stopping:
+                return None
+            # downstream stages first
+            for i in reversed(range(len(self.stages))):
+                try:
+                    job = self.stages[i].input.get_nowait()
+                except Queue.Empty:
+                    continue
+                if job is STOP:     # not meant for the shared workers
+                    self.stages[i].input.task_done()
+                    break
+                return (i, job)
+            # the job was flushed meanwhile (see Stage.flush)
+
+
+class _SharedWorker(threading.Thread):
+    """Thread of a SharedPool."""
+
+    def __init__(self, pool, number):
+        threading.Thread.__init__(self, name='SharedWorker-%i' % number)
+        self.daemon = True
+        self.pool = pool
+        # workers (not started) doing the jobs of every stage
+        self.workers = [stage.create_worker(number) for stage in pool.stages]
+
+    def run(self):
+        while True:
+            item = self.pool._next_job()
+            if item is None:
+                break
+            (i, job) = item
+            self.workers[i].handle(job)
+
+
+class SignallingQueue(InstrumentedQueue):
+    """
+    Queue releasing a semaphore (or a Waker, see EventLoop) for every item
+    put, so threads of a SharedPool can wait for jobs in any of several
+    queues.
+    """
+
+    def __init__(self, maxsize=0, semaphore=None):
+        InstrumentedQueue.__init__(self, maxsize)
+        self.semaphore = semaphore
+
+    def _put(self, item):
+        InstrumentedQueue._put(self, item)
+        self.semaphore.release()
+
+
+# Unit test
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -4,9 +4,14 @@
 @license: GPL
 
 """
+import multiprocessing
 import threading
+import Queue
 
-from dispatcher import Dispatcher
+from dispatcher import Dispatcher, STOP, put_unbounded
+from dispatcher import wait_interruptibly
+from stats import StageStats
+from worker import ProcessWorker
 
 
 #class StageState():
@@ -21,59 +26,213 @@ class Stage():
     """
 
     def __init__(self, name, WorkerClass, num_workers, in_buffer,
-                 out_buffer, seq_number, pipeline, path):
+                 out_buffer, seq_number, pipeline, path, conf=None,
+                 min_workers=None, max_workers=None, governor=None,
+                 journal=None, dead_letters=None, cancelled=None):
         self.name = name
         self.WorkerClass = WorkerClass
         self.num_workers = num_workers
+        # bounds of the number of workers set by the dispatcher (default:
+        # fixed number of workers)
+        self.min_workers = num_workers if min_workers is None else min_workers
+        self.max_workers = num_workers if max_workers is None else max_workers
         self.pipeline = pipeline
+        # accounts for the memory of loaded picture files (see MemoryGovernor)
+        self.governor = governor
+        # records the jobs done by the workers (see Journal)
+        self.journal = journal
+        # collects the failed jobs (see Pipeline.get_failures)
+        self.dead_letters = dead_letters
+        # set once the pipeline is cancelled (see abort)
+        self.cancelled = cancelled if cancelled is not None \
+                         else threading.Event()
         self.input = in_buffer
         self.output = out_buffer
         self.seq_number = seq_number
-        self.worker_environ = dict(pool=self, path=path)
+        self.worker_environ = dict(pool=self, path=path, conf=conf)
         self.isactive = False
-        self.progress = 0
+        self.dispatcher = Dispatcher(self)
+        self.stats = StageStats(in_buffer)
+
+    @property
+    def workers(self):
+        return self.dispatcher.workers
 
-    def _create_worker(self, num):
-        return [ self.WorkerClass(self.input, self.output, i, **self.worker_environ) for i in range(num) ]
+    def create_worker(self, number):
+        """Return a new (not started) worker. Called by the dispatcher."""
+        return self.WorkerClass(self.input, self.output, number,
+                                **self.worker_environ)
 
     def add_worker(self):
-        new_worker = self._create_worker(1)
-        self.workers.append(new_worker)
+        """Start an additional worker."""
+        self.dispatcher.start_workers(1)
         self.num_workers += 1
 
     def remove_worker(self):
-        self.workers.pop().join()
-        self.num_woker -= 1
+        """Stop a worker once it finished its current job. Doesn't block."""
+        self.dispatcher.stop_workers(1)
+        self.num_workers -= 1
 
-    def start(self):
-        # Global activity flag
+    def start(self, workers=True):
+        """
+        Start workers. They block until jobs arrive in the input queue. If
+        workers isn't set, the stage's jobs are done by a SharedPool instead.
+        """
         self.isactive = True
-        # Dispatcher-controlled Event worker threads wait for before they start
-        self.wakeSignal = threading.Event()
-        # create worker threads
-        self.workers = self._create_worker(self.num_workers)
-        # create dispatcher thread
-        self.dispatcher = Dispatcher(self)
-        # start threads
-        [worker.start() for worker in self.workers]
-        # start dispatcher thread
-        self.dispatcher.start()
+        if workers:
+            self.dispatcher.start_workers(self.num_workers)
 
     def stop(self):
         """
         Block until all workers have finished current job. Input queue does not
-        have to be empty.
+        have to be empty: queued jobs are put back after the workers stopped.
         """
-        self.isactive = False
+        jobs = []
+        pills = []  # of removed workers
+        while True:
+            try:
+                job = self.input.get_nowait()
+            except Queue.Empty:
+                break
+            (pills if job is STOP else jobs).append(job)
+            self.input.task_done()
+        for pill in pills:
+            put_unbounded(self.input, pill)
+        self.dispatcher.stop_workers()
         self.dispatcher.join()
+        for job in jobs:
+            put_unbounded(self.input, job)
+        self.isactive = False
 
     def join(self):
         """
-        Block until the input queue is empty.    
+        Block until all jobs in the input queue are done, then stop workers.
+        Returns early if the stage is cancelled (see abort).
         """
-        self.input.join()
-        self.isactive = False
+        with self.input.all_tasks_done:
+            wait_interruptibly(self.input.all_tasks_done.wait,
+                               lambda: not self.input.unfinished_tasks
+                                       or self.cancelled.is_set())
+        if self.cancelled.is_set():
+            return
+        self.dispatcher.stop_workers()
         self.dispatcher.join()
+        self.isactive = False
+
+    def flush(self):
+        """
+        Remove all jobs from the input queue without working on them &
+        release their pictures' loaded files. Return number of removed jobs.
+        """
+        pills = []  # of removed workers
+        flushed = 0
+        while True:
+            try:
+                job = self.input.get_nowait()
+            except Queue.Empty:
+                break
+            if job is STOP:
+                pills.append(job)
+            else:
+                self._release_buffer(job[0])
+                flushed += 1
+            self.input.task_done()
+        for pill in pills:
+            put_unbounded(self.input, pill)
+        return flushed
+
+    def cancel(self):
+        """
+        Abort the jobs in progress where possible (see Worker.cancel) and
+        flush the input queue. Jobs arriving later are dropped by the workers.
+        """
+        self.cancelled.set()
+        for worker in list(self.workers):
+            worker.cancel()
+        self.flush()
+
+    def abort(self, timeout=None):
+        """
+        Cancel the stage & stop the workers. Blocks until the workers stopped
+        or timeout seconds passed.
+        """
+        self.cancel()
+        self.dispatcher.stop_workers()
+        self.dispatcher.join(timeout)
+        self.isactive = False
+
+    def _release_buffer(self, picture):
+        if self.governor is not None:
+            self.governor.release_buffer(picture)
+        else:
+            picture.release_buffer()
+
+
+class ProcessStage(Stage):
+    """
+    A stage running its workers' jobs in a pool of worker processes.
+
+    The dispatcher's worker threads (see ProcessWorker) only hand the jobs to
+    the processes, so CPU-bound workers (e.g. pyexiv2 parsing) scale with the
+    number of CPUs. The pool has one process per CPU (at most max_workers) and
+    the stage has at most as many worker threads as processes. Pipelines
+    share one pool among all their process stages (see start_processes).
+    """
+
+    def __init__(self, *args, **kwargs):
+        Stage.__init__(self, *args, **kwargs)
+        self.max_workers = min(self.max_workers, multiprocessing.cpu_count())
+        self.min_workers = min(self.min_workers, self.max_workers)
+        self.num_workers = min(self.num_workers, self.max_workers)
+        conf = self.worker_environ['conf']
+        if conf is not None:    # only send plain values to the processes
+            self.worker_environ['conf'] = dict(conf)
+        self.processes = None
+        self._shared = False    # processes are stopped by their owner
+
+    def create_worker(self, number):
+        return ProcessWorker(self.input, self.output, number,
+                             **self.worker_environ)
+
+    def start_processes(self, processes=None):
+        """
+        Start the stage's pool of worker processes (unless started before).
+        If processes is given, the jobs are run by that pool instead, which
+        is shared with other stages and isn't stopped by the stage.
+        """
+        if processes is not None:
+            (self.processes, self._shared) = (processes, True)
+        elif self.processes is None:
+            self.processes = multiprocessing.Pool(self.max_workers)
+            self._shared = False
+
+    def start(self, workers=True):
+        """Start worker processes (unless started before) and workers."""
+        self.start_processes()
+        Stage.start(self, workers)
+
+    def _stop_processes(self):
+        if not self._shared:
+            self.processes.close()
+            self.processes.join()
+        self.processes = None
+
+    def stop(self):
+        Stage.stop(self)
+        self._stop_processes()
+
+    def join(self):
+        Stage.join(self)
+        if not self.cancelled.is_set():
+            self._stop_processes()
+
+    def abort(self, timeout=None):
+        Stage.abort(self, timeout)
+        if self.processes is not None and not self._shared:
+            # kill the worker processes' jobs in progress
+            self.processes.terminate()
+            self.processes.join()
+        self.processes = None
 
 
 # Unit test       
@@ -0,0 +1,188 @@
+"""
+@author: Matthias Grueter <matthias@grueter.name>
+@copyright: Copyright (c) 2012 Matthias Grueter
+@license: GPL
+
+"""
+import bisect
+import threading
+import time
+import Queue
+
+from dispatcher import STOP
+
+
+# upper bounds (seconds) of the buckets of time histograms
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram(object):
+    """
+    Histogram of durations in seconds with fixed buckets (see BUCKETS).
+
+    Histograms aren't thread-safe, their owner serialises access.
+    """
+
+    def __init__(self):
+        # number of values per bucket, the last bucket counts larger values
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """
+        Return upper bound of the bucket of the value below which fraction of
+        the values lie (or None if the histogram is empty).
+
+        >>> h = Histogram()
+        >>> for value in (0.003, 0.004, 0.03, 3):
+        ...     h.add(value)
+        >>> h.percentile(0.5), h.percentile(0.75), h.percentile(1)
+        (0.005, 0.05, 3)
+        """
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(BUCKETS + (self.max,), self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(bound, self.max)
+
+    def todict(self):
+        return dict(count=self.count,
+                    total=self.total,
+                    mean=self.total / self.count if self.count else None,
+                    max=self.max,
+                    p50=self.percentile(0.5),
+                    p95=self.percentile(0.95),
+                    buckets=dict(zip([str(b) for b in BUCKETS] + ['inf'],
+                                     self.counts)))
+
+
+class InstrumentedQueue(Queue.Queue):
+    """
+    Queue recording how long its items (except poison pills) waited in the
+    queue before they were taken.
+    """
+
+    def _init(self, maxsize):
+        Queue.Queue._init(self, maxsize)
+        self.waits = Histogram()
+
+    def _put(self, item):
+        self.queue.append((time.time(), item))
+
+    def _get(self):
+        (put_time, item) = self.queue.popleft()
+        if item is not STOP:
+            self.waits.add(time.time() - put_time)
+        return item
+
+    def wait_stats(self):
+        """Return histogram of the waiting times as dictionary."""
+        with self.mutex:
+            return self.waits.todict()
+
+
+class StageStats(object):
+    """
+    StageStats records the throughput & latency of a stage's workers.
+
+    Constructor arguments:
+        queue (Queue)           :   input queue of the stage (waiting times
+                                    are recorded if it's an InstrumentedQueue)
+    """
+
+    def __init__(self, queue=None):
+        self.queue = queue
+        self.started = time.time()
+        self.jobs = 0
+        self.failures = 0
+        self.bytes = 0
+        self.busy = 0.0     # seconds the workers spent on jobs
+        self.idle = 0.0     # seconds the workers waited for jobs
+        self.service_times = Histogram()
+        self._lock = threading.Lock()
+
+    def job_done(self, service_time, success, num_bytes=0):
+        """Record a finished job. Called by the workers."""
+        with self._lock:
+            self.jobs += 1
+            if not success:
+                self.failures += 1
+            self.bytes += num_bytes
+            self.busy += service_time
+            self.service_times.add(service_time)
+
+    def add_idle(self, seconds):
+        """Record time a worker waited for jobs. Called by the workers."""
+        with self._lock:
+            self.idle += seconds
+
+    def todict(self):
+        with self._lock:
+            elapsed = time.time() - self.started
+            stats = dict(jobs=self.jobs,
+                         failures=self.failures,
+                         bytes=self.bytes,
+                         busy=self.busy,
+                         idle=self.idle,
+                         elapsed=elapsed,
+                         utilization=(self.busy / (self.busy + self.idle)
+                                      if self.busy + self.idle else None),
+                         throughput=self.jobs / elapsed if elapsed else None,
+                         service_time=self.service_times.todict())
+        wait_stats = getattr(self.queue, 'wait_stats', None)
+        stats['queue_wait'] = wait_stats() if wait_stats else None
+        return stats
+
+
+def format_stats(stats):
+    """
+    Return table of pipeline statistics (see Pipeline.get_stats). The stage
+    whose workers were busy for the largest part of the time is marked as
+    bottleneck.
+    """
+    def ms(seconds):
+        return '-' if seconds is None else '%.1f' % (seconds * 1000)
+
+    lines = ["%i pictures in %.1f sec" % (stats['jobs'], stats['elapsed']),
+             "%-24s %6s %6s %8s %6s %7s %9s %9s %9s %9s" %
+             ('stage', 'jobs', 'failed', 'MB', 'busy%', 'jobs/s',
+              'svc p50', 'svc p95', 'wait p50', 'wait p95')]
+    utilizations = [stage['utilization'] or 0 for stage in stats['stages']]
+    bottleneck = None
+    if utilizations:
+        bottleneck = utilizations.index(max(utilizations))
+    for i, stage in enumerate(stats['stages']):
+        service = stage['service_time']
+        wait = stage['queue_wait'] or dict(p50=None, p95=None)
+        name = stage['name']
+        if stage['executor'] != 'thread':
+            name += ':' + stage['executor']
+        lines.append("%-24s %6i %6i %8.1f %6.1f %7.2f %9s %9s %9s %9s%s" %
+                     (name, stage['jobs'], stage['failures'],
+                      stage['bytes'] / 1024.0 ** 2,
+                      (stage['utilization'] or 0) * 100,
+                      stage['throughput'] or 0,
+                      ms(service['p50']), ms(service['p95']),
+                      ms(wait['p50']), ms(wait['p95']),
+                      '  <- bottleneck' if i == bottleneck else ''))
+    return '\n'.join(lines)
+
+
+# Unit test
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
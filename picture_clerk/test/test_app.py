@@ -7,14 +7,36 @@
 import unittest
 import mock
 import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+import Queue
 
 import index
 import repo
 import app
 
+from connector import Connector, ChecksumMismatchError, NotConnectedError
+from journal import get_state
+from picture import Picture, get_stat_key
+
 from testlib import MockConnector, MockPicture, new_mock_repo
 
 
+def mock_pipeline(MockPipeline):
+    """Set up the pipeline mocked by MockPipeline & return it."""
+    pl = MockPipeline.return_value
+    pl.get_stats.return_value = dict(name='Pipeline1', jobs=0, elapsed=0,
+                                     stages=[])
+    pl.get_failures.return_value = []
+    pl.output = Queue.Queue()
+    pl.cancelled = threading.Event()
+    pl.cancel.side_effect = pl.cancelled.set
+    return pl
+
+
 @mock.patch('app.Connector', new=MockConnector)
 class InitRepoTests(unittest.TestCase):
 
@@ -70,6 +92,212 @@ class AddRemovePicsTest(unittest.TestCase):
             self.assertIn(pic, rep.index)
         self.assertEqual(len(rep.index), len(old_pics) + len(new_pics))
 
+    @mock.patch('os.path.exists')
+    @mock.patch('app.Journal')
+    @mock.patch('app.Pipeline')
+    def test_add_with_recipe(self, MockPipeline, MockJournal, mock_exists):
+        pl = mock_pipeline(MockPipeline)
+        rep = new_mock_repo(self.path, num_pics=0)
+        app.add_pics(rep, ['DSC_0001'], process=True,
+                     recipe='HashDigestWorker, MetadataWorker after start')
+
+        recipe = MockPipeline.call_args[0][1]
+        self.assertEqual(recipe.stage_dependencies, [[], []])
+        pl.start.assert_called_once_with()
+        self.assertEqual(pl.put.call_count, 1)
+        pl.join.assert_called_once_with()
+        self.assertTrue(rep.connector.opened(repo.STATS_FILE))
+
+    @mock.patch('os.path.exists')
+    @mock.patch('app.Journal')
+    @mock.patch('app.Pipeline')
+    def test_add_journaled(self, MockPipeline, MockJournal, mock_exists):
+        pl = mock_pipeline(MockPipeline)
+        journal = MockJournal.return_value
+        rep = new_mock_repo(self.path, num_pics=0)
+        app.add_pics(rep, ['DSC_0001'], process=True,
+                     recipe='HashDigestWorker')
+
+        MockJournal.assert_called_once_with(
+                            os.path.join(self.path, repo.JOURNAL_FILE))
+        self.assertIs(MockPipeline.call_args[1]['journal'], journal)
+        self.assertFalse(journal.replay.called)
+        # journal is cleared before processing & after saving the index
+        self.assertEqual(journal.clear.call_count, 2)
+
+    @mock.patch('os.path.exists')
+    @mock.patch('app.Journal')
+    @mock.patch('app.Pipeline')
+    def test_add_resume(self, MockPipeline, MockJournal, mock_exists):
+        pl = mock_pipeline(MockPipeline)
+        state = get_state(Picture('DSC_0001'))
+        state['checksums'] = dict(sha1='abc')
+        MockJournal.return_value.replay.return_value = dict(
+                DSC_0001=(set(['HashDigestWorker']), state),
+                DSC_0002=(set(['HashDigestWorker', 'MetadataWorker']), state))
+        rep = new_mock_repo(self.path, num_pics=0)
+        app.add_pics(rep, ['DSC_0001', 'DSC_0002', 'DSC_0003'], process=True,
+                     recipe='LoadWorker, HashDigestWorker, MetadataWorker',
+                     resume=True)
+
+        # DSC_0002 is done, DSC_0003 wasn't started
+        self.assertEqual(pl.put.call_args_list,
+                         [mock.call(rep.index['DSC_0001'],
+                                    set(['HashDigestWorker'])),
+                          mock.call(rep.index['DSC_0003'], set())])
+        self.assertEqual(rep.index['DSC_0001'].checksums, dict(sha1='abc'))
+        self.assertEqual(rep.index['DSC_0002'].checksums, dict(sha1='abc'))
+        self.assertEqual(MockJournal.return_value.clear.call_count, 1)
+
+    @mock.patch('os.path.exists')
+    @mock.patch('app.log')
+    @mock.patch('app.Journal')
+    @mock.patch('app.Pipeline')
+    def test_add_reports_failures(self, MockPipeline, MockJournal, mock_log,
+                                  mock_exists):
+        pl = mock_pipeline(MockPipeline)
+        rep = new_mock_repo(self.path, num_pics=0)
+        pics = [Picture('DSC_0001'), Picture('DSC_0002')]
+        pl.get_failures.return_value = [
+                (pics[0], 1, 'HashDigestWorker', IOError(5, 'I/O error')),
+                (pics[1], 2, 'AutorotWorker', None)]
+        app.add_pics(rep, ['DSC_0001', 'DSC_0002'], process=True)
+
+        mock_log.warning.assert_called_once_with(
+                "%i jobs failed:\n%s", 2,
+                "  DSC_0001: HashDigestWorker ([Errno 5] I/O error)\n"
+                "  DSC_0002: AutorotWorker")
+
+    @mock.patch('os.path.exists')
+    @mock.patch('app.Journal')
+    @mock.patch('app.Pipeline')
+    def test_add_cancelled(self, MockPipeline, MockJournal, mock_exists):
+        pl = mock_pipeline(MockPipeline)
+        # e.g. SIGINT while the first picture is put
+        pl.put.side_effect = lambda pic, done: app.cancel()
+        rep = new_mock_repo(self.path, num_pics=0)
+        app.add_pics(rep, ['DSC_0001', 'DSC_0002'], process=True)
+
+        self.assertTrue(pl.cancelled.is_set())
+        self.assertEqual(pl.put.call_count, 1)
+        pl.join.assert_called_once_with()
+        self.assertFalse(app.cancel())  # no pipeline running anymore
+        # results are saved, the journal is kept for resuming
+        self.assertTrue(rep.connector.opened(repo.STATS_FILE))
+        self.assertEqual(MockJournal.return_value.clear.call_count, 1)
+
+    @mock.patch('os.path.exists')
+    @mock.patch('app.Journal')
+    @mock.patch('app.Pipeline')
+    def test_add_resume_cancelled(self, MockPipeline, MockJournal,
+                                  mock_exists):
+        pl = mock_pipeline(MockPipeline)
+        pl.put.side_effect = lambda pic, done: app.cancel()
+        rep = new_mock_repo(self.path, num_pics=0)
+        files = ['DSC_0001', 'DSC_0002']
+        app.add_pics(rep, files, process=True)
+        # the interrupted run saved the index
+        self.assertTrue(rep.connector.opened(rep.config['index.file']))
+        pics = [rep.index[fname] for fname in files]
+
+        self.assertRaises(index.PictureAlreadyIndexedError,
+                          app.add_pics, rep, files, True)
+        pl = mock_pipeline(MockPipeline)
+        pl.put.reset_mock()
+        pl.put.side_effect = None
+        MockJournal.return_value.replay.return_value = dict()
+        app.add_pics(rep, files, process=True, resume=True)
+
+        # the indexed pictures are processed again
+        self.assertEqual(len(rep.index), 2)
+        self.assertEqual([c[0][0] for c in pl.put.call_args_list], pics)
+
+    @mock.patch('os.path.exists')
+    @mock.patch('app.Journal')
+    @mock.patch('app.Pipeline')
+    def test_iter_add_pics(self, MockPipeline, MockJournal, mock_exists):
+        pl = mock_pipeline(MockPipeline)
+        pl.put.side_effect = lambda pic, done: pl.output.put((pic, 1))
+        rep = new_mock_repo(self.path, num_pics=0)
+        rep.config['index.checkpoint_size'] = 2
+        rep.config['index.checkpoint_max_overhead'] = 0
+        files = ['DSC_%04i' % i for i in range(5)]
+        with mock.patch.object(rep, 'save_index_to_disk') as mock_save:
+            done = [pic.filename for pic in app.iter_add_pics(rep, files)]
+
+            self.assertEqual(done, files)
+            # checkpoints after 2 & 4 pictures, then at the end
+            self.assertEqual(mock_save.call_count, 3)
+        self.assertEqual(MockJournal.return_value.clear.call_count, 2)
+
+    @mock.patch('os.path.exists')
+    @mock.patch('app.Journal')
+    @mock.patch('app.Pipeline')
+    def test_checkpoint_overhead(self, MockPipeline, MockJournal,
+                                 mock_exists):
+        pl = mock_pipeline(MockPipeline)
+        pl.put.side_effect = lambda pic, done: pl.output.put((pic, 1))
+        rep = new_mock_repo(self.path, num_pics=0)
+        rep.config['index.checkpoint_size'] = 1
+        rep.config['index.checkpoint_max_overhead'] = 0.1
+        files = ['DSC_%04i' % i for i in range(5)]
+        with mock.patch.object(rep, 'save_index_to_disk') as mock_save:
+            mock_save.side_effect = lambda *args: time.sleep(0.1)
+            list(app.iter_add_pics(rep, files))
+
+            # no checkpoint within 1 sec after the first one, then at the end
+            self.assertEqual(mock_save.call_count, 2)
+
+    @mock.patch('os.path.exists')
+    @mock.patch('app.Journal')
+    @mock.patch('app.Pipeline')
+    def test_checkpoint_in_flight(self, MockPipeline, MockJournal,
+                                  mock_exists):
+        pl = mock_pipeline(MockPipeline)
+        def put(pic, done):
+            if pic.filename == 'DSC_0000':
+                # still being processed while the others are done
+                pic.checksums['sha1'] = 'abc'
+            else:
+                pl.output.put((pic, 1))
+        pl.put.side_effect = put
+        rep = new_mock_repo(self.path, num_pics=0)
+        rep.config['index.checkpoint_size'] = 1
+        files = ['DSC_0000', 'DSC_0001']
+        with mock.patch.object(rep, 'save_index_to_disk') as mock_save:
+            done = [pic.filename for pic in app.iter_add_pics(rep, files)]
+
+            self.assertEqual(done, ['DSC_0001'])
+            (checkpoint, final) = mock_save.call_args_list
+        # the picture in flight is saved in the state it entered the pipeline
+        snapshot = checkpoint[0][0]
+        self.assertEqual(sorted(snapshot._index), files)
+        self.assertEqual(snapshot['DSC_0000'].checksums, dict())
+        self.assertIsNot(snapshot['DSC_0000'], rep.index['DSC_0000'])
+        self.assertIs(snapshot['DSC_0001'], rep.index['DSC_0001'])
+        self.assertEqual(final, mock.call())
+
+    @mock.patch('os.path.exists')
+    @mock.patch('app.Journal')
+    @mock.patch('app.Pipeline')
+    def test_iter_add_pics_stopped(self, MockPipeline, MockJournal,
+                                   mock_exists):
+        pl = mock_pipeline(MockPipeline)
+        def put(pic, done):
+            pl.output.put((pic, 1))
+            pl.cancelled.wait(5)    # pipeline is busy until cancelled
+        pl.put.side_effect = put
+        rep = new_mock_repo(self.path, num_pics=0)
+        pics = app.iter_add_pics(rep, ['DSC_0001', 'DSC_0002'])
+
+        self.assertEqual(next(pics).filename, 'DSC_0001')
+        pics.close()
+        self.assertTrue(pl.cancelled.is_set())
+        self.assertEqual(pl.put.call_count, 1)
+        # results are saved, the journal is kept for resuming
+        self.assertTrue(rep.connector.opened(repo.STATS_FILE))
+        self.assertEqual(MockJournal.return_value.clear.call_count, 1)
+
     def test_remove_pics(self):
         rep = new_mock_repo(self.path, num_pics=25)
         keep = [pic.filename for pic in rep.index.pics()[::2]]  # 0,2,4,6,... 
@@ -118,6 +346,103 @@ class ListPicsTests(unittest.TestCase):
         self.assertEqual(actual, expected)
 
 
+@mock.patch('app.Journal')
+@mock.patch('app.Pipeline')
+@mock.patch('app.Connector', new=MockConnector)
+class ProcessPicsTests(unittest.TestCase):
+
+    recipe = ('HashDigestWorker, ThumbWorker after start, '
+              'AutorotWorker after ThumbWorker')
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = new_mock_repo(self.path, num_pics=3)
+        self.pics = self.repo.index.pics()
+        for pic in self.pics:
+            with open(os.path.join(self.path, pic.filename), 'wb') as fh:
+                fh.write(pic.filename)
+            stat = list(get_stat_key(os.stat(os.path.join(self.path,
+                                                          pic.filename))))
+            for name in ('HashDigestWorker', 'ThumbWorker', 'AutorotWorker'):
+                pic.stages[name] = dict(source=stat, version=1, outputs=[],
+                                        params=dict())
+            algorithms = self.repo.config['checksums.algorithms']
+            pic.stages['HashDigestWorker']['params'] = {
+                    'checksums.algorithms': algorithms}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _put(self, MockPipeline):
+        return mock_pipeline(MockPipeline).put
+
+    def test_skip_current_stages(self, MockPipeline, MockJournal):
+        put = self._put(MockPipeline)
+        # ThumbWorker changed since, AutorotWorker works on its results
+        self.pics[0].stages['ThumbWorker']['version'] = 0
+        # picture file changed since
+        with open(os.path.join(self.path, self.pics[1].filename), 'ab') as fh:
+            fh.write('changed')
+        app.process_pics(self.repo, recipe=self.recipe)
+
+        self.assertEqual(put.call_args_list,
+                         [mock.call(self.pics[0], set(['HashDigestWorker'])),
+                          mock.call(self.pics[1], set())])
+        self.assertTrue(self.repo.connector.opened(repo.STATS_FILE))
+
+    def test_missing_output(self, MockPipeline, MockJournal):
+        put = self._put(MockPipeline)
+        thumbnail = self.pics[0].get_thumbnail_filenames()[0]
+        self.pics[0].stages['ThumbWorker']['outputs'] = [thumbnail]
+        app.process_pics(self.repo, recipe=self.recipe)
+
+        put.assert_called_once_with(self.pics[0], set(['HashDigestWorker']))
+
+    def test_changed_params(self, MockPipeline, MockJournal):
+        put = self._put(MockPipeline)
+        self.repo.config['checksums.algorithms'] = 'sha1,md5'
+        app.process_pics(self.repo, [self.pics[2].filename],
+                         recipe=self.recipe)
+
+        put.assert_called_once_with(self.pics[2],
+                                    set(['ThumbWorker', 'AutorotWorker']))
+
+    def test_force(self, MockPipeline, MockJournal):
+        put = self._put(MockPipeline)
+        app.process_pics(self.repo, recipe=self.recipe, force=True)
+
+        self.assertEqual(put.call_args_list,
+                         [mock.call(pic, set()) for pic in self.pics])
+
+
+@mock.patch('app.Connector', new=MockConnector)
+class StatsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = new_mock_repo("test/path")
+        self.stats = dict(name='Pipeline1', jobs=3, elapsed=1.5, stages=[
+            dict(name='HashDigestWorker', executor='thread', jobs=3,
+                 failures=1, bytes=3 * 1024 ** 2, utilization=0.9,
+                 throughput=2.0, service_time=dict(p50=0.2, p95=0.5),
+                 queue_wait=dict(p50=None, p95=None))])
+        with self.repo.connector.connected():
+            self.repo.save_stats_to_disk(self.stats)
+
+    def test_show_stats(self):
+        table = app.show_stats(self.repo)
+        self.assertIn('3 pictures in 1.5 sec', table)
+        self.assertIn('HashDigestWorker', table)
+        self.assertIn('bottleneck', table)
+
+    def test_show_raw_stats(self):
+        self.assertEqual(json.loads(app.show_stats(self.repo, raw=True)),
+                         self.stats)
+
+    def test_no_stats(self):
+        with mock.patch.object(self.repo.connector, 'exists',
+                               return_value=False):
+            self.assertIn('No statistics', app.show_stats(self.repo))
+
 @mock.patch('app.remove_pics')
 @mock.patch('app.Viewer', spec_set=True)
 class ViewPicsTests(unittest.TestCase):
@@ -212,6 +537,178 @@ class CheckPicsTests(unittest.TestCase):
         self.assertSequenceEqual(corrupt, [pic.filename for pic in corrupted])
         self.assertSequenceEqual(missing, [])
 
+    def test_parallel(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=31)
+        rep = self.populate_picture_buffers(rep)
+        corrupted = rep.index.pics()[1::3]
+        for pic in corrupted:
+            pic.checksum = 'wrong checksum!'
+
+        corrupt, missing = app.check_pics(rep, jobs=4)
+
+        self.assertSequenceEqual(corrupt, [pic.filename for pic in corrupted])
+        self.assertSequenceEqual(missing, [])
+
+    def test_parallel_device_limit(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=17)
+        rep = self.populate_picture_buffers(rep)
+        rep.config['check.device_jobs'] = 1
+
+        results = list(app.iter_check_pics(rep, jobs=4))
+
+        self.assertItemsEqual(results, [(pic.filename, app.OK)
+                                        for pic in rep.index.pics()])
+
+    def test_parallel_error(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=5)
+        rep = self.populate_picture_buffers(rep)
+        pics = rep.index.pics()
+        def stat(path):
+            if path.endswith(pics[2].filename):
+                raise NotConnectedError()
+            return os.stat_result((0100644, 0, 0, 1, 0, 0, 10, 0, 0, 0))
+
+        with mock.patch.object(rep.connector, '_stat', side_effect=stat):
+            # raised instead of waiting for the result forever
+            self.assertRaises(NotConnectedError, list,
+                              app.iter_check_pics(rep, jobs=2))
+
+    def test_parallel_no_device_lookup(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=5)
+        rep = self.populate_picture_buffers(rep)
+
+        with mock.patch('app._get_device') as mock_get_device:
+            list(app.iter_check_pics(rep, jobs=2))
+        # without a device limit the devices don't matter
+        self.assertFalse(mock_get_device.called)
+
+    def test_quick(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=10)
+        rep = self.populate_picture_buffers(rep)
+        app.check_pics(rep)     # records file status of verified pictures
+        changed = rep.index.pics()[::2]
+        for pic in rep.index.pics():
+            pic.checksum = 'wrong checksum!'
+        for pic in changed:
+            with rep.connector.connected():
+                with rep.connector.open(pic.filename, 'w') as buf:
+                    buf.write('modified ' + pic.filename)
+
+        corrupt, missing = app.check_pics(rep, quick=True)
+
+        self.assertSequenceEqual(corrupt, [pic.filename for pic in changed])
+        self.assertSequenceEqual(missing, [])
+
+    def test_quick_sample(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=10)
+        rep = self.populate_picture_buffers(rep)
+        app.check_pics(rep)
+        for pic in rep.index.pics():
+            pic.checksum = 'wrong checksum!'
+
+        corrupt, missing = app.check_pics(rep, quick=True, sample=1.0)
+
+        self.assertSequenceEqual(corrupt, [pic.filename
+                                           for pic in rep.index.pics()])
+
+    def test_scrub_time_budget(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=10)
+        rep = self.populate_picture_buffers(rep)
+
+        self.assertSequenceEqual(list(app.iter_check_pics(rep, budget='0s')),
+                                 [])
+        checked = [fname for fname, state in
+                   app.iter_check_pics(rep, budget='1h')]
+
+        self.assertItemsEqual(checked, [pic.filename
+                                        for pic in rep.index.pics()])
+        for pic in rep.index.pics():
+            self.assertIsNotNone(pic.verified)
+
+    def test_scrub_stalest_first(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=10)
+        rep = self.populate_picture_buffers(rep)
+        pics = rep.index.pics()
+        for i, pic in enumerate(reversed(pics)):
+            pic.verified = 1000 + i
+        pics[3].verified = None     # never verified
+
+        def fake_stat(path):
+            return os.stat_result((0100644, 0, 0, 1, 0, 0, 1024, 0, 0, 0))
+        rep.connector._stat = fake_stat
+
+        checked = [fname for fname, state in
+                   app.iter_check_pics(rep, budget='3K')]
+
+        self.assertSequenceEqual(checked, [pics[3].filename,
+                                           pics[-1].filename,
+                                           pics[-2].filename])
+
+    def test_parse_budget(self):
+        self.assertEqual(app.parse_budget('2h'), ('time', 7200))
+        self.assertEqual(app.parse_budget('1.5m'), ('time', 90))
+        self.assertEqual(app.parse_budget('100G'), ('bytes', 100 * 1024 ** 3))
+        self.assertEqual(app.parse_budget('2MB'), ('bytes', 2 * 1024 ** 2))
+        self.assertRaises(ValueError, app.parse_budget, '100')
+        self.assertRaises(ValueError, app.parse_budget, 'foo')
+
+    def test_audit(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=12)
+        rep = self.populate_picture_buffers(rep)
+        corrupted = rep.index.pics()[::4]
+        for pic in corrupted:
+            pic.checksums['sha256'] = 'wrong checksum!'
+
+        corrupt, missing = app.check_pics(rep)
+        self.assertSequenceEqual(corrupt, [])
+
+        corrupt, missing = app.check_pics(rep, audit=True)
+        self.assertSequenceEqual(corrupt, [pic.filename for pic in corrupted])
+        self.assertSequenceEqual(missing, [])
+
+    @mock.patch('app.Connector', new=MockConnector)
+    def test_remote_copy(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=10)
+        url = '/remote/copy/repo'
+        copy = MockConnector.from_string(url)
+        corrupted = rep.index.pics()[::3]
+        with copy.connected():
+            for pic in corrupted:
+                with copy.open(pic.filename, 'w') as buf:
+                    buf.write('corrupted')
+
+        corrupt, missing = app.check_pics(rep, remote=url)
+
+        self.assertSequenceEqual(corrupt, sorted(pic.filename
+                                                 for pic in corrupted))
+        self.assertSequenceEqual(missing, [])
+        for pic in rep.index.pics():
+            self.assertIsNone(pic.verified)     # only local files recorded
+
+    @mock.patch('app.Connector', new=MockConnector)
+    def test_remote_hashing(self):
+        rep = new_mock_repo('/basedir/repo/', num_pics=10)
+        url = '/remote/hashing/repo'
+        copy = MockConnector.from_string(url)
+        corrupted = rep.index.pics()[1::3]
+        with copy.connected():
+            for pic in corrupted:
+                with copy.open(pic.filename, 'w') as buf:
+                    buf.write('corrupted')
+        for pic in rep.index.pics():
+            pic.checksums['crc32'] = 'not calculated remotely'
+
+        with mock.patch.object(MockConnector, 'remote_algorithms', ('sha1',)):
+            with mock.patch.object(MockConnector, 'iter_digests',
+                                   autospec=True,
+                                   side_effect=Connector.iter_digests) as m:
+                corrupt, missing = app.check_pics(rep, remote=url)
+
+        self.assertSequenceEqual(corrupt, sorted(pic.filename
+                                                 for pic in corrupted))
+        self.assertSequenceEqual(missing, [])
+        self.assertEqual(m.call_args[0][2], 'sha1')
+
     def test_missing_pics(self):
         rep = new_mock_repo('/path/to/missingpics/repo', num_pics=31)
         def raise_oserror(*args):
@@ -266,6 +763,41 @@ class CloneRepoTests(unittest.TestCase):
         self.assertEqual(clone.connector.url.path, self.clone_path,
                          "Path to clone should be basepath + repo-name.")
 
+    def test_clone_corrupt_picture(self):
+        pic = self.origin.index.pics()[5]
+        connector = MockConnector.from_string(self.origin_path)
+        with connector.connected():
+            with connector.open(pic.filename, 'w') as buf:
+                buf.write('corrupted')
+
+        self.assertRaises(ChecksumMismatchError,
+                          app.clone_repo, self.origin_path, self.clone_basepath)
+
+    def test_clone_verify(self):
+        clone = app.clone_repo(self.origin_path, self.clone_basepath,
+                               verify=True)
+
+        self.assertEqual(clone.index, self.origin.index)
+
+    def test_clone_concurrently(self):
+        clone = app.clone_repo(self.origin_path, self.clone_basepath, jobs=4)
+
+        connector = MockConnector.from_string(self.clone_path)
+        for pic in self.origin.index.iterpics():
+            for fname in pic.get_filenames():
+                self.assertTrue(connector.opened(fname))
+        self.assertEqual(clone.index, self.origin.index)
+
+    def test_clone_concurrently_corrupt_picture(self):
+        pic = self.origin.index.pics()[5]
+        connector = MockConnector.from_string(self.origin_path)
+        with connector.connected():
+            with connector.open(pic.filename, 'w') as buf:
+                buf.write('corrupted')
+
+        self.assertRaises(ChecksumMismatchError, app.clone_repo,
+                          self.origin_path, self.clone_basepath, jobs=4)
+
     def test_cloned_repo_exists_on_disk(self):
         clone = app.clone_repo(self.origin_path, self.clone_basepath)
 
@@ -308,6 +840,17 @@ class BackupRepoTests(unittest.TestCase):
             self.assertEqual(backup.config, self.repo.config)
             self.assertEqual(backup.index, self.repo.index)
 
+    @mock.patch('app.repo.Repo.clone')
+    def test_backup_repo_ignores_clone_mode(self, mock_clone):
+        self.repo.config['clone.mode'] = 'hardlink'
+        app.backup_repo(self.repo, self.backupA_path)
+
+        self.assertEqual(mock_clone.call_args[0][3], 'copy')
+
+    def test_backup_repo_hardlink(self):
+        self.assertRaises(ValueError, app.backup_repo, self.repo,
+                          self.backupA_path, mode='hardlink')
+
 
 if __name__ == "__main__":
     unittest.main()
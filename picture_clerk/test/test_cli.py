@@ -7,6 +7,7 @@
 import unittest
 import mock
 import os
+import signal
 
 from cli import CLI
 from testlib import suppress_stderr
@@ -34,8 +35,8 @@ class ArgsParsingTests(unittest.TestCase):
 
 class CLIBaseTest(unittest.TestCase):
 
-    def create_patch(self, name):
-        patcher = mock.patch(name)
+    def create_patch(self, name, **kwargs):
+        patcher = mock.patch(name, **kwargs)
         thing = patcher.start()
         self.addCleanup(patcher.stop)
         return thing
@@ -47,11 +48,14 @@ class CLIBaseTest(unittest.TestCase):
         self.mock_init_repo = self.create_patch('app.init_repo')
         self.mock_load_repo = self.create_patch('app.load_repo')
         self.mock_add_pics = self.create_patch('app.add_pics')
+        self.mock_process_pics = self.create_patch('app.process_pics')
         self.mock_remove_pics = self.create_patch('app.remove_pics')
         self.mock_list_pics = self.create_patch('app.list_pics')
         self.mock_view_pics = self.create_patch('app.view_pics')
         self.mock_migrate_repo = self.create_patch('app.migrate_repo')
+        self.mock_show_stats = self.create_patch('app.show_stats')
         self.mock_check_pics = self.create_patch('app.check_pics')
+        self.mock_iter_check_pics = self.create_patch('app.iter_check_pics')
         self.mock_merge_repos = self.create_patch('app.merge_repos')
         self.mock_clone_repo = self.create_patch('app.clone_repo')
         self.mock_backup_repo = self.create_patch('app.backup_repo')
@@ -70,6 +74,32 @@ class BasicTests(CLIBaseTest):
         self.mock_app_shutdown.assert_called_once_with()
         self.mock_sys_exit.assert_called_once_with(17)
 
+    def test_signal_cancels_processing(self):
+        mock_cancel = self.create_patch('app.cancel', return_value=True)
+        cli = CLI()
+        cli.handle_sigint(signal.SIGINT, None)
+
+        mock_cancel.assert_called_once_with()
+        self.assertFalse(self.mock_sys_exit.called)
+        # the command saves its results & returns
+        cli.main(['progname', 'add', 'file1'])
+        self.mock_sys_exit.assert_called_once_with(128 + signal.SIGINT)
+
+    def test_signal_shuts_down(self):
+        self.create_patch('app.cancel', return_value=False)
+        CLI().handle_sigterm(signal.SIGTERM, None)
+
+        self.mock_app_shutdown.assert_called_once_with()
+        self.mock_sys_exit.assert_called_once_with(128 + signal.SIGTERM)
+
+    def test_second_signal_shuts_down(self):
+        self.create_patch('app.cancel', return_value=True)
+        cli = CLI()
+        cli.handle_sigint(signal.SIGINT, None)
+        cli.handle_sigint(signal.SIGINT, None)
+
+        self.mock_sys_exit.assert_called_once_with(128 + signal.SIGINT)
+
 
 class InitTests(CLIBaseTest):
 
@@ -88,7 +118,8 @@ class AddTests(CLIBaseTest):
 
         self.mock_load_repo.assert_called_once_with(self.cwd)
         repo = self.mock_load_repo.return_value
-        self.mock_add_pics.assert_called_once_with(repo, files, True, None)
+        self.mock_add_pics.assert_called_once_with(repo, files, True, None,
+                                                   False)
         self.mock_sys_exit.assert_called_once_with(0)
 
     def test_add_without_processing(self):
@@ -97,7 +128,8 @@ class AddTests(CLIBaseTest):
 
         self.mock_load_repo.assert_called_once_with(self.cwd)
         repo = self.mock_load_repo.return_value
-        self.mock_add_pics.assert_called_once_with(repo, files, False, None)
+        self.mock_add_pics.assert_called_once_with(repo, files, False, None,
+                                                   False)
         self.mock_sys_exit.assert_called_once_with(0)
 
     def test_add_with_process_recipe(self):
@@ -107,7 +139,41 @@ class AddTests(CLIBaseTest):
 
         self.mock_load_repo.assert_called_once_with(self.cwd)
         repo = self.mock_load_repo.return_value
-        self.mock_add_pics.assert_called_once_with(repo, files, True, recipe)
+        self.mock_add_pics.assert_called_once_with(repo, files, True, recipe,
+                                                   False)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_add_resume(self):
+        files = ['file1', 'file2', 'file3']
+        CLI().main(['progname', 'add'] + files + ['--resume'])
+
+        self.mock_load_repo.assert_called_once_with(self.cwd)
+        repo = self.mock_load_repo.return_value
+        self.mock_add_pics.assert_called_once_with(repo, files, True, None,
+                                                   True)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+
+class ProcessTests(CLIBaseTest):
+
+    def test_process(self):
+        CLI().main(['progname', 'process'])
+
+        self.mock_load_repo.assert_called_once_with(self.cwd)
+        repo = self.mock_load_repo.return_value
+        self.mock_process_pics.assert_called_once_with(repo, [], None,
+                                                       False, False)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_process_files(self):
+        files = ['file1', 'file2']
+        recipe = 'FOO.BAR'
+        CLI().main(['progname', 'process', '--force', '--recipe', recipe] +
+                   files)
+
+        repo = self.mock_load_repo.return_value
+        self.mock_process_pics.assert_called_once_with(repo, files, recipe,
+                                                       False, True)
         self.mock_sys_exit.assert_called_once_with(0)
 
 
@@ -178,20 +244,113 @@ class MigrateTests(CLIBaseTest):
         self.mock_migrate_repo.assert_called_once_with(repo)
         self.mock_sys_exit.assert_called_once_with(0)
 
+    def test_stats(self):
+        CLI().main(['progname', 'stats'])
+
+        self.mock_load_repo.assert_called_once_with(self.cwd)
+        repo = self.mock_load_repo.return_value
+        self.mock_show_stats.assert_called_once_with(repo, raw=False)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_stats_json(self):
+        CLI().main(['progname', 'stats', '--json'])
+
+        repo = self.mock_load_repo.return_value
+        self.mock_show_stats.assert_called_once_with(repo, raw=True)
+        self.mock_sys_exit.assert_called_once_with(0)
+
 
 class CheckTests(CLIBaseTest):
 
     def test_check(self):
-        self.mock_check_pics.return_value = ([], [])
+        self.mock_iter_check_pics.return_value = [('pic', 'ok')]
         CLI().main(['progname', 'check'])
 
         self.mock_load_repo.assert_called_once_with(self.cwd)
         repo = self.mock_load_repo.return_value
-        self.mock_check_pics.assert_called_once_with(repo)
+        self.mock_iter_check_pics.assert_called_once_with(repo, audit=False,
+                                                          jobs=None,
+                                                          processes=None,
+                                                          quick=False,
+                                                          sample=None,
+                                                          budget=None,
+                                                          remote=None)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_check_audit(self):
+        self.mock_iter_check_pics.return_value = []
+        CLI().main(['progname', 'check', '--audit'])
+
+        repo = self.mock_load_repo.return_value
+        self.mock_iter_check_pics.assert_called_once_with(repo, audit=True,
+                                                          jobs=None,
+                                                          processes=None,
+                                                          quick=False,
+                                                          sample=None,
+                                                          budget=None,
+                                                          remote=None)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_check_jobs(self):
+        self.mock_iter_check_pics.return_value = []
+        CLI().main(['progname', 'check', '--jobs', '8', '--processes'])
+
+        repo = self.mock_load_repo.return_value
+        self.mock_iter_check_pics.assert_called_once_with(repo, audit=False,
+                                                          jobs=8,
+                                                          processes=True,
+                                                          quick=False,
+                                                          sample=None,
+                                                          budget=None,
+                                                          remote=None)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_check_quick(self):
+        self.mock_iter_check_pics.return_value = [('pic', 'unchanged')]
+        CLI().main(['progname', 'check', '--quick', '--sample', '0.1'])
+
+        repo = self.mock_load_repo.return_value
+        self.mock_iter_check_pics.assert_called_once_with(repo, audit=False,
+                                                          jobs=None,
+                                                          processes=None,
+                                                          quick=True,
+                                                          sample=0.1,
+                                                          budget=None,
+                                                          remote=None)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_check_budget(self):
+        self.mock_iter_check_pics.return_value = []
+        CLI().main(['progname', 'check', '--budget', '2h'])
+
+        repo = self.mock_load_repo.return_value
+        self.mock_iter_check_pics.assert_called_once_with(repo, audit=False,
+                                                          jobs=None,
+                                                          processes=None,
+                                                          quick=False,
+                                                          sample=None,
+                                                          budget='2h',
+                                                          remote=None)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_check_remote(self):
+        self.mock_iter_check_pics.return_value = []
+        url = 'ssh://host/backup'
+        CLI().main(['progname', 'check', '--remote', url])
+
+        repo = self.mock_load_repo.return_value
+        self.mock_iter_check_pics.assert_called_once_with(repo, audit=False,
+                                                          jobs=None,
+                                                          processes=None,
+                                                          quick=False,
+                                                          sample=None,
+                                                          budget=None,
+                                                          remote=url)
         self.mock_sys_exit.assert_called_once_with(0)
 
     def test_check_fail(self):
-        self.mock_check_pics.return_value = (['corrupt pic'], ['missing pic'])
+        self.mock_iter_check_pics.return_value = [('corrupt pic', 'corrupt'),
+                                                  ('missing pic', 'missing')]
         CLI().main(['progname', 'check'])
 
         self.mock_sys_exit.assert_called_once_with(1)
@@ -215,7 +374,18 @@ class CloneTests(CLIBaseTest):
         src_url = "/origin/url"
         CLI().main(['progname', 'clone', src_url])
 
-        self.mock_clone_repo.assert_called_once_with(src=src_url, dest=self.cwd)
+        self.mock_clone_repo.assert_called_once_with(src=src_url, dest=self.cwd,
+                                                     verify=False, mode=None,
+                                                     jobs=None)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_clone_verify(self):
+        src_url = "/origin/url"
+        CLI().main(['progname', 'clone', '--verify', src_url])
+
+        self.mock_clone_repo.assert_called_once_with(src=src_url, dest=self.cwd,
+                                                     verify=True, mode=None,
+                                                     jobs=None)
         self.mock_sys_exit.assert_called_once_with(0)
 
 
@@ -227,7 +397,40 @@ class BackupTests(CLIBaseTest):
 
         self.mock_load_repo.assert_called_once_with(self.cwd)
         repo = self.mock_load_repo.return_value
-        self.mock_backup_repo.assert_called_once_with(repo, backup_url)
+        self.mock_backup_repo.assert_called_once_with(repo, backup_url,
+                                                      verify=False, mode=None,
+                                                      jobs=None)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_backup_verify(self):
+        backup_url = '/backup/url'
+        CLI().main(['progname', 'backup', '--verify', backup_url])
+
+        repo = self.mock_load_repo.return_value
+        self.mock_backup_repo.assert_called_once_with(repo, backup_url,
+                                                      verify=True, mode=None,
+                                                      jobs=None)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_backup_mode(self):
+        backup_url = '/backup/url'
+        CLI().main(['progname', 'backup', '--mode', 'reflink', backup_url])
+
+        repo = self.mock_load_repo.return_value
+        self.mock_backup_repo.assert_called_once_with(repo, backup_url,
+                                                      verify=False,
+                                                      mode='reflink',
+                                                      jobs=None)
+        self.mock_sys_exit.assert_called_once_with(0)
+
+    def test_backup_jobs(self):
+        backup_url = 'ssh://host/backup/url'
+        CLI().main(['progname', 'backup', '--jobs', '4', backup_url])
+
+        repo = self.mock_load_repo.return_value
+        self.mock_backup_repo.assert_called_once_with(repo, backup_url,
+                                                      verify=False, mode=None,
+                                                      jobs=4)
         self.mock_sys_exit.assert_called_once_with(0)
 
     def test_backup_to_many(self):
@@ -236,7 +439,9 @@ class BackupTests(CLIBaseTest):
 
         self.mock_load_repo.assert_called_once_with(self.cwd)
         repo = self.mock_load_repo.return_value
-        self.mock_backup_repo.assert_called_once_with(repo, *backup_urls)
+        self.mock_backup_repo.assert_called_once_with(repo, *backup_urls,
+                                                      verify=False, mode=None,
+                                                      jobs=None)
         self.mock_sys_exit.assert_called_once_with(0)
 
     @unittest.skip("not implemented yet")
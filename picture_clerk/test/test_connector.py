@@ -6,11 +6,19 @@
 """
 import unittest
 import mock
+import hashlib
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
+import errno
 
 from urlparse import urlparse
 
-from connector import Connector
-from connector import NotConnectedError
+from connector import Connector, LocalConnector, SSHConnector
+from connector import NotConnectedError, ChecksumMismatchError
+from connector import CMD_MKDIR, CMD_REMOVE, CMD_STATUS, _parse_sum_line
 
 
 class TestConnector(Connector):
@@ -20,6 +28,8 @@ class TestConnector(Connector):
     _exists = None
     _mkdir = None
     _remove = None
+    _rename = None
+    _stat = None
 
     def setup(self):
         self._connect = mock.Mock()
@@ -27,12 +37,15 @@ class TestConnector(Connector):
         self._exists = mock.Mock()
         self._mkdir = mock.Mock()
         self._remove = mock.Mock()
+        self._rename = mock.Mock()
+        self._stat = mock.Mock()
 
         # make sure that _open returns a (mocked) context manager
         mock_cm = mock.Mock()
         mock_cm.__enter__ = mock.Mock()
         mock_cm.__exit__ = mock.Mock()
         mock_cm.__exit__.return_value = False
+        mock_cm.__enter__.return_value = StringIO.StringIO()
         self._open = mock.Mock(return_value=mock_cm)
 
     def __init__(self, url):
@@ -133,6 +146,17 @@ class ConnectorMkdirTest(unittest.TestCase):
         self.assertRaises(NotConnectedError, self.tc.mkdir, 'path', 755)
         self.assertFalse(self.tc._mkdir.called)
 
+    def testMkdirMany(self):
+        """mkdir_many() should create missing parents first, once."""
+        self.tc.connect()
+        self.tc._exists.side_effect = lambda path: path == 'testurl/a'
+        self.tc.mkdir_many(['a/b/c', 'a/b/d', 'a', 'e'], 0700)
+        self.assertEqual(self.tc._mkdir.call_args_list,
+                         [mock.call('testurl/e', 0700),
+                          mock.call('testurl/a/b', 0700),
+                          mock.call('testurl/a/b/c', 0700),
+                          mock.call('testurl/a/b/d', 0700)])
+
 
 class ConnectorRemoveTest(unittest.TestCase):
 
@@ -145,6 +169,51 @@ class ConnectorRemoveTest(unittest.TestCase):
         self.assertRaises(NotConnectedError, self.tc.remove, 'path')
         self.assertFalse(self.tc._mkdir.called)
 
+    def testRemoveMany(self):
+        """remove_many() should skip missing files & raise other errors."""
+        self.tc.connect()
+        self.tc._remove.side_effect = [OSError(errno.ENOENT, 'missing'), None,
+                                       OSError(errno.EACCES, 'denied')]
+        self.assertRaises(OSError, self.tc.remove_many, ['a', 'b', 'c'])
+        self.assertEqual(self.tc._remove.call_count, 3)
+
+
+class ConnectorRenameTest(unittest.TestCase):
+
+    def setUp(self):
+        url = urlparse("testurl")
+        self.tc = TestConnector(url)
+
+    def testRenameFail(self):
+        """rename() should raise NotConnectedError if !isconnected."""
+        self.assertRaises(NotConnectedError, self.tc.rename, 'a', 'b')
+        self.assertFalse(self.tc._rename.called)
+
+    def testRename(self):
+        """rename() should pass absolute paths to _rename."""
+        self.tc.connect()
+        self.tc.rename('a', 'b')
+        self.tc._rename.assert_called_once_with(self.tc._rel2abs('a'),
+                                                self.tc._rel2abs('b'))
+
+
+class ConnectorStatTest(unittest.TestCase):
+
+    def setUp(self):
+        url = urlparse("testurl")
+        self.tc = TestConnector(url)
+
+    def testStatFail(self):
+        """stat() should raise NotConnectedError if !isconnected."""
+        self.assertRaises(NotConnectedError, self.tc.stat, 'path')
+        self.assertFalse(self.tc._stat.called)
+
+    def testStat(self):
+        """stat() should pass absolute path to _stat."""
+        self.tc.connect()
+        self.tc.stat('path')
+        self.tc._stat.assert_called_once_with(self.tc._rel2abs('path'))
+
 
 class ConnectorCopyTest(unittest.TestCase):
 
@@ -181,8 +250,329 @@ class ConnectorCopyTest(unittest.TestCase):
 
         src_abspath = self.src_tc._rel2abs('src_path')
         dest_abspath = self.dest_tc._rel2abs('dest_path')
-        self.src_tc._open.assert_called_once_with(src_abspath, 'r')
-        self.dest_tc._open.assert_called_once_with(dest_abspath, 'w')
+        self.src_tc._open.assert_called_once_with(src_abspath, 'rb')
+        self.dest_tc._open.assert_called_once_with(dest_abspath, 'wb')
+
+    def set_src_content(self, content):
+        self.src_tc._open.return_value.__enter__.return_value = \
+            StringIO.StringIO(content)
+
+    def testCopyChecksum(self):
+        """copy() should verify checksums of the copied data."""
+        self.set_src_content('picture data')
+        checksums = {'sha1': hashlib.sha1('picture data').hexdigest()}
+        self.src_tc.copy('src_path', self.dest_tc, 'dest_path',
+                         checksums=checksums)
+
+        self.assertFalse(self.dest_tc._remove.called)
+
+    def testCopyChecksumMismatch(self):
+        """copy() should raise ChecksumMismatchError & remove destination."""
+        self.set_src_content('corrupted picture data')
+        checksums = {'sha1': hashlib.sha1('picture data').hexdigest()}
+        self.assertRaises(ChecksumMismatchError, self.src_tc.copy,
+                          'src_path', self.dest_tc, 'dest_path',
+                          checksums=checksums)
+
+        dest_abspath = self.dest_tc._rel2abs('dest_path')
+        self.dest_tc._remove.assert_called_once_with(dest_abspath)
+
+    def testCopyBuffers(self):
+        """copy() should write the chunks read to local files as they are."""
+        src = tempfile.TemporaryFile()
+        src.write('picture data')
+        src.seek(0)
+        self.src_tc._open.return_value.__enter__.return_value = src
+        dest = mock.MagicMock(spec=file)
+        self.dest_tc._open.return_value.__enter__.return_value = dest
+        self.src_tc.copy('src_path', self.dest_tc, 'dest_path')
+
+        (chunk,) = dest.write.call_args[0]
+        self.assertIsInstance(chunk, buffer)
+        self.assertEqual(str(chunk), 'picture data')
+
+    def testCopyVerify(self):
+        """copy() should read back destination if verify is set."""
+        self.set_src_content('picture data')
+        written = StringIO.StringIO('garbage')
+        self.dest_tc._open.return_value.__enter__.return_value = written
+        written.write = mock.Mock()     # simulate lost writes
+
+        self.assertRaises(ChecksumMismatchError, self.src_tc.copy,
+                          'src_path', self.dest_tc, 'dest_path', verify=True)
+
+        dest_abspath = self.dest_tc._rel2abs('dest_path')
+        self.dest_tc._open.assert_called_with(dest_abspath, 'rb')
+
+
+class LocalConnectorCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="pic")
+        self.src = LocalConnector.from_string(self.tempdir)
+        self.dest = LocalConnector.from_string(os.path.join(self.tempdir,
+                                                            'dest'))
+        os.mkdir(os.path.join(self.tempdir, 'dest'))
+        self.data = os.urandom(3 * 1024 ** 2 + 17)
+        with open(os.path.join(self.tempdir, 'src_path'), 'wb') as fh:
+            fh.write(self.data)
+        self.checksums = {'sha1': hashlib.sha1(self.data).hexdigest()}
+        self.src.connect()
+        self.dest.connect()
+
+    def tearDown(self):
+        self.src.disconnect()
+        self.dest.disconnect()
+        shutil.rmtree(self.tempdir)
+
+    def read_dest(self, path):
+        with open(os.path.join(self.tempdir, 'dest', path), 'rb') as fh:
+            return fh.read()
+
+    def testCopyModes(self):
+        """copy() should produce identical files in all modes."""
+        for mode in ('copy', 'fast', 'reflink', 'hardlink'):
+            dest_path = os.path.join(mode, 'subdir', 'dest_path')
+            self.src.copy('src_path', self.dest, dest_path,
+                          create_parents=True, checksums=self.checksums,
+                          verify=True, mode=mode)
+            self.assertEqual(self.read_dest(dest_path), self.data, mode)
+
+    def testHardlink(self):
+        """copy() in hardlink mode should link destination to source."""
+        self.src.copy('src_path', self.dest, 'dest_path',
+                      create_parents=True, mode='hardlink')
+        src_stat = self.src.stat('src_path')
+        dest_stat = self.dest.stat('dest_path')
+        self.assertEqual(src_stat.st_ino, dest_stat.st_ino)
+
+    def testUnknownMode(self):
+        """copy() should raise ValueError for unknown modes."""
+        self.assertRaises(ValueError, self.src.copy, 'src_path', self.dest,
+                          'dest_path', mode='teleport')
+
+
+@mock.patch('connector.paramiko')
+class SSHConnectorChannelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = SSHConnector(urlparse('ssh://user@host/path'))
+
+    def testChannelPerThread(self, mock_paramiko):
+        """Every thread should get its own SFTP channel."""
+        mock_paramiko.SFTPClient.from_transport.side_effect = \
+            lambda *args, **kwargs: mock.Mock()
+        self.conn.connect()
+        sftps = [self.conn._sftp]
+        thread = threading.Thread(target=lambda: sftps.append(self.conn._sftp))
+        thread.start()
+        thread.join()
+        self.assertIs(self.conn._sftp, sftps[0])
+        self.assertIsNot(sftps[1], sftps[0])
+
+        self.conn.disconnect()
+        for sftp in sftps:
+            sftp.close.assert_called_once_with()
+
+    def testPrefetchAndPipelining(self, mock_paramiko):
+        """Reads should be prefetched and writes pipelined."""
+        self.conn.connect()
+        sftp = mock_paramiko.SFTPClient.from_transport.return_value
+        self.conn.open('foo', 'rb')
+        sftp.open.return_value.prefetch.assert_called_once_with()
+        self.conn.open('foo', 'wb')
+        sftp.open.return_value.set_pipelined.assert_called_once_with(True)
+
+
+@mock.patch('connector.paramiko')
+class SSHConnectorCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = SSHConnector(urlparse('ssh://user@host/path'))
+        self.requests = []
+        self.errors = {}    # request path -> errno of reply
+
+    def connect(self, mock_paramiko, entries=()):
+        self.conn.connect()
+        sftp = mock_paramiko.SFTPClient.from_transport.return_value
+        def listdir_attr(path):
+            if path != '/path':
+                raise IOError(errno.ENOENT, 'missing')
+            return [mock.Mock(filename=entry) for entry in entries]
+        sftp.listdir_attr.side_effect = listdir_attr
+        sftp._async_request.side_effect = self.async_request
+        sftp._read_response.side_effect = self.read_response
+        sftp._convert_status.side_effect = self.convert_status
+        return sftp
+
+    def async_request(self, replies, t, path, *args):
+        self.requests.append((replies, t, path))
+        return len(self.requests) - 1
+
+    def read_response(self):
+        for num, (replies, t, path) in enumerate(self.requests):
+            if num not in replies:
+                replies._async_response(CMD_STATUS, path, num)
+                return
+
+    def convert_status(self, path):
+        if path in self.errors:
+            raise IOError(self.errors[path], os.strerror(self.errors[path]))
+
+    def testListParentOnce(self, mock_paramiko):
+        """exists() should list parent dir once for all its entries."""
+        sftp = self.connect(mock_paramiko, entries=['a', 'b'])
+        self.assertTrue(self.conn.exists('a'))
+        self.assertTrue(self.conn.exists('b'))
+        self.assertFalse(self.conn.exists('c'))
+        sftp.listdir_attr.assert_called_once_with('/path')
+        self.assertFalse(sftp.stat.called)
+
+    def testMissingParent(self, mock_paramiko):
+        """Paths in a missing directory shouldn't be looked up."""
+        sftp = self.connect(mock_paramiko)
+        self.assertFalse(self.conn.exists('x/y'))
+        self.assertFalse(self.conn.exists('x/z'))
+        sftp.listdir_attr.assert_called_once_with('/path/x')
+
+    def testStatAfterWrite(self, mock_paramiko):
+        """Written files should exist and be stat'ed again."""
+        sftp = self.connect(mock_paramiko)
+        self.assertFalse(self.conn.exists('f'))
+        self.conn.open('f', 'wb')
+        self.assertTrue(self.conn.exists('f'))
+        self.assertIs(self.conn.stat('f'), sftp.stat.return_value)
+        sftp.stat.assert_called_once_with('/path/f')
+
+    def testCacheClearedOnDisconnect(self, mock_paramiko):
+        """Cached attributes should only be used during a connection."""
+        sftp = self.connect(mock_paramiko, entries=['a'])
+        self.conn.exists('a')
+        self.conn.disconnect()
+        self.conn.connect()
+        self.conn.exists('a')
+        self.assertEqual(sftp.listdir_attr.call_count, 2)
+
+    def testPipelinedMkdir(self, mock_paramiko):
+        """mkdir_many() should send all requests of a depth at once."""
+        sftp = self.connect(mock_paramiko)
+        self.conn.mkdir_many(['a/b', 'c'])
+        self.assertEqual([(t, path) for _, t, path in self.requests],
+                         [(CMD_MKDIR, '/path/a'), (CMD_MKDIR, '/path/c'),
+                          (CMD_MKDIR, '/path/a/b')])
+        self.assertIs(self.requests[0][0], self.requests[1][0])
+        listings = sftp.listdir_attr.call_count
+        self.assertTrue(self.conn.exists('a/b'))
+        self.assertFalse(self.conn.exists('a/b/c'))
+        self.assertEqual(sftp.listdir_attr.call_count, listings)
+
+    def testPipelinedMkdirError(self, mock_paramiko):
+        """mkdir_many() should raise errors replied by the server."""
+        self.connect(mock_paramiko)
+        self.errors['/path/c'] = errno.EACCES
+        self.assertRaises(IOError, self.conn.mkdir_many, ['a', 'c'])
+        self.assertTrue(self.conn.exists('a'))
+        self.assertFalse(self.conn.exists('c'))
+
+    def testPipelinedRemove(self, mock_paramiko):
+        """remove_many() should skip missing files."""
+        self.connect(mock_paramiko, entries=['a', 'b'])
+        self.errors['/path/b'] = errno.ENOENT
+        self.conn.remove_many(['a', 'b'])
+        self.assertEqual([(t, path) for _, t, path in self.requests],
+                         [(CMD_REMOVE, '/path/a'), (CMD_REMOVE, '/path/b')])
+        self.assertFalse(self.conn.exists('a'))
+        self.assertFalse(self.conn.exists('b'))
+
+
+@mock.patch('connector.paramiko')
+class SSHConnectorDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = SSHConnector(urlparse('ssh://user@host/my path'))
+        self.data = {'a': 'foo', 'b/c': 'bar'}
+
+    def exec_command(self, output, status=0):
+        """Make remote commands print output and exit with status."""
+        stdin = mock.Mock()
+        stdout = StringIO.StringIO(output)
+        stdout.channel = mock.Mock()
+        stdout.channel.recv_exit_status.return_value = status
+        stderr = StringIO.StringIO()
+        self.conn._ssh.exec_command.return_value = (stdin, stdout, stderr)
+        return stdin
+
+    def sha1sum(self, *fnames):
+        return ''.join('%s  %s\n' % (hashlib.sha1(self.data[f]).hexdigest(), f)
+                       for f in fnames)
+
+    def testRemoteDigests(self, mock_paramiko):
+        """iter_digests() should run sha1sum on the remote host."""
+        self.conn.connect()
+        stdin = self.exec_command(self.sha1sum('b/c', 'a'), status=123)
+
+        digests = dict(self.conn.iter_digests(['a', 'b/c', 'missing'], 'sha1'))
+
+        self.assertEqual(digests, {'a': hashlib.sha1('foo').hexdigest(),
+                                   'b/c': hashlib.sha1('bar').hexdigest(),
+                                   'missing': None})
+        self.conn._ssh.exec_command.assert_called_once_with(
+            "cd '/my path' || exit 100; xargs -0 sha1sum --")
+        stdin.write.assert_called_once_with('a\0b/c\0missing')
+        stdin.channel.shutdown_write.assert_called_once_with()
+
+    def testStderrDrained(self, mock_paramiko):
+        """iter_digests() should read stderr while reading stdout."""
+        self.conn.connect()
+        self.exec_command('')
+        drained = threading.Event()
+        stdout = mock.MagicMock()
+        stdout.__iter__.side_effect = lambda: iter(
+                        [self.sha1sum('a')] if drained.wait(5) else [])
+        stderr = mock.MagicMock()
+        stderr.__iter__.side_effect = lambda: drained.set() or iter(['error'])
+        self.conn._ssh.exec_command.return_value = (mock.Mock(), stdout,
+                                                    stderr)
+
+        digests = list(self.conn.iter_digests(['a'], 'sha1'))
+
+        self.assertEqual(digests, [('a', hashlib.sha1('foo').hexdigest())])
+
+    def testCommandNotFound(self, mock_paramiko):
+        """iter_digests() should hash locally if the command is missing."""
+        self.conn.connect()
+        self.exec_command('', status=127)
+        with mock.patch.object(Connector, 'iter_digests',
+                               return_value=iter([('a', 'local')])) as m:
+            digests = list(self.conn.iter_digests(['a'], 'sha1'))
+        self.assertEqual(digests, [('a', 'local')])
+        m.assert_called_once_with(self.conn, ['a'], 'sha1', mock.ANY)
+
+    def testCdFailed(self, mock_paramiko):
+        """iter_digests() should hash locally if the path can't be entered."""
+        self.conn.connect()
+        self.exec_command('', status=100)
+        with mock.patch.object(Connector, 'iter_digests',
+                               return_value=iter([('a', 'local')])) as m:
+            digests = list(self.conn.iter_digests(['a'], 'sha1'))
+        self.assertEqual(digests, [('a', 'local')])
+        m.assert_called_once_with(self.conn, ['a'], 'sha1', mock.ANY)
+
+    def testLocalAlgorithm(self, mock_paramiko):
+        """Algorithms without remote command should be calculated locally."""
+        self.conn.connect()
+        with mock.patch.object(Connector, 'iter_digests',
+                               return_value=iter([])) as m:
+            list(self.conn.iter_digests(['a'], 'crc32'))
+        self.assertFalse(self.conn._ssh.exec_command.called)
+        m.assert_called_once_with(self.conn, ['a'], 'crc32', mock.ANY)
+
+    def testParseSumLine(self, mock_paramiko):
+        """_parse_sum_line() should unescape special file names."""
+        self.assertEqual(_parse_sum_line('abc  a b\n'), ('a b', 'abc'))
+        self.assertEqual(_parse_sum_line('abc *bin\n'), ('bin', 'abc'))
+        self.assertEqual(_parse_sum_line('\\abc  x\\\\y\\nz\n'),
+                         ('x\\y\nz', 'abc'))
 
 
 if __name__ == "__main__":
@@ -5,12 +5,18 @@
 
 """
 import unittest
+import mock
 
 import copy
+import cPickle as pickle
 import hashlib
 import os
+import zlib
+import StringIO
+import tempfile
 
-from picture import get_sha1
+from picture import Picture, get_sha1, get_digests, iter_chunks
+from picture import cheapest_algorithm, strongest_algorithm
 
 
 class ChecksumTests(unittest.TestCase):
@@ -30,6 +36,85 @@ class ChecksumTests(unittest.TestCase):
         self.assertEqual(get_sha1(self.buf),
                          get_sha1(buf2))
 
+    def test_sha1_from_file(self):
+        with tempfile.TemporaryFile() as fh:
+            fh.write(self.buf)
+            fh.seek(0)
+            self.assertEqual(get_sha1(fh, chunk_size=1000),
+                             hashlib.sha1(self.buf).hexdigest())
+
+    def test_sha1_from_file_without_readinto(self):
+        fh = StringIO.StringIO(self.buf)
+        self.assertEqual(get_sha1(fh, chunk_size=1000),
+                         hashlib.sha1(self.buf).hexdigest())
+
+
+    def test_digests(self):
+        digests = get_digests(self.buf, ['sha1', 'sha256', 'crc32'])
+        self.assertEqual(digests['sha1'], hashlib.sha1(self.buf).hexdigest())
+        self.assertEqual(digests['sha256'],
+                         hashlib.sha256(self.buf).hexdigest())
+        self.assertEqual(digests['crc32'],
+                         '%08x' % (zlib.crc32(self.buf) & 0xffffffff))
+
+    def test_digests_single_read(self):
+        fh = mock.Mock(wraps=StringIO.StringIO(self.buf))
+        del fh.readinto
+        digests = get_digests(fh, ['md5', 'sha1', 'adler32'],
+                              chunk_size=len(self.buf))
+        self.assertEqual(fh.read.call_count, 2)  # data & EOF
+        self.assertEqual(digests['md5'], hashlib.md5(self.buf).hexdigest())
+
+    def test_unknown_algorithm(self):
+        self.assertRaises(ValueError, get_digests, self.buf, ['foo'])
+
+    def test_algorithm_selection(self):
+        algorithms = ['sha256', 'crc32', 'sha1']
+        self.assertEqual(cheapest_algorithm(algorithms), 'crc32')
+        self.assertEqual(strongest_algorithm(algorithms), 'sha256')
+        self.assertEqual(cheapest_algorithm([]), None)
+
+
+class PictureChecksumTests(unittest.TestCase):
+
+    def test_checksum_is_sha1(self):
+        pic = Picture('DSC_0001.NEF')
+        pic.checksum = 'abc'
+        self.assertEqual(pic.checksums, {'sha1': 'abc'})
+
+    def test_unpickle_legacy_checksum(self):
+        pic = Picture('DSC_0001.NEF')
+        state = pic.__dict__.copy()
+        del state['checksums']
+        state['checksum'] = 'abc'
+        legacy = Picture.__new__(Picture)
+        legacy.__setstate__(state)
+        self.assertEqual(legacy.checksum, 'abc')
+        self.assertNotIn('checksum', legacy.__dict__)
+
+    def test_buffer_not_pickled(self):
+        pic = Picture('DSC_0001.NEF')
+        pic.buffer = 'content'
+        pic.buffer_stat = (7, 0, None, None)
+        unpickled = pickle.loads(pickle.dumps(pic))
+        self.assertIsNone(unpickled.buffer)
+        self.assertIsNone(unpickled.buffer_stat)
+        self.assertEqual(pic.buffer, 'content')
+
+
+class ChunkTests(unittest.TestCase):
+
+    def test_chunk_sizes(self):
+        with tempfile.TemporaryFile() as fh:
+            fh.write('x' * 2500)
+            fh.seek(0)
+            sizes = [len(chunk) for chunk in iter_chunks(fh, chunk_size=1000)]
+        self.assertEqual(sizes, [1000, 1000, 500])
+
+    def test_empty_file(self):
+        with tempfile.TemporaryFile() as fh:
+            self.assertEqual(list(iter_chunks(fh)), [])
+
 
 if __name__ == "__main__":
     unittest.main()
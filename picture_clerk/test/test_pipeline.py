@@ -0,0 +1,1283 @@
+"""
+@author: Matthias Grueter <matthias@grueter.name>
+@copyright: Copyright (c) 2012 Matthias Grueter
+@license: GPL
+
+"""
+import unittest
+import mock
+import errno
+import hashlib
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import Queue
+
+from dispatcher import Dispatcher, put_unbounded, wait_interruptibly
+from eventloop import _Job
+import journal
+from journal import Journal
+from pipeline import Pipeline, MemoryGovernor, _parse_buffer_sizes
+from pipeline import _DeadLetters, _Join
+from recipe import Recipe
+from repo import new_repo_config
+from stage import Stage, ProcessStage
+from stats import Histogram, format_stats
+from picture import Picture, get_stat_key
+from worker import Worker, SubprocessWorker, AutorotWorker
+from worker import HashDigestWorker, LoadWorker, is_current
+
+from testlib import MockPicture
+
+
+class AppendWorker(Worker):
+    """Worker appending its name to the picture's metadata."""
+
+    name = 'AppendWorker'
+
+    def _work(self, picture, jobnr):
+        picture.metadata.setdefault('workers', []).append(self.name)
+        return True
+
+    def _compile_sidecar_path(self, picture):
+        return (picture.basename + '.append', 'Append')
+
+
+class SidecarCheckWorker(AppendWorker):
+    """Worker failing if the previous stage's sidecar is missing."""
+
+    name = 'SidecarCheckWorker'
+
+    def _work(self, picture, jobnr):
+        if picture.basename + '.append' not in picture.get_filenames():
+            return False
+        return AppendWorker._work(self, picture, jobnr)
+
+
+class FailingWorker(Worker):
+
+    name = 'FailingWorker'
+
+    def _work(self, picture, jobnr):
+        if jobnr % 2:
+            raise IOError("file not found")
+        return False
+
+
+class FlakyWorker(Worker):
+    """Worker failing with an I/O error the first failures times."""
+
+    name = 'FlakyWorker'
+    failures = 1
+    error = errno.EIO
+
+    def _work(self, picture, jobnr):
+        attempts = picture.metadata.setdefault('attempts', 0) + 1
+        picture.metadata['attempts'] = attempts
+        if attempts <= self.failures:
+            raise IOError(self.error, os.strerror(self.error))
+        return True
+
+
+class BlockingWorker(Worker):
+    """Worker blocking until the test releases it."""
+
+    name = 'BlockingWorker'
+    started = threading.Event()
+    release = threading.Event()
+
+    def _work(self, picture, jobnr):
+        self.started.set()
+        self.release.wait()
+        return True
+
+
+class SleepWorker(Worker):
+    """I/O-bound worker recording the peak number of workers in its stage."""
+
+    name = 'SleepWorker'
+    peak = 0
+
+    def _work(self, picture, jobnr):
+        SleepWorker.peak = max(SleepWorker.peak, len(self.pool.workers))
+        time.sleep(0.02)
+        return True
+
+
+class PidWorker(Worker):
+    """Worker recording the process it runs in."""
+
+    name = 'PidWorker'
+
+    def _work(self, picture, jobnr):
+        picture.metadata['pid'] = os.getpid()
+        picture.checksums['sha1'] = picture.basename
+        picture.add_sidecar(picture.basename + '.pid', 'PID')
+        return True
+
+    def _compile_sidecar_path(self, picture):
+        return (picture.basename + '.ran', 'Ran')
+
+
+class EchoWorker(SubprocessWorker):
+    """Batch worker reporting an error for files named 'bad...'."""
+
+    name = 'EchoWorker'
+    batchable = True
+    evented = False
+    runs = 0
+    script = ('import sys\n'
+              'bad = [f for f in sys.argv[1:] if f.startswith("bad")]\n'
+              'for f in sys.argv[1:]: print("%s: %s" % (f, f in bad))\n'
+              'sys.exit(1 if bad else 0)\n')
+
+    def _compile_commands(self, picture):
+        return [self._compile_batch_command([picture.filename])]
+
+    def _compile_batch_command(self, files):
+        return [sys.executable, '-c', self.script] + files
+
+    def _batch_files(self, picture):
+        return [picture.filename]
+
+    def _is_error_line(self, line):
+        return line.endswith('True')
+
+    def _execute(self, command, jobnr):
+        EchoWorker.runs += 1
+        return SubprocessWorker._execute(self, command, jobnr)
+
+
+class SlowSubprocessWorker(SubprocessWorker):
+    """Worker running a program sleeping for 10 seconds."""
+
+    name = 'SlowSubprocessWorker'
+    evented = False
+    started = threading.Event()
+
+    def _compile_commands(self, picture):
+        return [sys.executable, '-c', 'import time; time.sleep(10)'],
+
+    def _execute(self, command, jobnr):
+        self.started.set()
+        return SubprocessWorker._execute(self, command, jobnr)
+
+
+class SleepProgramWorker(SubprocessWorker):
+    """Worker running a program sleeping for a given number of seconds."""
+
+    name = 'SleepProgramWorker'
+    seconds = 0.5
+    program = sys.executable
+
+    def _compile_commands(self, picture):
+        return ([self.program, '-c', 'print("sleeping")'],
+                [self.program, '-c', 'import time; time.sleep(%f)'
+                                     % self.seconds])
+
+    def _compile_sidecar_path(self, picture):
+        return (picture.basename + '.slept', 'Slept')
+
+
+class BrokenSidecarWorker(SleepProgramWorker):
+    """Worker raising an exception when the job is finished."""
+
+    name = 'BrokenSidecarWorker'
+
+    def _compile_sidecar_path(self, picture):
+        raise ValueError('broken')
+
+
+class OrderWorker(Worker):
+    """Worker recording the order in which the stages do their jobs."""
+
+    name = 'OrderWorker'
+    jobs = []
+
+    def _work(self, picture, jobnr):
+        self.jobs.append((self.pool.seq_number, jobnr))
+        return True
+
+
+class BufferCheckWorker(Worker):
+    """Worker failing if the picture file wasn't loaded by LoadWorker."""
+
+    name = 'BufferCheckWorker'
+
+    def _work(self, picture, jobnr):
+        return picture.buffer == picture.filename
+
+
+class BufferedWorker(Worker):
+    """Worker recording whether it got the file loaded by LoadWorker."""
+
+    name = 'BufferedWorker'
+
+    def _work(self, picture, jobnr):
+        picture.metadata['buffered'] = picture.buffer is not None
+        return True
+
+
+class LeftWorker(Worker):
+    """Worker recording whether RightWorker works on a picture meanwhile."""
+
+    name = 'LeftWorker'
+    started = threading.Event()
+    other = 'RightWorker'
+
+    def _work(self, picture, jobnr):
+        self.started.set()
+        picture.metadata[self.name] = globals()[self.other].started.wait(1)
+        return True
+
+
+class RightWorker(LeftWorker):
+
+    name = 'RightWorker'
+    started = threading.Event()
+    other = 'LeftWorker'
+
+
+def new_pipeline(*worker_classes):
+    return Pipeline('TestPipeline', Recipe(list(worker_classes)), path='.')
+
+
+class PipelineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pics = MockPicture.create_many(20)
+
+    def test_join(self):
+        pl = new_pipeline(AppendWorker, SidecarCheckWorker)
+        for pic in self.pics:
+            pl.put(pic)
+        pl.start()
+        pl.join()
+
+        self.assertEqual(pl.output.qsize(), len(self.pics))
+        for pic in self.pics:
+            self.assertEqual(pic.metadata['workers'],
+                             ['AppendWorker', 'SidecarCheckWorker'])
+        for stage in pl.stages:
+            self.assertEqual(stage.workers, [])
+
+    def test_join_without_latency(self):
+        pl = new_pipeline(AppendWorker, AppendWorker, AppendWorker)
+        start = time.time()
+        pl.start()
+        pl.put(self.pics[0])
+        pl.join()
+
+        # the former polling loop added up to a second per stage
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(pl.output.qsize(), 1)
+
+    def test_failed_jobs_dont_block(self):
+        pl = new_pipeline(FailingWorker, AppendWorker)
+        for pic in self.pics:
+            pl.put(pic)
+        pl.start()
+        pl.join()
+
+        self.assertEqual(pl.output.qsize(), 0)
+        failures = pl.get_failures()
+        self.assertEqual(sorted(pic for (pic, _, _, _) in failures),
+                         sorted(self.pics))
+        for (pic, jobnr, stage, error) in failures:
+            self.assertEqual(stage, 'FailingWorker')
+            if jobnr % 2:
+                self.assertIsInstance(error, IOError)
+            else:   # _work returned False
+                self.assertIsNone(error)
+
+    def _run_flaky(self, failures, error=errno.EIO):
+        conf = {'pipeline.retries': 2, 'pipeline.retry_delay': 0.01}
+        pl = Pipeline('TestPipeline', Recipe([FlakyWorker]), path='.',
+                      conf=conf)
+        with mock.patch.multiple(FlakyWorker, failures=failures, error=error):
+            for pic in self.pics:
+                pl.put(pic)
+            pl.start()
+            pl.join()
+        return pl
+
+    def test_transient_error_retried(self):
+        pl = self._run_flaky(failures=2)
+
+        self.assertEqual(pl.output.qsize(), len(self.pics))
+        self.assertEqual(pl.get_failures(), [])
+        for pic in self.pics:
+            self.assertEqual(pic.metadata['attempts'], 3)
+
+    def test_retries_exhausted(self):
+        pl = self._run_flaky(failures=3)
+
+        self.assertEqual(pl.output.qsize(), 0)
+        self.assertEqual(len(pl.get_failures()), len(self.pics))
+        for (pic, jobnr, stage, error) in pl.get_failures():
+            self.assertEqual(pic.metadata['attempts'], 3)
+            self.assertEqual(error.errno, errno.EIO)
+
+    def test_permanent_error_not_retried(self):
+        pl = self._run_flaky(failures=1, error=errno.ENOENT)
+
+        self.assertEqual(len(pl.get_failures()), len(self.pics))
+        for pic in self.pics:
+            self.assertEqual(pic.metadata['attempts'], 1)
+
+    def test_dag(self):
+        LeftWorker.started.clear()
+        RightWorker.started.clear()
+        recipe = Recipe([AppendWorker, LeftWorker, RightWorker,
+                         SidecarCheckWorker], [[], [0], [0], [1, 2]])
+        pl = Pipeline('TestPipeline', recipe, path='.')
+        pl.start()
+        pl.put(self.pics[0])
+        pl.join()
+
+        self.assertEqual(pl.output.get()[0], self.pics[0])
+        self.assertTrue(pl.output.empty())
+        metadata = self.pics[0].metadata
+        # branches ran concurrently
+        self.assertTrue(metadata['LeftWorker'])
+        self.assertTrue(metadata['RightWorker'])
+        # joining stage ran after both branches
+        self.assertEqual(metadata['workers'],
+                         ['AppendWorker', 'SidecarCheckWorker'])
+        self.assertEqual(sorted(name for (name, t) in self.pics[0].history),
+                         ['AppendWorker', 'LeftWorker', 'RightWorker',
+                          'SidecarCheckWorker'])
+        self.assertEqual(self.pics[0].history[-1][0], 'SidecarCheckWorker')
+
+    def test_dag_many_pictures(self):
+        recipe = Recipe([AppendWorker, SleepWorker, SleepWorker,
+                         SidecarCheckWorker], [[], [0], [0], [1, 2]])
+        pl = Pipeline('TestPipeline', recipe, path='.')
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        pl.join()
+
+        done = [pl.output.get()[0] for pic in self.pics]
+        self.assertEqual(sorted(done), sorted(self.pics))
+        self.assertTrue(pl.output.empty())
+
+    def test_dag_branch_fails(self):
+        recipe = Recipe([AppendWorker, FailingWorker, AppendWorker],
+                        [[], [0], [0]])
+        pl = Pipeline('TestPipeline', recipe, path='.')
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        pl.join()
+
+        self.assertEqual(pl.output.qsize(), 0)
+        self.assertEqual(pl.get_stats()['stages'][2]['jobs'], len(self.pics))
+        # the arrivals of the other branch aren't kept
+        for join in pl.dead_letters.joins:
+            self.assertEqual(join._arrived, dict())
+
+    def test_join_drops_failed_jobs(self):
+        queue = Queue.Queue()
+        dead_letters = _DeadLetters()
+        join = _Join(queue, 2, failed=dead_letters)
+        dead_letters.joins = [join]
+        (pic_a, pic_b) = self.pics[:2]
+        # pic_a fails after the other branch is done, pic_b before
+        join.put((pic_a, 0))
+        dead_letters.put((pic_a, 0, 'FailingWorker', None))
+        dead_letters.put((pic_b, 1, 'FailingWorker', None))
+        join.put((pic_b, 1))
+
+        self.assertEqual(join._arrived, dict())
+        self.assertTrue(queue.empty())
+        self.assertEqual(dead_letters.qsize(), 2)
+
+    def test_bounded_buffers(self):
+        conf = {'pipeline.buffer_size': 1, 'pipeline.max_workers': 4}
+        pl = Pipeline('TestPipeline', Recipe([SleepWorker, AppendWorker]),
+                      path='.', conf=conf)
+        self.assertEqual([b.maxsize for b in pl.buffers], [1, 1, 0])
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        pl.join()
+
+        self.assertEqual(pl.output.qsize(), len(self.pics))
+        for stage in pl.stages:
+            self.assertEqual(stage.workers, [])
+
+    def test_stats(self):
+        pl = new_pipeline(AppendWorker, FailingWorker)
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        pl.join()
+        stats = pl.get_stats()
+
+        self.assertEqual(stats['jobs'], len(self.pics))
+        (append, failing) = stats['stages']
+        self.assertEqual(append['name'], 'AppendWorker')
+        self.assertEqual(append['jobs'], len(self.pics))
+        self.assertEqual(append['failures'], 0)
+        self.assertEqual(append['queue_wait']['count'], len(self.pics))
+        self.assertEqual(append['service_time']['count'], len(self.pics))
+        self.assertEqual(failing['jobs'], len(self.pics))
+        self.assertEqual(failing['failures'], len(self.pics))
+        self.assertGreater(append['idle'], 0)
+        self.assertIn('FailingWorker', format_stats(stats))
+
+    def test_buffer_sizes(self):
+        self.assertEqual(_parse_buffer_sizes(16, 3), [16, 16, 16])
+        self.assertEqual(_parse_buffer_sizes('32, 8', 3), [32, 8, 8])
+        self.assertEqual(_parse_buffer_sizes('4, 2, 1', 2), [4, 2])
+
+    def test_put_unbounded(self):
+        queue = Queue.Queue(1)
+        queue.put('job')
+        put_unbounded(queue, 'pill')
+        self.assertEqual([queue.get(), queue.get()], ['job', 'pill'])
+
+    def test_wait_interruptibly(self):
+        event = threading.Event()
+        timer = threading.Timer(0.2, event.set)
+        timer.start()
+        wait = mock.Mock(side_effect=time.sleep)
+        self.assertTrue(wait_interruptibly(wait, event.is_set))
+        # waited in steps
+        self.assertGreater(wait.call_count, 1)
+        self.assertFalse(wait_interruptibly(lambda timeout: None,
+                                            lambda: False, time.time() + 0.2))
+        self.assertTrue(wait_interruptibly(lambda timeout: True,
+                                           lambda: False))
+
+
+class LoadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pics = MockPicture.create_many(5)
+        for pic in self.pics:
+            with open(os.path.join(self.path, pic.filename), 'wb') as fh:
+                fh.write(pic.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_buffer_released_after_last_stage(self):
+        pl = Pipeline('TestPipeline',
+                      Recipe([LoadWorker, BufferCheckWorker, AppendWorker]),
+                      path=self.path)
+        for pic in self.pics:
+            pl.put(pic)
+        pl.start()
+        pl.join()
+
+        self.assertEqual(pl.output.qsize(), len(self.pics))
+        for pic in self.pics:
+            self.assertIsNone(pic.buffer)
+            self.assertIsNone(pic.buffer_stat)
+
+    def test_buffer_in_process_stage(self):
+        pl = Pipeline('TestPipeline',
+                      Recipe([LoadWorker, (BufferCheckWorker, 'process')]),
+                      path=self.path)
+        for pic in self.pics:
+            pl.put(pic)
+        pl.start()
+        pl.join()
+
+        self.assertEqual(pl.output.qsize(), len(self.pics))
+        self.assertEqual(pl.get_failures(), [])
+        for pic in self.pics:
+            self.assertIsNone(pic.buffer)
+
+    def test_process_stage_budget(self):
+        # room for a loaded file, not for the copies sent to the processes
+        budget = os.path.getsize(os.path.join(self.path,
+                                              self.pics[0].filename))
+        pl = Pipeline('TestPipeline',
+                      Recipe([LoadWorker, (BufferedWorker, 'process')]),
+                      path=self.path, conf={'pipeline.memory_budget': budget})
+        for pic in self.pics:
+            pl.put(pic)
+        pl.start()
+        pl.join()
+
+        self.assertEqual(pl.output.qsize(), len(self.pics))
+        self.assertEqual(pl.governor.in_flight, 0)
+        for pic in self.pics:
+            self.assertFalse(pic.metadata['buffered'])
+
+    def test_memory_budget(self):
+        pl = Pipeline('TestPipeline', Recipe([LoadWorker, BufferCheckWorker]),
+                      path=self.path, conf={'pipeline.memory_budget': 1})
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        pl.join()
+
+        self.assertEqual(pl.output.qsize(), len(self.pics))
+        self.assertEqual(pl.governor.in_flight, 0)
+
+    def test_hash_from_buffer(self):
+        pic = self.pics[0]
+        LoadWorker(None, None, 0, None, self.path)._work(pic, 0)
+        os.remove(os.path.join(self.path, pic.filename))
+        worker = HashDigestWorker(None, None, 0, None, self.path,
+                                  {'checksums.algorithms': 'md5'})
+        with mock.patch('worker.repo.SHA1_SIDECAR_ENABLED', 0):
+            self.assertTrue(worker._work(pic, 0))
+        self.assertEqual(pic.checksums['md5'],
+                         hashlib.md5(pic.filename).hexdigest())
+        self.assertEqual(pic.stat, pic.buffer_stat)
+
+
+class AbortTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pics = MockPicture.create_many(10)
+        SlowSubprocessWorker.started.clear()
+
+    def _start(self):
+        pl = new_pipeline(SlowSubprocessWorker, AppendWorker)
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        self.assertTrue(SlowSubprocessWorker.started.wait(5))
+        return pl
+
+    def _assert_aborted(self, pl):
+        self.assertEqual(pl.output.qsize(), 0)
+        self.assertEqual(pl.get_failures(), [])
+        for buf in pl.buffers:
+            self.assertEqual(buf.unfinished_tasks, 0)
+        for stage in pl.stages:
+            self.assertEqual(stage.workers, [])
+
+    def test_abort(self):
+        pl = self._start()
+        start = time.time()
+        pl.abort()
+
+        # the running program was killed
+        self.assertLess(time.time() - start, 1)
+        self._assert_aborted(pl)
+
+    def test_cancel_during_join(self):
+        pl = self._start()
+        start = time.time()
+        threading.Timer(0.1, pl.cancel).start()
+        pl.join()
+
+        self.assertLess(time.time() - start, 1)
+        self._assert_aborted(pl)
+
+    def test_flush(self):
+        pl = new_pipeline(AppendWorker)
+        for pic in self.pics:
+            pl.put(pic)
+
+        self.assertEqual(pl.flush(), len(self.pics))
+        self.assertEqual(pl.buffers[0].unfinished_tasks, 0)
+
+    def test_put_after_cancel(self):
+        pl = Pipeline('TestPipeline', Recipe([AppendWorker]), path='.',
+                      conf={'pipeline.buffer_size': 1})
+        pl.cancel()
+        for pic in self.pics:
+            pl.put(pic)     # doesn't block, although nobody takes the jobs
+
+        self.assertEqual(pl.buffers[0].qsize(), 0)
+
+
+class JournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = Journal(os.path.join(self.path, 'journal'))
+        self.pics = MockPicture.create_many(5)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_jobs_recorded(self):
+        pl = Pipeline('TestPipeline', Recipe([AppendWorker, FailingWorker]),
+                      path='.', journal=self.journal)
+        with self.journal:
+            for pic in self.pics:
+                pl.put(pic)
+            pl.start()
+            pl.join()
+
+        records = self.journal.replay()
+        self.assertEqual(sorted(records),
+                         sorted(pic.filename for pic in self.pics))
+        for pic in self.pics:
+            # failed jobs aren't recorded
+            (done, state) = records[pic.filename]
+            self.assertEqual(done, set(['AppendWorker']))
+            self.assertEqual(state['metadata'], dict(workers=['AppendWorker']))
+            self.assertIn([pic.basename + '.append', 'Append'],
+                          state['sidecars'])
+            self.assertEqual(state['history'][0][0], 'AppendWorker')
+
+    def test_resume(self):
+        pl = Pipeline('TestPipeline',
+                      Recipe([AppendWorker, SidecarCheckWorker]),
+                      path='.', journal=self.journal)
+        with self.journal:
+            for pic in self.pics:
+                # state restored from the journal of an interrupted run
+                pic.add_sidecar(pic.basename + '.append', 'Append')
+                pl.put(pic, done=['AppendWorker'])
+            pl.start()
+            pl.join()
+
+        for pic in self.pics:
+            # AppendWorker didn't work on the pictures again
+            self.assertEqual(pic.metadata,
+                             dict(workers=['SidecarCheckWorker']))
+            self.assertEqual([h[0] for h in pic.history],
+                             ['SidecarCheckWorker'])
+        for (done, state) in self.journal.replay().values():
+            self.assertEqual(done, set(['SidecarCheckWorker']))
+
+    def test_concurrent_branches(self):
+        pic = self.pics[0]
+        snapped = threading.Event()
+        recorded = threading.Event()
+        get_state = journal.get_state
+        def slow_get_state(picture):
+            state = get_state(picture)
+            if not snapped.is_set():
+                # the other branch applies its changes meanwhile
+                snapped.set()
+                recorded.wait(0.5)
+            return state
+        def hash_branch():
+            snapped.wait(5)
+            pic.checksums['sha1'] = 'digest'
+            self.journal.record(pic, 'HashDigestWorker')
+            recorded.set()
+        with self.journal:
+            with mock.patch('journal.get_state', side_effect=slow_get_state):
+                thread = threading.Thread(target=hash_branch)
+                thread.start()
+                self.journal.record(pic, 'ThumbWorker')
+                thread.join()
+
+        (done, state) = self.journal.replay()[pic.filename]
+        self.assertEqual(done, set(['HashDigestWorker', 'ThumbWorker']))
+        self.assertEqual(state['checksums'], dict(sha1='digest'))
+
+    def test_replay_ignores_corrupt_record(self):
+        with self.journal:
+            self.journal.record(self.pics[0], 'AppendWorker')
+        with open(self.journal.path, 'a') as fh:
+            fh.write('{"picture": "DSC_')    # interrupted while writing
+
+        records = self.journal.replay()
+        self.assertEqual(records.keys(), [self.pics[0].filename])
+
+    def test_replay_missing_journal(self):
+        self.assertEqual(self.journal.replay(), dict())
+
+    def test_clear(self):
+        with self.journal:
+            self.journal.record(self.pics[0], 'AppendWorker')
+        self.journal.clear()
+        self.assertFalse(os.path.exists(self.journal.path))
+        self.journal.clear()    # journal doesn't exist
+
+
+class StampTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.pics = MockPicture.create_many(3)
+        for pic in self.pics:
+            for fname in (pic.filename, pic.basename + '.append'):
+                with open(os.path.join(self.path, fname), 'wb') as fh:
+                    fh.write(pic.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _stat(self, pic):
+        return get_stat_key(os.stat(os.path.join(self.path, pic.filename)))
+
+    def test_jobs_stamped(self):
+        pl = Pipeline('TestPipeline', Recipe([LoadWorker, AppendWorker]),
+                      path=self.path)
+        for pic in self.pics:
+            pl.put(pic)
+        pl.start()
+        pl.join()
+
+        for pic in self.pics:
+            # LoadWorker has no results
+            self.assertEqual(pic.stages.keys(), ['AppendWorker'])
+            self.assertEqual(pic.stages['AppendWorker'],
+                             dict(source=list(self._stat(pic)), version=1,
+                                  params=dict(),
+                                  outputs=[pic.basename + '.append']))
+            self.assertTrue(is_current(AppendWorker, pic, self._stat(pic),
+                                       self.path, dict()))
+
+    def test_outdated(self):
+        pl = Pipeline('TestPipeline', Recipe([HashDigestWorker]),
+                      path=self.path, conf={'checksums.algorithms': 'md5'})
+        with mock.patch('worker.repo.SHA1_SIDECAR_ENABLED', 0):
+            for pic in self.pics:
+                pl.put(pic)
+            pl.start()
+            pl.join()
+        pic = self.pics[0]
+        stat = self._stat(pic)
+        conf = {'checksums.algorithms': 'md5'}
+        # sidecar isn't written if disabled
+        sidecar = os.path.join(self.path, pic.stages['HashDigestWorker']
+                                                    ['outputs'][0])
+        os.makedirs(os.path.dirname(sidecar))
+        open(sidecar, 'w').close()
+
+        self.assertTrue(is_current(HashDigestWorker, pic, stat, self.path,
+                                   conf))
+        self.assertFalse(is_current(HashDigestWorker, pic, stat, self.path,
+                                    {'checksums.algorithms': 'sha256'}))
+        self.assertFalse(is_current(HashDigestWorker, pic,
+                                    (stat[0] + 1,) + stat[1:], self.path,
+                                    conf))
+        self.assertFalse(is_current(AppendWorker, pic, stat, self.path, conf))
+        with mock.patch.object(HashDigestWorker, 'version', 2):
+            self.assertFalse(is_current(HashDigestWorker, pic, stat,
+                                        self.path, conf))
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for value in [0.003] * 90 + [0.3] * 10:
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(0.5), 0.005)
+        self.assertEqual(histogram.percentile(0.95), 0.3)
+        self.assertEqual(histogram.todict()['count'], 100)
+        self.assertAlmostEqual(histogram.todict()['mean'], 0.0327)
+
+    def test_empty(self):
+        self.assertIsNone(Histogram().percentile(0.5))
+        self.assertIsNone(Histogram().todict()['mean'])
+
+class MemoryGovernorTests(unittest.TestCase):
+
+    def test_block_until_released(self):
+        governor = MemoryGovernor(100)
+        governor.acquire(60)
+        threading.Timer(0.05, governor.release, (60,)).start()
+        start = time.time()
+        governor.acquire(60)
+        self.assertGreaterEqual(time.time() - start, 0.04)
+        self.assertEqual(governor.in_flight, 60)
+
+    def test_oversized(self):
+        governor = MemoryGovernor(100)
+        governor.acquire(1000)
+        self.assertEqual(governor.in_flight, 1000)
+
+    def test_no_block(self):
+        governor = MemoryGovernor(100)
+        self.assertTrue(governor.acquire(60, block=False))
+        self.assertFalse(governor.acquire(60, block=False))
+        self.assertEqual(governor.in_flight, 60)
+
+    def test_unlimited(self):
+        governor = MemoryGovernor(0)
+        governor.acquire(1000)
+        governor.acquire(1000)
+        self.assertEqual(governor.in_flight, 2000)
+
+
+class StageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.input = Queue.Queue()
+        self.output = Queue.Queue()
+        self.pics = MockPicture.create_many(5)
+
+    def new_stage(self, WorkerClass, num_workers):
+        return Stage('TestStage', WorkerClass, num_workers, self.input,
+                     self.output, 0, pipeline=None, path='.')
+
+    def test_stop_keeps_queued_jobs(self):
+        BlockingWorker.started.clear()
+        BlockingWorker.release.clear()
+        stage = self.new_stage(BlockingWorker, 1)
+        stage.start()
+        for jobnr, pic in enumerate(self.pics):
+            self.input.put((pic, jobnr))
+        BlockingWorker.started.wait()
+
+        threading.Timer(0.1, BlockingWorker.release.set).start()
+        stage.stop()
+
+        self.assertEqual(stage.workers, [])
+        self.assertEqual(self.output.qsize(), 1)
+        self.assertEqual([self.input.get()[0] for pic in self.pics[1:]],
+                         self.pics[1:])
+
+    def test_add_and_remove_workers(self):
+        stage = self.new_stage(AppendWorker, 2)
+        stage.start()
+        stage.add_worker()
+        self.assertEqual(len(stage.workers), 3)
+        stage.remove_worker()
+        stage.remove_worker()
+        stage.dispatcher.join()
+        self.assertEqual(len(stage.workers), 1)
+
+        for jobnr, pic in enumerate(self.pics):
+            self.input.put((pic, jobnr))
+        stage.join()
+        self.assertEqual(self.output.qsize(), len(self.pics))
+        self.assertEqual(stage.workers, [])
+
+    def test_grow_io_bound_stage(self):
+        SleepWorker.peak = 0
+        stage = Stage('TestStage', SleepWorker, 1, self.input, self.output, 0,
+                      pipeline=None, path='.', min_workers=1, max_workers=4)
+        for jobnr, pic in enumerate(MockPicture.create_many(40)):
+            self.input.put((pic, jobnr))
+        stage.start()
+        stage.join()
+
+        self.assertEqual(self.output.qsize(), 40)
+        self.assertGreater(SleepWorker.peak, 1)
+        self.assertLessEqual(SleepWorker.peak, 4)
+        self.assertEqual(stage.workers, [])
+
+    def test_process_stage(self):
+        stage = ProcessStage('TestStage', PidWorker, 2, self.input,
+                             self.output, 0, pipeline=None, path='.')
+        for jobnr, pic in enumerate(self.pics):
+            self.input.put((pic, jobnr))
+        stage.start()
+        stage.join()
+
+        self.assertEqual(self.output.qsize(), len(self.pics))
+        self.assertIsNone(stage.processes)
+        for pic in self.pics:
+            self.assertNotEqual(pic.metadata['pid'], os.getpid())
+            self.assertEqual(pic.checksum, pic.basename)
+            self.assertIn(pic.basename + '.pid', pic.get_filenames())
+            self.assertIn(pic.basename + '.ran', pic.get_filenames())
+            self.assertEqual(pic.history[-1][0], 'PidWorker')
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.input = Queue.Queue()
+        self.output = Queue.Queue()
+        EchoWorker.runs = 0
+
+    def run_stage(self, pics, **conf):
+        stage = Stage('TestStage', EchoWorker, 1, self.input, self.output, 0,
+                      pipeline=None, path='.', conf=conf)
+        for jobnr, pic in enumerate(pics):
+            self.input.put((pic, jobnr))
+        stage.start()
+        stage.join()
+        return [self.output.get()[0] for i in range(self.output.qsize())]
+
+    def test_batches(self):
+        pics = MockPicture.create_many(10)
+        done = self.run_stage(pics, **{'subprocess.batch_size': 4})
+        self.assertEqual(EchoWorker.runs, 3)
+        self.assertEqual(sorted(done), sorted(pics))
+        for pic in pics:
+            self.assertEqual(pic.history[-1][0], 'EchoWorker')
+
+    def test_failures_per_file(self):
+        good = MockPicture.create_many(3)
+        bad = [Picture('bad%i.NEF' % i) for i in range(2)]
+        done = self.run_stage(good + bad)
+        self.assertEqual(EchoWorker.runs, 1)
+        self.assertEqual(sorted(done), sorted(good))
+
+    def test_failures_whole_paths(self):
+        # the error line of bad0.NEF doesn't name d0.NEF
+        good = Picture('d0.NEF')
+        bad = Picture('bad0.NEF')
+        done = self.run_stage([good, bad])
+        self.assertEqual(EchoWorker.runs, 1)
+        self.assertEqual(done, [good])
+
+    def test_without_batches(self):
+        pics = MockPicture.create_many(3)
+        done = self.run_stage(pics, **{'subprocess.batch_size': 1})
+        self.assertEqual(EchoWorker.runs, 3)
+        self.assertEqual(sorted(done), sorted(pics))
+
+    def test_failures_without_batches(self):
+        good = MockPicture.create_many(3)
+        bad = [Picture('bad%i.NEF' % i) for i in range(2)]
+        done = self.run_stage(good + bad, **{'subprocess.batch_size': 1})
+        self.assertEqual(EchoWorker.runs, 5)
+        self.assertEqual(sorted(done), sorted(good))
+
+    def test_names_file(self):
+        worker = EchoWorker(None, None, 0, None, '.')
+        self.assertTrue(worker._names_file('a.NEF: failed', 'a.NEF'))
+        self.assertTrue(worker._names_file("can't read 'a b.NEF'", 'a b.NEF'))
+        self.assertFalse(worker._names_file('ba.NEF: failed', 'a.NEF'))
+        self.assertFalse(worker._names_file('a.NEF.xmp: failed', 'a.NEF'))
+
+    def test_autorot_skips_pictures_without_thumbnail(self):
+        worker = AutorotWorker(None, None, 0, None, '.')
+        self.assertEqual(worker._compile_commands(Picture('a.NEF')), ())
+        self.assertTrue(worker._work(Picture('a.NEF'), 0))
+        self.assertEqual(worker._work_batch([(Picture('a.NEF'), 0)]), [True])
+
+
+class RecipeTests(unittest.TestCase):
+
+    def test_from_string(self):
+        recipe = Recipe.fromString('HashDigestWorker, ThumbWorker:process')
+        self.assertEqual([cls.name for cls in recipe.stage_types],
+                         ['HashDigestWorker', 'ThumbWorker'])
+        self.assertEqual(recipe.stage_executors, ['thread', 'process'])
+
+    def test_dependencies_from_string(self):
+        recipe = Recipe.fromString('LoadWorker, HashDigestWorker after '
+                                   'LoadWorker, ThumbWorker after LoadWorker, '
+                                   'AutorotWorker, MetadataWorker:process '
+                                   'after HashDigestWorker+AutorotWorker')
+        self.assertEqual(recipe.stage_dependencies,
+                         [[], [0], [0], [2], [1, 3]])
+        self.assertEqual(recipe.stage_executors[4], 'process')
+
+    def test_linear_by_default(self):
+        recipe = Recipe([AppendWorker, AppendWorker, AppendWorker])
+        self.assertEqual(recipe.stage_dependencies, [[], [0], [1]])
+
+    def test_invalid_dependencies(self):
+        self.assertRaises(ValueError, Recipe, [AppendWorker, AppendWorker],
+                          [[1], []])
+        self.assertRaises(ValueError, Recipe, [AppendWorker], [[], []])
+        self.assertRaises(ValueError, Recipe.fromString,
+                          'LoadWorker, HashDigestWorker after ThumbWorker')
+
+    def test_start_dependency(self):
+        recipe = Recipe.fromString('LoadWorker, HashDigestWorker, '
+                                   'MetadataWorker after start')
+        self.assertEqual(recipe.stage_dependencies, [[], [0], []])
+
+    def test_default_recipe(self):
+        recipe = Recipe.fromString(new_repo_config()['recipes.default'])
+        self.assertEqual(recipe.stage_dependencies,
+                         [[], [0], [0], [2], [0]])
+
+    def test_unknown_executor(self):
+        self.assertRaises(ValueError, Recipe, [(AppendWorker, 'fiber')])
+
+    def test_process_stage_in_pipeline(self):
+        pl = Pipeline('TestPipeline',
+                      Recipe([AppendWorker, (PidWorker, 'process')]),
+                      path='.')
+        self.assertEqual([stage.__class__ for stage in pl.stages],
+                         [Stage, ProcessStage])
+
+    def test_processes_started_first(self):
+        threads = []
+        Pool = multiprocessing.Pool
+        def new_pool(*args):
+            threads.append(threading.active_count())
+            return Pool(*args)
+        pl = Pipeline('TestPipeline',
+                      Recipe([AppendWorker, (PidWorker, 'process')]),
+                      path='.')
+        before = threading.active_count()
+        with mock.patch('stage.multiprocessing.Pool', side_effect=new_pool):
+            pl.start()
+        pl.join()
+
+        self.assertEqual(threads, [before])
+
+    @mock.patch('stage.multiprocessing.cpu_count', return_value=2)
+    def test_shared_processes(self, mock_cpu_count):
+        pl = Pipeline('TestPipeline',
+                      Recipe([(AppendWorker, 'process'),
+                              (PidWorker, 'process')]),
+                      path='.', conf={'pipeline.max_workers': 4})
+        with mock.patch('stage.multiprocessing.Pool',
+                        wraps=multiprocessing.Pool) as mock_pool:
+            pl.start()
+            pics = MockPicture.create_many(3)
+            for pic in pics:
+                pl.put(pic)
+            pl.join()
+
+        # one process per CPU for both stages
+        mock_pool.assert_called_once_with(2)
+        self.assertEqual(pl.output.qsize(), len(pics))
+        self.assertIsNone(pl.processes)
+
+
+class SharedPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pics = MockPicture.create_many(10)
+
+    def _pipeline(self, instructions, **conf):
+        conf['pipeline.engine'] = 'shared'
+        return Pipeline('TestPipeline', Recipe(instructions), path='.',
+                        conf=conf)
+
+    def test_shared_pool(self):
+        pl = self._pipeline([AppendWorker, SidecarCheckWorker,
+                             (PidWorker, 'process')],
+                            **{'pipeline.pool_size': 3})
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        pl.join()
+
+        self.assertEqual(pl.output.qsize(), len(self.pics))
+        for pic in self.pics:
+            self.assertEqual(pic.metadata['workers'],
+                             ['AppendWorker', 'SidecarCheckWorker'])
+            self.assertNotEqual(pic.metadata['pid'], os.getpid())
+        for stage in pl.stages:
+            self.assertEqual(stage.workers, [])
+            self.assertEqual(stage.stats.jobs, len(self.pics))
+        self.assertEqual(pl.pool.threads, [])
+
+    def test_downstream_first(self):
+        OrderWorker.jobs = []
+        pl = self._pipeline([OrderWorker, OrderWorker],
+                            **{'pipeline.pool_size': 1})
+        for pic in self.pics[:3]:
+            pl.put(pic)
+        pl.start()
+        pl.join()
+
+        # a picture is finished before the next one is started
+        self.assertEqual(OrderWorker.jobs,
+                         [(0, 1), (1, 1), (0, 2), (1, 2), (0, 3), (1, 3)])
+
+    def test_abort(self):
+        SlowSubprocessWorker.started.clear()
+        pl = self._pipeline([SlowSubprocessWorker, AppendWorker])
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        self.assertTrue(SlowSubprocessWorker.started.wait(5))
+        start = time.time()
+        pl.abort()
+
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(pl.output.qsize(), 0)
+        self.assertEqual(pl.pool.threads, [])
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, Pipeline, 'TestPipeline',
+                          Recipe([AppendWorker]), '.',
+                          {'pipeline.engine': 'foo'})
+
+
+class EventLoopTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pics = MockPicture.create_many(10)
+        SleepProgramWorker.seconds = 0.5
+        SleepProgramWorker.program = sys.executable
+
+    def _pipeline(self, instructions, **conf):
+        conf['pipeline.engine'] = 'events'
+        return Pipeline('TestPipeline', Recipe(instructions), path='.',
+                        conf=conf)
+
+    def test_event_loop(self):
+        pl = self._pipeline([AppendWorker, SleepProgramWorker,
+                             SidecarCheckWorker],
+                            **{'pipeline.pool_size': 1,
+                               'pipeline.max_subprocesses': 10})
+        start = time.time()
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        pl.join()
+
+        # the programs ran at the same time
+        self.assertLess(time.time() - start, 2.5)
+        self.assertEqual(pl.output.qsize(), len(self.pics))
+        for pic in self.pics:
+            self.assertEqual(pic.metadata['workers'],
+                             ['AppendWorker', 'SidecarCheckWorker'])
+            self.assertIn(pic.basename + '.slept',
+                          pic.get_sidecar_filenames())
+        self.assertEqual(pl.pool.stages, [pl.stages[0], pl.stages[2]])
+        self.assertEqual(pl.stages[1].stats.jobs, len(self.pics))
+        self.assertIsNone(pl.loop.thread)
+
+    def test_reaped_at_eof(self):
+        worker = mock.Mock(path='.')
+        worker.pool.cancelled = threading.Event()
+        worker._compile_commands.return_value = [[sys.executable, '-c',
+                                                  'print("done")']]
+        job = _Job(worker, self.pics[0], 0)
+        self.assertTrue(job.next_command())
+        while job.fd is not None:
+            job.read()
+
+        # finished without waiting for the loop's next poll
+        self.assertIsNotNone(job.process.returncode)
+        self.assertTrue(job.exited())
+
+    def test_max_subprocesses(self):
+        SleepProgramWorker.seconds = 0.2
+        pl = self._pipeline([SleepProgramWorker],
+                            **{'pipeline.max_subprocesses': 2})
+        start = time.time()
+        pl.start()
+        for pic in self.pics[:4]:
+            pl.put(pic)
+        pl.join()
+
+        self.assertGreaterEqual(time.time() - start, 0.4)
+        self.assertEqual(pl.output.qsize(), 4)
+
+    def test_failed_program(self):
+        SleepProgramWorker.program = '/nonexistent/program'
+        pl = self._pipeline([SleepProgramWorker, AppendWorker])
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        pl.join()
+
+        self.assertEqual(pl.output.qsize(), 0)
+        failures = pl.get_failures()
+        self.assertEqual(len(failures), len(self.pics))
+        self.assertEqual(set(f[2] for f in failures), {'SleepProgramWorker'})
+
+    def test_abort(self):
+        SleepProgramWorker.seconds = 10
+        pl = self._pipeline([SleepProgramWorker, AppendWorker])
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        while not pl.loop.jobs:
+            time.sleep(0.01)
+        start = time.time()
+        pl.abort()
+
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(pl.output.qsize(), 0)
+        self.assertEqual(pl.get_failures(), [])
+        self.assertIsNone(pl.loop.thread)
+
+    def _join(self, pl):
+        """Join pipeline, fail if that doesn't return within 10 sec."""
+        joining = threading.Thread(target=pl.join)
+        joining.start()
+        joining.join(10)
+        if joining.is_alive():
+            pl.abort()
+            self.fail("pipeline didn't finish")
+
+    def test_full_buffer(self):
+        SleepProgramWorker.seconds = 0.01
+        pl = self._pipeline([SleepProgramWorker, SleepProgramWorker],
+                            **{'pipeline.buffer_size': '64, 1',
+                               'pipeline.max_subprocesses': 10})
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        # the loop doesn't block on the second stage's full buffer
+        self._join(pl)
+
+        self.assertEqual(pl.output.qsize(), len(self.pics))
+        self.assertEqual(pl.loop.pending, [])
+
+    def test_full_buffer_fork(self):
+        SleepProgramWorker.seconds = 0.01
+        recipe = Recipe([SleepProgramWorker, BrokenSidecarWorker,
+                         AppendWorker], [[], [0], [0]])
+        pl = Pipeline('TestPipeline', recipe, path='.',
+                      conf={'pipeline.engine': 'events',
+                            'pipeline.buffer_size': 1})
+        pl.start()
+        for pic in self.pics:
+            pl.put(pic)
+        self._join(pl)
+
+        # the pictures failed in the broken stage, the others ran
+        self.assertEqual(pl.output.qsize(), 0)
+        failures = pl.get_failures()
+        self.assertEqual(len(failures), len(self.pics))
+        self.assertTrue(all(isinstance(f[3], ValueError) for f in failures))
+        self.assertEqual(pl.stages[2].stats.jobs, len(self.pics))
+
+    def test_not_evented(self):
+        pl = self._pipeline([AppendWorker, (PidWorker, 'process')])
+        self.assertIsNone(pl.loop)
+        self.assertEqual(len(pl.pool.stages), 2)
+
+
+class AutoscalingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = mock.Mock(min_workers=1, max_workers=4)
+        self.pool.name = 'TestStage'
+        self.dispatcher = Dispatcher(self.pool)
+        self.dispatcher.start_workers(2)
+
+    def test_grow(self):
+        self.pool.input.qsize.return_value = 10
+        self.dispatcher.job_done(0.01, 0.0)
+        self.pool.add_worker.assert_called_once_with()
+
+    def test_shrink(self):
+        self.pool.input.qsize.return_value = 0
+        self.dispatcher.job_done(0.01, 0.0)
+        self.pool.remove_worker.assert_called_once_with()
+
+    def test_bounds(self):
+        self.pool.max_workers = 2
+        self.pool.input.qsize.return_value = 10
+        self.dispatcher.job_done(0.01, 0.0)
+        self.pool.min_workers = 2
+        self.pool.input.qsize.return_value = 0
+        self.dispatcher.job_done(0.01, 0.0)
+        self.assertFalse(self.pool.add_worker.called)
+        self.assertFalse(self.pool.remove_worker.called)
+
+    @mock.patch('dispatcher.multiprocessing.cpu_count', return_value=2)
+    def test_cpu_bound(self, mock_cpu_count):
+        self.pool.input.qsize.return_value = 10
+        self.dispatcher.job_done(0.01, 0.01)
+        self.assertFalse(self.pool.add_worker.called)
+
+    def test_cooldown(self):
+        self.pool.input.qsize.return_value = 10
+        self.dispatcher.job_done(10, 0.0)
+        self.dispatcher.job_done(10, 0.0)
+        self.pool.add_worker.assert_called_once_with()
+
+    def test_no_scaling_after_stop(self):
+        self.pool.input = Queue.Queue()
+        self.dispatcher.stop_workers()
+        for i in range(10):
+            self.pool.input.put(i)
+        self.dispatcher.job_done(0.01, 0.0)
+        self.assertFalse(self.pool.add_worker.called)
+
+
+if __name__ == "__main__":
+    unittest.main()
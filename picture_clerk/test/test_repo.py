@@ -136,6 +136,18 @@ class SaveTests(unittest.TestCase):
         index_on_disk.read(self.connector.get_file('mock-index-path'))
         self.assertEqual(index_on_disk, self.pi)
         self.assertIsNot(index_on_disk, self.pi)
+        # written to a temporary file first
+        self.assertFalse(self.connector.opened('mock-index-path.tmp'))
+
+    def test_save_index_snapshot_to_disk(self):
+        r = Repo(self.pi, self.conf, self.connector)
+        snapshot = index.PictureIndex()
+        snapshot.add(MockPicture.create_many(2))
+        r.save_index_to_disk(snapshot)
+
+        index_on_disk = index.PictureIndex()
+        index_on_disk.read(self.connector.get_file('mock-index-path'))
+        self.assertEqual(index_on_disk, snapshot)
 
 
 class FactoryTests(unittest.TestCase):
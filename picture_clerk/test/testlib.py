@@ -5,8 +5,8 @@
 
 """
 
-import collections
 import hashlib
+import os
 import random
 import StringIO
 import sys
@@ -39,13 +39,24 @@ class MockFile(StringIO.StringIO):
         return self.buf
 
 
+class MockFiles(dict):
+    """Files of a MockConnector. Files never written contain their name."""
+
+    def __missing__(self, path):
+        buf = MockFile()
+        buf.write(os.path.basename(path))
+        buf.seek(0)
+        self[path] = buf
+        return buf
+
+
 class MockConnector(Connector):
 
     connectors = dict()
 
     def __init__(self, url):
         Connector.__init__(self, url)
-        self.buffers = collections.defaultdict(MockFile)
+        self.buffers = MockFiles()
         self.removed_files = []
 
     def _connect(self):
@@ -60,12 +71,23 @@ class MockConnector(Connector):
     def _mkdir(self, path, mode):
         pass
 
+    def _stat(self, path):
+        size = len(self.buffers[path].getvalue())
+        return os.stat_result((0100644, 0, 0, 1, 0, 0, size, 0, 0, 0))
+
     def _open(self, path, mode):
-        return self.buffers[path]
+        buf = self.buffers[path]
+        if 'w' in mode:
+            buf.seek(0)
+            buf.truncate()
+        return buf
 
     def _remove(self, path):
         self.removed_files.append(path)
 
+    def _rename(self, src_path, dest_path):
+        self.buffers[dest_path] = self.buffers.pop(src_path)
+
     def opened(self, rel_path):
         return self._rel2abs(rel_path) in self.buffers
 
@@ -86,6 +108,7 @@ class MockConnector(Connector):
 
 
 class MockPicture(Picture):
+    """Picture whose file content (see MockFiles) is its filename."""
 
     def __init__(self, filename):
         Picture.__init__(self, filename)
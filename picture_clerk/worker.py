@@ -4,21 +4,31 @@
 @license: GPL
 
 """
+import copy
+import errno
 import os
+import re
 import threading
-import Queue
 import subprocess
 import time
-import hashlib
 import pyexiv2
 import logging
+import multiprocessing
+import Queue
 
 import config
 import repo
 
+from dispatcher import STOP, thread_time
+from picture import Picture, get_digests, get_stat_key, parse_algorithms
+
 
 log = logging.getLogger('pic.worker')
 
+# error numbers of I/O errors that may go away if a job is retried
+TRANSIENT_ERRNOS = (errno.EAGAIN, errno.EINTR, errno.EIO, errno.EBUSY,
+                    errno.ETIMEDOUT, errno.ESTALE, errno.ENFILE, errno.EMFILE)
+
 
 #class WorkerState():
 #    IDLE = 0    # worker is waiting for jobs
@@ -27,10 +37,6 @@ log = logging.getLogger('pic.worker')
 
 # TODO: error/execption handling in thread class or outside?
 # TODO: unit tests
-# TODO: queue_timeout should be controlled by stage or pipleine resp. workertype
-# TODO: implement batch workers: they take several pictures from a queue and
-#       process in the same run due to better efficiency (typically subprocess
-#       workers to circumvent large process starting overhead).
 # TODO: _compile_sidecar_path in Worker and _compile_command in Subprocess class
 #       should return dictionaries insteaf of tuples
 # FIXME: all write to writable picture attributes has to be thread safe
@@ -43,17 +49,29 @@ class Worker(threading.Thread):
         outqueue (Queue.Queue)  :   queue into which worker puts finished jobs
         pool                    :   object to which worker belongs (i.e. Stage)
         path (string)           :   path in which the worker is to base its work
+        conf (Config or dict)   :   repository configuration (optional)
     """
 
     name = 'Worker'
-
-    def __init__(self, inqueue, outqueue, number, pool, path):
+    # jobs are run by an EventLoop if 'pipeline.engine' is 'events' (see
+    # SubprocessWorker)
+    evented = False
+    # jobs done are recorded in the pipeline's journal (see Journal) and
+    # stamped on the picture (see is_current)
+    journaled = True
+    # increment when the worker's results change, so they're made again
+    version = 1
+    # configuration options the worker's results depend on
+    params = ()
+
+    def __init__(self, inqueue, outqueue, number, pool, path, conf=None):
         threading.Thread.__init__(self)
         self.inqueue = inqueue
         self.outqueue = outqueue
         self.number = number
         self.pool = pool
         self.path = path
+        self.conf = conf if conf is not None else dict()
         self.logger = logging.getLogger("%s-%i" % (self.name, self.number))
 
     def _work(self, picture, jobnr):
@@ -77,37 +95,318 @@ class Worker(threading.Thread):
         self.logger.info("Thread %s starting up...", self.name)
 
         while True:
-            self.pool.wakeSignal.wait()
-            if not self.pool.isactive:
-                self.logger.info("Thread %s terminating. Bye bye.", self.name)
+            # block until the next job (or the poison pill) arrives
+            wait_start = time.time()
+            item = self.inqueue.get()
+            self.pool.stats.add_idle(time.time() - wait_start)
+            if item is STOP:
+                self._stop()
                 break
+            self.handle(item)
+
+    def handle(self, job):
+        """
+        Work on a job (picture, jobnr) taken from the input queue. Called by
+        run or, if the worker isn't started, by a SharedPool's thread.
+        """
+        (picture, jobnr) = job
+        if self._skip(picture, jobnr):
+            return
+        self.logger.debug("%s handling %s", self.name, picture.filename)
+        self.logger.info("%s starting job %i", self.name, jobnr)
+        start, cpu_start = time.time(), thread_time()
+        (success, error) = self._attempt(picture, jobnr)
+        self._job_done(start, cpu_start, [(picture, success)])
+        self._finish(picture, jobnr, success, error)
+
+    def _attempt(self, picture, jobnr):
+        """
+        Work on job, retrying it up to 'pipeline.retries' times if it fails
+        with a transient I/O error (see is_transient). The delay before a
+        retry starts at 'pipeline.retry_delay' seconds and doubles with every
+        retry. Return success & the exception raised by the last attempt.
+        """
+        retries = self.conf.get('pipeline.retries', config.STAGE_RETRIES)
+        delay = self.conf.get('pipeline.retry_delay', config.STAGE_RETRY_DELAY)
+        attempt = 0
+        while True:
             try:
-                # get next queue item, block for WORKER_TIMEOUT seconds if empty
-                (picture, jobnr) = self.inqueue.get(True, config.WORKER_TIMEOUT)
-            except Queue.Empty:
-                pass    # try again
+                return (self._work(picture, jobnr), None)
+            except Exception, e:
+                if attempt >= retries or not is_transient(e):
+                    self.logger.exception("%s, job %i raised an exception",
+                                          self.name, jobnr)
+                    return (False, e)
+            self.logger.warning("%s, job %i failed (%s), retrying in %.1f "
+                                "sec", self.name, jobnr, e, delay)
+            if self.pool.cancelled.wait(delay):
+                return (False, e)
+            delay *= 2
+            attempt += 1
+
+    def _stamp(self, picture, sidecar):
+        """
+        Record the inputs (picture file status, worker version & params) and
+        outputs (sidecar) of the job done in picture.stages (see is_current).
+        """
+        stat = picture.buffer_stat
+        if stat is None:
+            try:
+                stat = get_stat_key(os.stat(os.path.join(self.path,
+                                                         picture.filename)))
+            except OSError:
+                return  # job is done again next time
+        picture.stages[self.name] = dict(
+                source=list(stat),
+                version=self.version,
+                params=dict((key, self.conf.get(key)) for key in self.params),
+                outputs=[sidecar[0]] if sidecar else [])
+
+    def _skip(self, picture, jobnr):
+        """
+        Don't work on a job if the stage was cancelled (the job is dropped)
+        or if the job was already done before the pipeline was interrupted
+        (the picture is handed on to the next stage, see Pipeline.put).
+        Return True if the job was skipped.
+        """
+        if self.pool.cancelled.is_set():
+            self._release_buffer(picture)
+            self.inqueue.task_done()
+            return True
+        pipeline = self.pool.pipeline
+        if pipeline is None or not pipeline.is_done(jobnr, self.name):
+            return False
+        self.logger.info("%s, job %i already done", self.name, jobnr)
+        self.outqueue.put((picture, jobnr))
+        self.inqueue.task_done()
+        return True
 
-            else:
-                self.logger.info("%s loading %s...",
-                                 self.name, picture.filename)
-                self.logger.info("%s starting job %i", self.name, jobnr)
-                if self._work(picture, jobnr):
-                    self.logger.info("%s, job %i done", self.name, jobnr)
-                    self.outqueue.put((picture, jobnr))
-                    self.logger.info("%s done with %s",
-                                     self.name, picture.filename)
-                    # TODO: make history more useful: exact job performed, timestamp, etc.
-                    # FIXME: this has to be thread safe (it is now because a
-                    #        every picture is worked on by only one worker but if
-                    #        we introduce parallel stages or piplines then we have
-                    #        to fix this.)
-                    picture.history.append((self.name, time.ctime()))
-                    sidecar = self._compile_sidecar_path(picture)
-                    if sidecar:
-                        picture.add_sidecar(*sidecar)
-                    self.inqueue.task_done()
-                else:
-                    self.logger.error("%s, job %i failed!", self.name, jobnr)
+    def cancel(self):
+        """
+        Abort the job in progress if possible. Called by the stage when it's
+        aborted, override in derived classes.
+        """
+        pass
+
+    def _stop(self):
+        """Terminate after having taken the poison pill."""
+        self.inqueue.task_done()
+        self.logger.info("Thread %s terminating. Bye bye.", self.name)
+        self.pool.dispatcher.worker_stopped(self)
+
+    def _job_done(self, start, cpu_start, results):
+        """
+        Report the service & CPU time of jobs started together to the
+        dispatcher and record them in the stage's statistics.
+
+        Arguments:
+        start     -- time the jobs were started
+        cpu_start -- thread's CPU time when the jobs were started
+        results   -- list of (picture, success) tuples
+        """
+        service_time = (time.time() - start) / len(results)
+        cpu_time = thread_time()
+        if cpu_time is not None:
+            cpu_time = (cpu_time - cpu_start) / len(results)
+        for (picture, success) in results:
+            self.pool.dispatcher.job_done(service_time, cpu_time)
+            self.pool.stats.job_done(service_time, success,
+                                     self._job_bytes(picture))
+
+    def _job_bytes(self, picture):
+        """Return size of the picture file (0 if unknown)."""
+        stat = picture.buffer_stat or picture.stat
+        return stat[0] if stat else 0
+
+    def _release_buffer(self, picture):
+        """Release picture's loaded file content (see LoadWorker)."""
+        if self.pool.governor is not None:
+            self.pool.governor.release_buffer(picture)
+        else:
+            picture.release_buffer()
+
+    def _finish(self, picture, jobnr, success, error=None):
+        """
+        Hand picture of a successful job on to the next stage. Failed jobs
+        are put into the stage's dead letters together with the exception
+        that made them fail (if any).
+        """
+        if success:
+            self.logger.info("%s, job %i done", self.name, jobnr)
+            # update picture before handing it on to the next stage
+            # TODO: make history more useful: exact job performed, timestamp, etc.
+            picture.history.append((self.name, time.ctime()))
+            sidecar = self._compile_sidecar_path(picture)
+            if sidecar:
+                picture.add_sidecar(*sidecar)
+            if self.journaled:
+                self._stamp(picture, sidecar)
+                if self.pool.journal is not None:
+                    self.pool.journal.record(picture, self.name)
+            self.outqueue.put((picture, jobnr))
+            self.logger.info("%s done with %s",
+                             self.name, picture.filename)
+        else:
+            self.logger.error("%s, job %i failed!", self.name, jobnr)
+            # jobs aborted by cancelling the pipeline didn't fail
+            if self.pool.dead_letters is not None \
+                    and not self.pool.cancelled.is_set():
+                self.pool.dead_letters.put((picture, jobnr, self.name, error))
+        # the picture file's content is no longer needed once the job failed
+        # (pipelines release it when the picture leaves them, see _Join)
+        if not success or self.pool.pipeline is None:
+            self._release_buffer(picture)
+        # failed jobs are done as well, so that joining doesn't block
+        self.inqueue.task_done()
+
+
+class ProcessWorker(Worker):
+    """
+    ProcessWorker is a thread handing the jobs of its stage's worker class
+    (pool.WorkerClass) to the stage's pool of worker processes (pool.processes)
+    so that CPU-bound work isn't serialised on the GIL.
+
+    Only the picture's filename and the file's content loaded by LoadWorker
+    (if any) are shipped to the worker process. The copies of the content
+    count towards the pipeline's memory budget: if it's exhausted, the
+    process reads the file itself instead. The process runs the job on a
+    fresh Picture instance and returns the changes of its attributes
+    (checksums, metadata, sidecars, ...), which are then applied to the
+    picture in this process. Worker classes run by process stages must thus
+    not depend on other picture attributes set by previous stages.
+    """
+
+    def __init__(self, inqueue, outqueue, number, pool, path, conf=None):
+        Worker.__init__(self, inqueue, outqueue, number, pool, path, conf)
+        # worker instance (not started) providing the sidecar paths
+        self.delegate = pool.WorkerClass(None, None, number, None, path, conf)
+        self.name = self.delegate.name
+        self.journaled = self.delegate.journaled
+        self.version = self.delegate.version
+        self.params = self.delegate.params
+        self.logger = self.delegate.logger
+
+    def _work(self, picture, jobnr):
+        # may be released by a concurrent stage
+        (buf, stat) = (picture.buffer, picture.buffer_stat)
+        governor = self.pool.governor
+        # the pickled job & the process' copy of the content
+        charge = 2 * len(buf) if buf is not None and governor is not None \
+                 else 0
+        if charge and not governor.acquire(charge, block=False):
+            (buf, stat, charge) = (None, None, 0)
+        try:
+            result = self.pool.processes.apply_async(
+                                _run_job, (self.pool.WorkerClass,
+                                           picture.filename, jobnr,
+                                           self.path, self.conf, buf, stat))
+            while True:
+                try:
+                    (success, changes) = result.get(config.POLL_INTERVAL)
+                    break
+                except multiprocessing.TimeoutError:
+                    # the stage terminates the worker processes when aborted
+                    if self.pool.cancelled.is_set():
+                        return False
+        finally:
+            if charge:
+                governor.release(charge)
+        _apply_changes(picture, changes)
+        return success
+
+    def _compile_sidecar_path(self, picture):
+        return self.delegate._compile_sidecar_path(picture)
+
+
+def _run_job(WorkerClass, filename, jobnr, path, conf, buf=None, stat=None):
+    """
+    Run job in a worker process & return success and the picture's changes.
+    buf and stat are the picture file's content & status loaded by LoadWorker.
+    """
+    picture = Picture(filename)
+    (picture.buffer, picture.buffer_stat) = (buf, stat)
+    before = copy.deepcopy(picture.__dict__)
+    worker = WorkerClass(None, None, os.getpid(), None, path, conf)
+    success = worker._work(picture, jobnr)
+    # the buffer isn't sent back
+    changes = dict((key, value) for (key, value) in picture.__dict__.items()
+                   if key not in ('_sidecars', 'history', 'buffer',
+                                  'buffer_stat')
+                   and before.get(key) != value)
+    changes['sidecars'] = [(sidecar.path, sidecar.content_type)
+                           for sidecar in picture.list_sidecars()]
+    return (success, changes)
+
+
+def is_transient(error):
+    """Return True if a job failing with error may succeed if retried."""
+    return isinstance(error, EnvironmentError) and \
+           error.errno in TRANSIENT_ERRNOS
+
+def is_current(WorkerClass, picture, stat, path, conf):
+    """
+    Return True if the results of WorkerClass for picture are up to date,
+    i.e. the worker was done with the picture file having status stat (see
+    get_stat_key) by the same version of the worker with the same params and
+    the sidecar it made still exists in path.
+    """
+    stamp = picture.stages.get(WorkerClass.name)
+    if stamp is None:
+        return False
+    params = dict((key, conf.get(key)) for key in WorkerClass.params)
+    if list(stamp['source']) != list(stat) \
+            or stamp['version'] != WorkerClass.version \
+            or stamp['params'] != params:
+        return False
+    sidecars = picture.get_sidecar_filenames()
+    return all(output in sidecars
+               and os.path.exists(os.path.join(path, output))
+               for output in stamp['outputs'])
+
+def _apply_changes(picture, changes):
+    """Apply changes returned by _run_job to picture."""
+    for (path, content_type) in changes.pop('sidecars', []):
+        picture.add_sidecar(path, content_type)
+    for (key, value) in changes.iteritems():
+        current = getattr(picture, key, None)
+        if isinstance(current, dict) and isinstance(value, dict):
+            current.update(value)
+        else:
+            setattr(picture, key, value)
+
+
+class LoadWorker(Worker):
+    """
+    LoadWorker reads the picture file into memory once so that the following
+    workers of the pipeline (HashDigestWorker, ThumbWorker, MetadataWorker)
+    don't read it from disk again. The content is kept in picture.buffer until
+    the picture leaves the pipeline. The size of loaded files is accounted for
+    by the pipeline's MemoryGovernor.
+
+    Workers in process stages (see ProcessWorker) get a copy of the buffer
+    while their job runs if the memory budget has room for it, otherwise
+    they read the file again (typically from the page cache).
+    """
+
+    name = 'LoadWorker'
+    # the file's content isn't kept, it's loaded again when resuming
+    journaled = False
+
+    def _work(self, picture, jobnr):
+        governor = self.pool.governor if self.pool is not None else None
+        with open(os.path.join(self.path, picture.filename), 'rb') as pic:
+            stat = get_stat_key(os.fstat(pic.fileno()))
+            # block while the pipeline's memory budget is exhausted
+            if governor is not None:
+                governor.acquire(stat[0])
+            try:
+                picture.buffer = pic.read()
+            except:
+                if governor is not None:
+                    governor.release(stat[0])
+                raise
+        picture.buffer_stat = stat
+        return True
 
 
 class ThumbWorker(Worker):
@@ -125,7 +424,11 @@ class ThumbWorker(Worker):
         if not os.path.exists(repo.THUMB_SIDECAR_DIR):
             os.mkdir(repo.THUMB_SIDECAR_DIR)
 
-        metadata = pyexiv2.ImageMetadata(picture.filename)
+        buf = picture.buffer    # may be released by a concurrent stage
+        if buf is not None:
+            metadata = pyexiv2.ImageMetadata.from_buffer(buf)
+        else:
+            metadata = pyexiv2.ImageMetadata(picture.filename)
         metadata.read()
         # pyexiv2 sorts previews by dimensions (ascending), we are only
         # interested in the one with the largest dimensions
@@ -203,7 +506,11 @@ class MetadataWorker(Worker):
                  'Exif.Image.Make', 'Exif.Image.Model',
                  'Exif.Photo.UserComment']
         try:
-            metadata = pyexiv2.ImageMetadata(_picFname)
+            buf = picture.buffer    # may be released by a concurrent stage
+            if buf is not None:
+                metadata = pyexiv2.ImageMetadata.from_buffer(buf)
+            else:
+                metadata = pyexiv2.ImageMetadata(_picFname)
             metadata.read()
         except IOError:
             self.logger.error("%s (%i): file not found: %s", _picFname)
@@ -232,13 +539,28 @@ class HashDigestWorker(Worker):
     """
 
     name = 'HashDigestWorker'
+    params = ('checksums.algorithms',)
 
     def _work(self, picture, jobnr):
         # TODO: catch exceptions of inaccessible files
-        with open(os.path.join(self.path, picture.filename), 'rb') as pic:
-            buf = pic.read()
-        digest = hashlib.sha1(buf).hexdigest()
-        picture.checksum = digest
+        chunk_size = self.conf.get('checksums.chunk_size', config.CHUNK_SIZE)
+        algorithms = parse_algorithms(self.conf.get('checksums.algorithms',
+                                                    'sha1'))
+        # SHA1 is always calculated (sidecar file, compatibility)
+        if 'sha1' not in algorithms:
+            algorithms.append('sha1')
+        # file was read by LoadWorker (unless released by a concurrent stage)
+        (buf, stat) = (picture.buffer, picture.buffer_stat)
+        if buf is not None and stat is not None:
+            digests = get_digests(buf, algorithms, chunk_size)
+        else:
+            with open(os.path.join(self.path, picture.filename), 'rb') as pic:
+                stat = get_stat_key(os.fstat(pic.fileno()))
+                digests = get_digests(pic, algorithms, chunk_size)
+        picture.checksums.update(digests)
+        picture.stat = stat
+        picture.verified = time.time()
+        digest = digests['sha1']
         if repo.SHA1_SIDECAR_ENABLED:
             # create sha1 subdir if it doesn't already exist
             #@fixme: this isn't thread-safe!
@@ -268,9 +590,20 @@ class HashDigestWorker(Worker):
 class SubprocessWorker(Worker):
     """
     SubprocessWorker class derived from Worker executes external programs.
+
+    Batchable subprocess workers take up to 'subprocess.batch_size' jobs from
+    their queue (waiting at most 'subprocess.batch_wait' seconds for more jobs
+    once they got the first one) and run a single command for all of them, so
+    the cost of starting the program is paid once per batch instead of once
+    per picture.
     """
 
     name = 'SubprocessWorker'
+    # True if derived class implements _compile_batch_command & _batch_files
+    batchable = False
+    # True if the jobs can be run by an EventLoop (only _compile_commands is
+    # used, derived classes overriding _work or _execute must reset it)
+    evented = True
 
     def _compile_commands(self, picture):
         """
@@ -284,33 +617,185 @@ class SubprocessWorker(Worker):
         pass    # Override me in derived class
         return None
 
+    def _compile_batch_command(self, files):
+        """
+        Returns command processing all given files in a single run
+
+        This function has to be overriden by batchable derived classes.
+            Arguments passed    : list of files (see _batch_files)
+            Arguments returned  : command line (list of strings)
+        """
+
+        pass    # Override me in derived class
+        return None
+
+    def _batch_files(self, picture):
+        """
+        Returns the files a batch command has to process for picture (no files:
+        nothing to do, job succeeds)
+
+        This function has to be overriden by batchable derived classes.
+            Arguments passed    : picture object
+            Arguments returned  : list of paths
+        """
+
+        pass    # Override me in derived class
+        return []
+
+    def _is_error_line(self, line):
+        """Return True if output line of a failed batch command is an error."""
+        return True
+
+    def _names_file(self, line, path):
+        """
+        Return True if error line names the file path (a whole word, e.g. in
+        "path: error" or "error in 'path'", not a longer path containing it).
+        """
+        return re.search(r'(?:^|[\s\'"`(\[:=])%s(?:$|[\s\'"`)\]:,;])'
+                         % re.escape(path), line) is not None
+
+    def _execute(self, command, jobnr):
+        """
+        Run command & log its output. Return exit code and output lines (or
+        None if the command couldn't be executed).
+        """
+        try:
+            self.process = subprocess.Popen(command,
+                                            shell=False, cwd=self.path,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT)
+        except OSError, e:
+            self.logger.error("%s (%i): '%s' execution failed: %s",
+                              self.name, jobnr, command, e)
+            return None
+        if self.pool.cancelled.is_set():    # cancelled while starting
+            self.cancel()
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                break
+            lines.append(line.strip())
+            self.logger.info(line.strip())
+        return (self.process.wait(), lines)
+
+    def cancel(self):
+        """Kill the external program run by the job in progress."""
+        process = getattr(self, 'process', None)
+        if process is not None and process.poll() is None:
+            try:
+                process.kill()
+            except OSError:
+                pass    # terminated meanwhile
+
     def _work(self, picture, jobnr):
         commands = self._compile_commands(picture)
         for command in commands:
-            try:
-                self.process = subprocess.Popen(command,
-                                                shell=False, cwd=self.path,
-                                                stdout=subprocess.PIPE,
-                                                stderr=subprocess.STDOUT)
-
-                while True:
-                    line = self.process.stdout.readline()
-                    if not line:
-                        break
-                    self.logger.info(line.strip())
-
-                retcode = self.process.wait()
-                if retcode < 0:
-                    self.logger.error("%s (%i): '%s' terminated with signal %s",
-                                      self.name, jobnr, command, retcode)
-                    return False
-            except OSError, e:
-                self.logger.error("%s (%i): '%s' execution failed: %s",
-                                  self.name, jobnr, command, e)
+            result = self._execute(command, jobnr)
+            if result is None:
+                return False
+            retcode = result[0]
+            if retcode < 0:
+                self.logger.error("%s (%i): '%s' terminated with signal %s",
+                                  self.name, jobnr, command, retcode)
+                return False
+            if retcode > 0:
+                self.logger.error("%s (%i): '%s' failed with exit code %i",
+                                  self.name, jobnr, command, retcode)
                 return False
 
         return True
 
+    def _work_batch(self, jobs):
+        """
+        Run a single command for all jobs (list of (picture, jobnr) tuples).
+        Returns list of success flags, one per job.
+
+        If the command fails (exits with a non-zero code, as a failed job of
+        _work), the jobs whose files are named in an error line of its output
+        failed (see _names_file). If no file is named, all jobs failed.
+        """
+        files = [self._batch_files(picture) for (picture, jobnr) in jobs]
+        if not any(files):
+            return [True] * len(jobs)
+        jobnr = jobs[0][1]
+        command = self._compile_batch_command(sum(files, []))
+        result = self._execute(command, jobnr)
+        if result is None:
+            return [False] * len(jobs)
+        (retcode, lines) = result
+        if retcode == 0:
+            return [True] * len(jobs)
+        if retcode < 0:
+            self.logger.error("%s (%i): '%s' terminated with signal %s",
+                              self.name, jobnr, command, retcode)
+            return [False] * len(jobs)
+        errors = [line for line in lines if self._is_error_line(line)]
+        failed = [any(self._names_file(line, path)
+                      for path in job_files for line in errors)
+                  for job_files in files]
+        if not any(failed):
+            self.logger.error("%s (%i): '%s' failed with exit code %i",
+                              self.name, jobnr, command, retcode)
+            return [False] * len(jobs)
+        return [not job_failed for job_failed in failed]
+
+    def _get_batch(self):
+        """
+        Block until a job arrives, then take more jobs until the batch is full,
+        the batch wait expired or the poison pill arrived. Returns list of jobs
+        and True if the poison pill arrived.
+        """
+        size = self.conf.get('subprocess.batch_size',
+                             config.SUBPROCESS_BATCH_SIZE)
+        wait = self.conf.get('subprocess.batch_wait',
+                             config.SUBPROCESS_BATCH_WAIT)
+        item = self.inqueue.get()
+        jobs = []
+        deadline = time.time() + wait
+        while item is not STOP:
+            jobs.append(item)
+            timeout = deadline - time.time()
+            if len(jobs) >= size or timeout <= 0:
+                break
+            try:
+                item = self.inqueue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+        return (jobs, item is STOP)
+
+    def run(self):
+        batch_size = self.conf.get('subprocess.batch_size',
+                                   config.SUBPROCESS_BATCH_SIZE)
+        if not self.batchable or batch_size <= 1:
+            return Worker.run(self)
+
+        self.logger.info("Thread %s starting up...", self.name)
+        while True:
+            wait_start = time.time()
+            (jobs, stop) = self._get_batch()
+            self.pool.stats.add_idle(time.time() - wait_start)
+            jobs = [(picture, jobnr) for (picture, jobnr) in jobs
+                    if not self._skip(picture, jobnr)]
+            if jobs:
+                self.logger.info("%s starting jobs %s", self.name,
+                                 ', '.join(str(jobnr) for (p, jobnr) in jobs))
+                start, cpu_start = time.time(), thread_time()
+                error = None
+                try:
+                    results = self._work_batch(jobs)
+                except Exception, error:
+                    self.logger.exception("%s, batch of %i jobs raised an "
+                                          "exception", self.name, len(jobs))
+                    results = [False] * len(jobs)
+                pictures = [picture for (picture, jobnr) in jobs]
+                self._job_done(start, cpu_start, zip(pictures, results))
+                for ((picture, jobnr), success) in zip(jobs, results):
+                    self._finish(picture, jobnr, success, error)
+            if stop:
+                self._stop()
+                break
+
 
 class Exiv2XMPSidecarWorker(SubprocessWorker):
     """
@@ -319,6 +804,7 @@ class Exiv2XMPSidecarWorker(SubprocessWorker):
     """
 
     name = 'Exiv2XMPSidecarWorker'
+    batchable = True
     _bin = config.EXIV2_BIN
     _args = ['-e', 'X', 'ex']
 
@@ -326,6 +812,12 @@ class Exiv2XMPSidecarWorker(SubprocessWorker):
         cmd = [ self._bin ] + self._args + [ picture.filename ]
         return cmd,
 
+    def _compile_batch_command(self, files):
+        return [ self._bin ] + self._args + files
+
+    def _batch_files(self, picture):
+        return [ picture.filename ]
+
     def _compile_sidecar_path(self, picture):
         _filename = picture.basename + '.xmp'
         _path = os.path.join(repo.XMP_SIDECAR_DIR, _filename)
@@ -340,12 +832,25 @@ class AutorotWorker(SubprocessWorker):
     """
 
     name = 'AutorotWorker'
+    batchable = True
     _bin = config.JHEAD_BIN
     _args = '-autorot'
 
     def _compile_commands(self, picture):
-        if not picture.thumbnail:
-            return [echo, "SKIPPED"],
-        else:
-            cmd = [ self._bin, self._args, picture.thumbnail ]
-            return cmd,
+        files = self._batch_files(picture)
+        if not files:
+            return ()
+        cmd = [ self._bin, self._args ] + files
+        return cmd,
+
+    def _compile_batch_command(self, files):
+        return [ self._bin, self._args ] + files
+
+    def _batch_files(self, picture):
+        # pictures without thumbnail are skipped
+        thumbnail = getattr(picture, 'thumbnail', None)
+        return [ thumbnail ] if thumbnail else []
+
+    def _is_error_line(self, line):
+        # jhead reports every rotated file
+        return not line.startswith('Modified:')